@@ -1,14 +1,30 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from .configuration import *
 from .test import *
+from .failure import *
+from .archive import *
+from .impact import *
+from .linecoverage import *
+from .rollup import *
+from .bisection import *
 from .work import *
 
 def register():
     Pool.register(
+        Configuration,
+        ConfigurationComponent,
+        TestBisect,
         TestBuildGroup,
         TestBuild,
+        TestCase,
+        TestFailure,
         TestBuildResult,
+        TestBuildArchive,
+        TestImpact,
+        TestBuildCoverage,
+        TestRollup,
         Component,
         Work,
         module='project_unittest', type_='model')
@@ -0,0 +1,115 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+import json
+import os
+import zlib
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+
+__all__ = ['TestBuildArchive']
+
+# Size of the chunks read from archive files
+CHUNK_SIZE = 64 * 1024
+
+
+def archive_path():
+    'Return the directory where archives of the current database are stored'
+    path = config.get('project_unittest', 'archive_path',
+        default=os.path.join(config.get('database', 'path'),
+            'project_unittest'))
+    return os.path.join(path, Transaction().database.name)
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+class ArchiveWriter(object):
+    '''
+    Append gzip members to a monthly archive file, each member holds one
+    JSON value by line
+    '''
+
+    def __init__(self, date=None):
+        if date is None:
+            date = datetime.date.today()
+        self.filename = '%s.jsonl.gz' % date.strftime('%Y-%m')
+        path = archive_path()
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        self.file = open(os.path.join(path, self.filename), 'ab')
+        self.compressor = None
+        self.offset = None
+
+    def start(self):
+        'Start a new member and return its offset'
+        self.file.seek(0, os.SEEK_END)
+        self.offset = self.file.tell()
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        return self.offset
+
+    def write(self, value):
+        line = json.dumps(value, default=_default) + '\n'
+        self.file.write(self.compressor.compress(line.encode('utf-8')))
+
+    def end(self):
+        'Close the current member and return its length'
+        self.file.write(self.compressor.flush())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.compressor = None
+        return self.file.tell() - self.offset
+
+    def close(self):
+        self.file.close()
+
+
+def read_archive(filename, offset, length):
+    'Yield the JSON values stored in the member of the archive file'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b''
+    with open(os.path.join(archive_path(), filename), 'rb') as file_:
+        file_.seek(offset)
+        while length > 0:
+            chunk = file_.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            lines = (pending + decompressor.decompress(chunk)).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield json.loads(line.decode('utf-8'))
+        pending += decompressor.flush()
+        if pending.strip():
+            yield json.loads(pending.decode('utf-8'))
+
+
+class TestBuildArchive(ModelSQL, ModelView):
+    'Test Build Archive'
+    __name__ = 'project.test.build.archive'
+
+    group = fields.Many2One('project.test.build.group', 'Group',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    component = fields.Many2One('project.work.component', 'Component',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    branch = fields.Char('Branch', readonly=True)
+    revision = fields.Char('Revision', readonly=True)
+    execution = fields.DateTime('Execution', readonly=True)
+    results = fields.Integer('Results', readonly=True)
+    filename = fields.Char('File Name', required=True, readonly=True)
+    offset = fields.BigInteger('Offset', required=True, readonly=True)
+    length = fields.BigInteger('Length', required=True, readonly=True)
+
+    def read_build(self):
+        '''
+        Return the values of the archived build and an iterator over the
+        values of its results
+        '''
+        values = read_archive(self.filename, self.offset, self.length)
+        return next(values), values
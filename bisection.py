@@ -0,0 +1,298 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import pipes
+import subprocess
+
+from sql import Null
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+from .planner import first_bad
+from .test import TEST_TYPES
+
+__all__ = ['TestBisect']
+
+logger = logging.getLogger(__name__)
+
+_STATES = {
+    'readonly': Eval('state') != 'draft',
+    }
+_DEPENDS = ['state']
+
+
+class TestBisect(ModelSQL, ModelView):
+    'Test Bisect'
+    __name__ = 'project.test.bisect'
+
+    component = fields.Many2One('project.work.component', 'Component',
+        required=True, select=True, states=_STATES, depends=_DEPENDS)
+    branch = fields.Char('Branch', required=True, states=_STATES,
+        depends=_DEPENDS)
+    db_type = fields.Selection([
+            ('sqlite', 'SQLite'),
+            ('postgresql', 'PostgreSQL'),
+            ], 'db_type', required=True, states=_STATES, depends=_DEPENDS)
+    good_revision = fields.Char('Good Revision', required=True,
+        states=_STATES, depends=_DEPENDS)
+    bad_revision = fields.Char('Bad Revision', required=True,
+        states=_STATES, depends=_DEPENDS)
+    revisions = fields.Text('Revisions', states=_STATES, depends=_DEPENDS,
+        help='The revisions from the good to the bad one, one by line.\n'
+        'If empty, they are listed by the revisions command of the '
+        'configuration.')
+    tests = fields.Text('Tests', readonly=True,
+        help='The tests failing on the bad revision, the only ones run.')
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ], 'State', required=True, readonly=True, select=True)
+    first_bad_revision = fields.Char('First Bad Revision', readonly=True)
+    first_bad_build = fields.Function(fields.Many2One('project.test.build',
+            'First Bad Build'), 'get_first_bad_build')
+    builds = fields.One2Many('project.test.build', 'bisect', 'Builds',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TestBisect, cls).__setup__()
+        cls.__rpc__.update({
+                'queue': RPC(readonly=False, instantiate=0),
+                })
+        cls._buttons.update({
+                'queue': {
+                    'invisible': Eval('state') != 'draft',
+                    },
+                })
+        cls._error_messages.update({
+                'no_revisions': ('No revision found between "%(good)s" and '
+                    '"%(bad)s".'),
+                'no_failing_tests': ('No failing test found for revision '
+                    '"%s".'),
+                })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @staticmethod
+    def default_db_type():
+        return 'sqlite'
+
+    def get_first_bad_build(self, name):
+        for build in self.builds:
+            if build.first_bad:
+                return build.id
+
+    def get_rec_name(self, name):
+        return '%s %s..%s' % (self.component.rec_name, self.good_revision,
+            self.bad_revision)
+
+    def get_revisions(self):
+        'Return the list of revisions from the good to the bad one'
+        pool = Pool()
+        Configuration = pool.get('project.test.configuration')
+        revisions = (self.revisions or '').split()
+        if not revisions:
+            configuration = Configuration(1)
+            if configuration.revisions_command:
+                # The command is run by the shell
+                command = configuration.revisions_command.format(
+                    component=pipes.quote(self.component.rec_name),
+                    branch=pipes.quote(self.branch),
+                    good=pipes.quote(self.good_revision),
+                    bad=pipes.quote(self.bad_revision))
+                revisions = subprocess.check_output(command, shell=True,
+                    cwd=configuration.directory).decode('utf-8').split()
+        if revisions and revisions[0] != self.good_revision:
+            revisions.insert(0, self.good_revision)
+        if revisions and revisions[-1] != self.bad_revision:
+            revisions.append(self.bad_revision)
+        if len(revisions) < 2:
+            self.raise_user_error('no_revisions', {
+                    'good': self.good_revision,
+                    'bad': self.bad_revision,
+                    })
+        return revisions
+
+    def _builds_where(self, build, group, revision):
+        '''
+        Return the condition on build joined to its group for the builds of
+        revision with results and the component, the branch and the database
+        type of the bisect
+        '''
+        # Builds reusing a cached build have no result
+        return ((build.component == self.component.id)
+            & (build.branch == self.branch)
+            & (build.revision == revision)
+            & (group.db_type == self.db_type)
+            & (build.cache_build == Null))
+
+    def get_states(self, revision, tests):
+        '''
+        Return the build and the states of tests in the latest build of
+        revision with results, a dictionary of test name and state
+        '''
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Build = pool.get('project.test.build')
+        Result = pool.get('project.test.build.result')
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+        group = Group.__table__()
+        result = Result.__table__()
+        case = TestCase.__table__()
+
+        cursor.execute(*build.join(group,
+                condition=build.group == group.id).select(build.id,
+                where=self._builds_where(build, group, revision),
+                order_by=build.id.desc, limit=1))
+        row = cursor.fetchone()
+        if not row:
+            return None, {}
+        build_id, = row
+        cursor.execute(*result.join(case,
+                condition=result.case == case.id).select(
+                case.name, result.state,
+                where=(result.build == build_id)
+                & case.name.in_(tests)))
+        return Build(build_id), dict(cursor.fetchall())
+
+    def is_bad(self, revision, tests):
+        '''
+        Return if revision is bad for tests and its build, reusing the
+        results of revision if all tests were already run.
+        Otherwise only tests are run in a new build.
+        '''
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Build = pool.get('project.test.build')
+        transaction = Transaction()
+
+        build, states = self.get_states(revision, tests)
+        if any(s in ('fail', 'error') for s in states.itervalues()):
+            return True, build
+        if build and len(states) == len(tests):
+            return False, build
+
+        group, = Group.create([{
+                    'name': 'Bisect %s' % self.rec_name,
+                    'db_type': self.db_type,
+                    'failfast': True,
+                    'bypass_cache': True,
+                    }])
+        build, = Build.create([{
+                    'group': group.id,
+                    'component': self.component.id,
+                    'branch': self.branch,
+                    'revision': revision,
+                    'covered_lines': 0,
+                    'bisect': self.id,
+                    'expected_tests': len(tests),
+                    }])
+        transaction.commit()
+        Group.run_builds([group])
+        build = Build(build.id)
+        _, states = self.get_states(revision, tests)
+        # A revision which can not run the tests is bad too
+        bad = (build.test_state != 'pass'
+            or any(s in ('fail', 'error') for s in states.itervalues()))
+        return bad, build
+
+    @classmethod
+    @ModelView.button
+    def queue(cls, bisects):
+        'Queue bisects to be run by the scheduler'
+        cls.write(bisects, {
+                'state': 'queued',
+                })
+
+    @classmethod
+    def run_queued(cls):
+        'Run the queued bisects, the oldest first'
+        transaction = Transaction()
+        bisects = cls.search([
+                ('state', '=', 'queued'),
+                ], order=[('id', 'ASC')])
+        for bisect in bisects:
+            # A failing bisect is not run again
+            cls.write([bisect], {
+                    'state': 'running',
+                    })
+            transaction.commit()
+            cls.run([bisect])
+
+    @classmethod
+    def run(cls, bisects):
+        '''
+        Search by bisection the first bad revision of bisects, running only
+        the tests failing on the bad revision.
+        Each build is committed as soon as it is run.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        transaction = Transaction()
+        for bisect in bisects:
+            revisions = bisect.get_revisions()
+            build, states = bisect.get_states(bisect.bad_revision,
+                bisect.get_failing_tests())
+            tests = sorted(n for n, s in states.iteritems()
+                if s in ('fail', 'error'))
+            if not tests:
+                cls.raise_user_error('no_failing_tests', bisect.bad_revision)
+            cls.write([bisect], {
+                    'state': 'running',
+                    'revisions': '\n'.join(revisions),
+                    'tests': '\n'.join(tests),
+                    })
+            transaction.commit()
+
+            builds = {bisect.bad_revision: build}
+
+            def is_bad(revision):
+                bad, builds[revision] = bisect.is_bad(revision, tests)
+                logger.info('Bisect %s: revision %s is %s', bisect.id,
+                    revision, 'bad' if bad else 'good')
+                return bad
+            bad = first_bad(revisions, is_bad)
+            bad_build = builds[revisions[bad]]
+            cls.write([bisect], {
+                    'state': 'done',
+                    'first_bad_revision': revisions[bad],
+                    })
+            if bad_build:
+                Build.write([bad_build], {
+                        'bisect': bisect.id,
+                        'first_bad': True,
+                        })
+            transaction.commit()
+
+    def get_failing_tests(self):
+        'Return the names of the failing tests of the bad revision'
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Build = pool.get('project.test.build')
+        Result = pool.get('project.test.build.result')
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+        group = Group.__table__()
+        result = Result.__table__()
+        case = TestCase.__table__()
+
+        cursor.execute(*result.join(case,
+                condition=result.case == case.id).select(case.name,
+                where=result.build.in_(build.join(group,
+                        condition=build.group == group.id).select(build.id,
+                        where=self._builds_where(build, group,
+                            self.bad_revision)))
+                & result.type.in_(TEST_TYPES)
+                & result.state.in_(['fail', 'error'])))
+        return list({n for n, in cursor.fetchall()})
@@ -1,32 +1,102 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import ModelSQL, ModelView, ModelSingleton
 import os
-import subprocess
 
-__all__ = ['Configuration','ConfigurationComponent']
+from trytond.model import ModelSQL, ModelView, ModelSingleton, fields
+
+from .template import TemplatePool
+
+__all__ = ['Configuration', 'ConfigurationComponent']
 
 
 class Configuration(ModelSingleton, ModelSQL, ModelView):
-    '''Product Configuration'''
+    'Test Configuration'
     __name__ = 'project.test.configuration'
 
-
-    test_component = fields.Many2One('project.component', 'Repository', required=True)
+    test_component = fields.Many2One('project.work.component', 'Repository',
+        required=True)
     directory = fields.Char('Directory', required=True)
     client_components = fields.Many2Many(
-        'project.test.configuration-project.component',
+        'project.test.configuration-project.work.component',
         'configuration', 'component', 'Client Components')
+    workers = fields.Integer('Workers',
+        help='Number of builds run in parallel, the number of CPUs if empty.')
+    checkout_command = fields.Char('Checkout Command', required=True,
+        help='Command run in the directory to get the working copy of a '
+        'build.\nAvailable placeholders: {component}, {branch}, {revision} '
+        'and {directory}.')
+    test_command = fields.Char('Test Command', required=True,
+        help='Command run in the working copy of a build which must write '
+        'the JUnit XML report to {report} and may write the Cobertura XML '
+        'report to {coverage}.\n{order} is a file with the names of the '
+        'tests to run, one by line, in the order they should be run.')
+    template_command = fields.Char('Template Command',
+        help='Command run in the working copy of a build to install the '
+        'dependencies of its modules, but not the modules themselves, in the '
+        'database named by the DB_NAME environment variable. '
+        'If set, the database is kept as template and cloned for the next '
+        'builds of the same components, dependencies and database type, '
+        'whatever their revision.')
+    dependencies_command = fields.Char('Dependencies Command',
+        help='Command run in the working copy of a build which prints the '
+        'list and the revision of its dependencies. Templates are rebuilt '
+        'when it changes.')
+    revisions_command = fields.Char('Revisions Command',
+        help='Command run in the directory to list the revisions of a '
+        'component from {good} to {bad}, one by line, for bisections.\n'
+        'Available placeholders: {component}, {branch}, {good} and {bad}.')
+    changes_command = fields.Char('Changes Command',
+        help='Command run in the directory which prints the unified diff of '
+        'the changes of a revision, to run first the tests covering them.\n'
+        'Available placeholders: {component}, {branch} and {revision}.')
+    retention_weeks = fields.Integer('Retention Weeks',
+        help='Number of weeks the builds of ended groups are kept.')
+    archive_builds = fields.Boolean('Archive Builds',
+        help='Archive the expired builds to compressed files instead of '
+        'deleting them.')
+
+    @classmethod
+    def __setup__(cls):
+        super(Configuration, cls).__setup__()
+        cls._buttons.update({
+                'invalidate_templates': {},
+                })
+
+    @property
+    def template_directory(self):
+        return os.path.join(self.directory, 'templates')
 
+    @classmethod
+    @ModelView.button
+    def invalidate_templates(cls, configurations):
+        'Drop the template databases to rebuild them on the next builds'
+        for configuration in configurations:
+            if os.path.isdir(configuration.template_directory):
+                TemplatePool(configuration.template_directory).invalidate()
 
+    @staticmethod
+    def default_retention_weeks():
+        return 1
+
+    @staticmethod
+    def default_archive_builds():
+        return False
+
+    @staticmethod
+    def default_checkout_command():
+        return 'hg clone -u {revision} {component} {directory}'
+
+    @staticmethod
+    def default_test_command():
+        return ('coverage run -m pytest --junitxml={report} tests '
+            '&& coverage xml -o {coverage}')
 
 
 class ConfigurationComponent(ModelSQL):
     'Configuration - Component'
-    __name__ = 'project.test.configuration-project.component'
+    __name__ = 'project.test.configuration-project.work.component'
 
     configuration = fields.Many2One('project.test.configuration',
         'Configuration', required=True, select=True)
-    component = fields.Many2One('project.component', 'Component',
+    component = fields.Many2One('project.work.component', 'Component',
         required=True, select=True)
-
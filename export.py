@@ -0,0 +1,126 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Streaming export of results to JUnit XML and CSV'
+import csv
+from xml.sax.saxutils import escape, quoteattr
+
+from trytond import backend
+from trytond.transaction import Transaction
+
+__all__ = ['JUnitWriter', 'CSVWriter', 'EXPORT_FORMATS', 'server_cursor']
+
+# Number of rows fetched at once by server-side cursors
+FETCH_SIZE = 2000
+
+
+def server_cursor(name):
+    '''
+    Return a cursor which fetches the rows of its query by chunks instead of
+    loading them all, using a named cursor on PostgreSQL
+    '''
+    connection = Transaction().connection
+    if backend.name() == 'postgresql':
+        cursor = connection.cursor(name)
+        cursor.itersize = FETCH_SIZE
+        return cursor
+    return connection.cursor()
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value
+
+
+class JUnitWriter(object):
+    '''
+    Write results as JUnit XML, one testsuite by build, to a file opened in
+    binary mode. The header is not written when continuing an export.
+    '''
+    extension = 'xml'
+
+    def __init__(self, file_, header=True):
+        self.file = file_
+        if header:
+            self._write(
+                u'<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+
+    def _write(self, text):
+        self.file.write(text.encode('utf-8'))
+
+    def start_build(self, name, tests, failures, errors, time):
+        self._write(u'<testsuite name=%s tests="%s" failures="%s" '
+            'errors="%s" time="%.3f">\n' % (quoteattr(_text(name)), tests,
+                failures, errors, time or 0))
+
+    def resume_build(self, name):
+        'Continue the build started by a previous chunk of the export'
+        pass
+
+    def write(self, result):
+        name = _text(result['name'])
+        classname = None
+        if result['type'] != 'scenario' and '.' in name:
+            classname, name = name.rsplit('.', 1)
+        attributes = u'name=%s' % quoteattr(name)
+        if classname:
+            attributes = u'classname=%s %s' % (quoteattr(classname),
+                attributes)
+        if result['duration'] is not None:
+            attributes += u' time="%.3f"' % result['duration']
+        if result['state'] in ('fail', 'error'):
+            tag = 'failure' if result['state'] == 'fail' else 'error'
+            description = _text(result['description'])
+            message = description.strip().splitlines()[-1:] or [u'']
+            self._write(u'<testcase %s><%s message=%s>%s</%s></testcase>\n'
+                % (attributes, tag, quoteattr(message[0]),
+                    escape(description), tag))
+        else:
+            self._write(u'<testcase %s/>\n' % attributes)
+
+    def end_build(self):
+        self._write(u'</testsuite>\n')
+
+    def close(self):
+        self._write(u'</testsuites>\n')
+
+
+class CSVWriter(object):
+    '''
+    Write results as CSV, one line by result, to a file opened in binary mode.
+    The header is not written when continuing an export.
+    '''
+    extension = 'csv'
+    fields = ['build', 'name', 'type', 'state', 'duration', 'flaky',
+        'description']
+
+    def __init__(self, file_, header=True):
+        self.writer = csv.writer(file_)
+        if header:
+            self.writer.writerow(self.fields)
+        self.build = None
+
+    def start_build(self, name, tests, failures, errors, time):
+        self.build = name
+
+    def resume_build(self, name):
+        self.build = name
+
+    def write(self, result):
+        values = dict(result, build=self.build)
+        self.writer.writerow([_text(values[f]).encode('utf-8')
+                for f in self.fields])
+
+    def end_build(self):
+        self.build = None
+
+    def close(self):
+        pass
+
+
+EXPORT_FORMATS = {
+    'junit': JUnitWriter,
+    'csv': CSVWriter,
+    }
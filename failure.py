@@ -0,0 +1,150 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+import hashlib
+import re
+import zlib
+
+from sql.aggregate import Count, Max
+
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['TestFailure']
+
+# Maximal length of the summary of failures
+SUMMARY_SIZE = 256
+
+_NORMALIZE = [
+    # Directories of file paths
+    (re.compile(r'(?:[A-Za-z]:)?(?:[\\/][^\s\\/:"\']+)+[\\/]'), ''),
+    # Line numbers of tracebacks and of pytest reports
+    (re.compile(r'(, line )\d+'), r'\1N'),
+    (re.compile(r'(\.py):\d+'), r'\1'),
+    # Memory addresses
+    (re.compile(r'0x[0-9a-fA-F]+'), '0x?'),
+    (re.compile(r'[ \t]+$', re.M), ''),
+    ]
+
+
+def normalize_traceback(text):
+    '''
+    Return text without what differs between occurrences of the same
+    failure: file paths, line numbers and memory addresses
+    '''
+    for pattern, replacement in _NORMALIZE:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def fingerprint(text):
+    'Return the fingerprint of the failure described by text'
+    normalized = normalize_traceback(text)
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def summary(text):
+    'Return the last line of the normalized text, usually the exception'
+    lines = normalize_traceback(text).splitlines()
+    return lines[-1][:SUMMARY_SIZE] if lines else ''
+
+
+class TestFailure(ModelSQL, ModelView):
+    'Test Failure'
+    __name__ = 'project.test.failure'
+    _rec_name = 'summary'
+
+    fingerprint = fields.Char('Fingerprint', required=True, readonly=True,
+        select=True, help='Hash of the normalized traceback.')
+    summary = fields.Char('Summary', readonly=True)
+    data = fields.Binary('Data', readonly=True,
+        help='The compressed description of the first result.')
+    description = fields.Function(fields.Text('Description'),
+        'get_description')
+    results = fields.One2Many('project.test.build.result', 'failure',
+        'Results', readonly=True)
+    result_count = fields.Function(fields.Integer('Results'), 'get_counts')
+    component_count = fields.Function(fields.Integer('Components'),
+        'get_counts')
+    last_execution = fields.Function(fields.DateTime('Last Execution'),
+        'get_counts')
+
+    @classmethod
+    def __setup__(cls):
+        super(TestFailure, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('fingerprint_uniq', Unique(t, t.fingerprint),
+                'The fingerprint of failures must be unique.'),
+            ]
+        cls._order.insert(0, ('id', 'DESC'))
+
+    def get_description(self, name):
+        if self.data:
+            return zlib.decompress(self.data).decode('utf-8')
+
+    @classmethod
+    def get_counts(cls, failures, names):
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+        Build = pool.get('project.test.build')
+        cursor = Transaction().connection.cursor()
+        result = Result.__table__()
+        build = Build.__table__()
+
+        counts = dict((n, {}.fromkeys((f.id for f in failures), None))
+            for n in names)
+        for sub_failures in grouped_slice(failures):
+            cursor.execute(*result.join(build,
+                    condition=result.build == build.id).select(result.failure,
+                    Count(result.id), Count(build.component, distinct=True),
+                    Max(build.execution),
+                    where=reduce_ids(result.failure,
+                        [f.id for f in sub_failures]),
+                    group_by=result.failure))
+            for row in cursor.fetchall():
+                for name, value in zip(('result_count', 'component_count',
+                            'last_execution'), row[1:]):
+                    if name in counts:
+                        counts[name][row[0]] = value
+        return counts
+
+    @classmethod
+    def get_ids(cls, descriptions, cache):
+        '''
+        Fill cache, a dictionary of fingerprint and failure id, with the
+        failures of descriptions, a dictionary of fingerprint and description,
+        creating the missing failures
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        def fetch():
+            missing = [f for f in descriptions if f not in cache]
+            for sub_fingerprints in grouped_slice(missing):
+                cursor.execute(*table.select(table.id, table.fingerprint,
+                        where=table.fingerprint.in_(list(sub_fingerprints))))
+                for id_, fingerprint_ in cursor.fetchall():
+                    cache[fingerprint_] = id_
+            return [f for f in missing if f not in cache]
+        to_create = fetch()
+        if to_create:
+            # Concurrent imports may create the same failures
+            cls.lock()
+            to_create = fetch()
+        if to_create:
+            create_date = datetime.datetime.now()
+            columns = [table.create_uid, table.create_date,
+                table.fingerprint, table.summary, table.data]
+            for sub_fingerprints in grouped_slice(to_create):
+                cursor.execute(*table.insert(columns, [
+                            [transaction.user, create_date, f,
+                                summary(descriptions[f]),
+                                cls.data.sql_format(zlib.compress(
+                                        descriptions[f].encode('utf-8')))]
+                            for f in sub_fingerprints]))
+            fetch()
+        return cache
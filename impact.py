@@ -0,0 +1,249 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import base64
+import json
+import os
+import sqlite3
+import tempfile
+import zlib
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['TestImpact']
+
+
+def numbits_to_lines(numbits):
+    'Return the line numbers set in numbits (coverage.py format)'
+    lines = []
+    for index, byte in enumerate(bytearray(numbits)):
+        for bit in range(8):
+            if byte & (1 << bit):
+                lines.append(index * 8 + bit)
+    return lines
+
+
+def lines_to_numbits(lines):
+    'Return the numbits (coverage.py format) of line numbers'
+    numbits = bytearray((max(lines) // 8 + 1) if lines else 0)
+    for line in lines:
+        numbits[line // 8] |= 1 << (line % 8)
+    return bytes(numbits)
+
+
+def numbits_any(numbits, other):
+    'Return if numbits and other have at least one line in common'
+    return any(a & b for a, b in zip(bytearray(numbits), bytearray(other)))
+
+
+def _hunk_range(text):
+    'Return the start and the number of lines of a range of a diff hunk'
+    start, _, count = text[1:].partition(',')
+    return int(start), int(count) if count else 1
+
+
+def diff_changes(lines):
+    '''
+    Return the changes of the unified diff lines, a dictionary of file name
+    and the numbers of the lines added or modified in the new files
+    '''
+    changes = {}
+    filename = None
+    line = old = new = 0
+    for text in lines:
+        if old > 0 or new > 0:
+            # Inside a hunk
+            if text.startswith('+'):
+                if filename:
+                    changes.setdefault(filename, []).append(line)
+                line += 1
+                new -= 1
+            elif text.startswith('-'):
+                old -= 1
+            elif not text.startswith('\\'):
+                line += 1
+                old -= 1
+                new -= 1
+        elif text.startswith('+++ '):
+            filename = text[4:].split('\t')[0].strip()
+            if filename == '/dev/null':
+                filename = None
+            elif filename.startswith('b/'):
+                filename = filename[2:]
+        elif text.startswith('@@ '):
+            old_range, new_range = text.split()[1:3]
+            _, old = _hunk_range(old_range)
+            line, new = _hunk_range(new_range)
+    return changes
+
+
+def encode_map(tests):
+    'Encode tests, a dictionary of test case id and numbits'
+    return zlib.compress(json.dumps(dict((str(k), base64.b64encode(v))
+                    for k, v in tests.iteritems())))
+
+
+def decode_map(data):
+    return dict((int(k), base64.b64decode(v))
+        for k, v in json.loads(zlib.decompress(data)).iteritems())
+
+
+class TestImpact(ModelSQL, ModelView):
+    'Test Impact'
+    __name__ = 'project.test.impact'
+
+    build = fields.Many2One('project.test.build', 'Build', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    component = fields.Many2One('project.work.component', 'Component',
+        required=True, readonly=True, ondelete='CASCADE')
+    revision = fields.Char('Revision', required=True, readonly=True)
+    filename = fields.Char('File Name', required=True, readonly=True)
+    data = fields.Binary('Data', readonly=True,
+        help='Lines covered by each test case of the file.')
+
+    @classmethod
+    def __setup__(cls):
+        super(TestImpact, cls).__setup__()
+        cls.__rpc__.update({
+                'upload_contexts': RPC(readonly=False, instantiate=0),
+                'select_tests': RPC(),
+                })
+        cls._error_messages.update({
+                'missing_contexts': 'The coverage data file "%s" is missing.',
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(TestImpact, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['component', 'revision', 'filename'], 'add')
+
+    @classmethod
+    def import_contexts(cls, build, path, root=None):
+        '''
+        Store the lines covered by each test of build from the coverage.py
+        data file at path, recorded with dynamic contexts (for example with
+        "--contexts=test_function").
+
+        Contexts are matched to test cases by name or by name suffix and file
+        names are made relative to root.
+        path is read on the server so clients must use upload_contexts.
+        '''
+        pool = Pool()
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        case = TestCase.__table__()
+
+        cursor.execute(*case.select(case.id, case.name,
+                where=case.component == build.component.id))
+        case_ids = {}
+        for case_id, name in cursor.fetchall():
+            parts = name.split('.')
+            for i in range(len(parts)):
+                case_ids.setdefault('.'.join(parts[i:]), case_id)
+
+        # SQLite would create a missing database
+        if not os.path.isfile(path):
+            cls.raise_user_error('missing_contexts', path)
+        connection = sqlite3.connect(path)
+        try:
+            contexts = {}
+            for context_id, context in connection.execute(
+                    'SELECT id, context FROM context'):
+                if context in case_ids:
+                    contexts[context_id] = case_ids[context]
+            to_create = []
+            for file_id, filename in connection.execute(
+                    'SELECT id, path FROM file').fetchall():
+                tests = {}
+                for context_id, numbits in connection.execute(
+                        'SELECT context_id, numbits FROM line_bits '
+                        'WHERE file_id = ?', (file_id,)):
+                    if context_id in contexts:
+                        tests[contexts[context_id]] = bytes(numbits)
+                if not tests:
+                    continue
+                if root:
+                    filename = os.path.relpath(filename, root)
+                to_create.append({
+                        'build': build.id,
+                        'component': build.component.id,
+                        'revision': build.revision,
+                        'filename': filename,
+                        'data': encode_map(tests),
+                        })
+        finally:
+            connection.close()
+        cls.create(to_create)
+
+    @classmethod
+    def upload_contexts(cls, build, data, root=None):
+        '''
+        Store the lines covered by each test of build from the content of the
+        coverage.py data file sent by a client, see import_contexts
+        '''
+        # SQLite only reads databases from files
+        with tempfile.NamedTemporaryFile(suffix='.coverage') as file_:
+            file_.write(data)
+            file_.flush()
+            cls.import_contexts(build, file_.name, root=root)
+
+    @classmethod
+    def select_tests(cls, component, changes, revision=None):
+        '''
+        Return the names of the tests of component covering the changes, a
+        dictionary of file name and changed line numbers, and the file names
+        without coverage data.
+
+        The coverage data of revision is used or the one of the latest build
+        of component with coverage data.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        build = Build.__table__()
+        case = TestCase.__table__()
+
+        component = int(component)
+        if revision is None:
+            cursor.execute(*table.join(build,
+                    condition=table.build == build.id).select(
+                    table.revision,
+                    where=table.component == component,
+                    order_by=[build.execution.desc, build.id.desc],
+                    limit=1))
+            row = cursor.fetchone()
+            if not row:
+                return [], sorted(changes)
+            revision, = row
+
+        case_ids = set()
+        unknown = set(changes)
+        for sub_files in grouped_slice(list(changes)):
+            cursor.execute(*table.select(table.filename, table.data,
+                    where=(table.component == component)
+                    & (table.revision == revision)
+                    & table.filename.in_(list(sub_files))))
+            for filename, data in cursor.fetchall():
+                unknown.discard(filename)
+                changed = lines_to_numbits(changes[filename])
+                for case_id, numbits in decode_map(bytes(data)).iteritems():
+                    if case_id not in case_ids and numbits_any(numbits,
+                            changed):
+                        case_ids.add(case_id)
+
+        names = []
+        for sub_ids in grouped_slice(list(case_ids)):
+            cursor.execute(*case.select(case.name,
+                    where=reduce_ids(case.id, list(sub_ids))))
+            names.extend(n for n, in cursor.fetchall())
+        return sorted(names), sorted(unknown)
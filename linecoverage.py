@@ -0,0 +1,178 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['TestBuildCoverage']
+
+
+def _write_varint(data, value):
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return
+
+
+def _read_varints(data):
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = shift = 0
+
+
+def encode_runs(lines):
+    '''
+    Encode the line numbers as runs of consecutive lines, each run being
+    stored as the gap from the end of the previous run and its length, both
+    as variable length integers
+    '''
+    data = bytearray()
+    end = 0
+    start = previous = None
+    for line in sorted(set(lines)):
+        if start is not None and line == previous + 1:
+            previous = line
+            continue
+        if start is not None:
+            _write_varint(data, start - end)
+            _write_varint(data, previous - start + 1)
+            end = previous + 1
+        start = previous = line
+    if start is not None:
+        _write_varint(data, start - end)
+        _write_varint(data, previous - start + 1)
+    return bytes(data)
+
+
+def decode_runs(data):
+    'Return the line numbers encoded by encode_runs'
+    lines = []
+    end = 0
+    values = _read_varints(data or b'')
+    for gap, length in zip(values, values):
+        start = end + gap
+        lines.extend(range(start, start + length))
+        end = start + length
+    return lines
+
+
+class TestBuildCoverage(ModelSQL, ModelView):
+    'Test Build Coverage'
+    __name__ = 'project.test.build.coverage'
+
+    build = fields.Many2One('project.test.build', 'Build', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    filename = fields.Char('File Name', required=True, readonly=True)
+    lines = fields.Integer('Lines', readonly=True)
+    covered_lines = fields.Integer('Covered Lines', readonly=True)
+    statements = fields.Binary('Statements', readonly=True)
+    missing = fields.Binary('Missing', readonly=True)
+
+    @classmethod
+    def import_files(cls, build, files):
+        '''
+        Store the coverage of files, an iterable of file name, statement lines
+        and missing lines, for build
+        '''
+        vlist = []
+        for filename, statements, missing in files:
+            values = cls._file_values(statements, missing)
+            values.update({
+                    'build': build.id,
+                    'filename': filename,
+                    })
+            vlist.append(values)
+            if len(vlist) >= 1000:
+                cls.create(vlist)
+                vlist = []
+        if vlist:
+            cls.create(vlist)
+
+    @staticmethod
+    def _file_values(statements, missing):
+        return {
+            'lines': len(statements),
+            'covered_lines': len(statements) - len(missing),
+            'statements': encode_runs(statements),
+            'missing': encode_runs(missing),
+            }
+
+    @classmethod
+    def merge_files(cls, build, files):
+        '''
+        Merge the coverage of files, as given to import_files, into the
+        stored coverage of build. A line is covered if any of the merged
+        reports covers it.
+        '''
+        files = list(files)
+        for sub_files in grouped_slice(files, 1000):
+            sub_files = list(sub_files)
+            coverages = dict((c.filename, c) for c in cls.search([
+                        ('build', '=', build.id),
+                        ('filename', 'in', [f[0] for f in sub_files]),
+                        ]))
+            new_files, to_write = [], []
+            for filename, statements, missing in sub_files:
+                coverage = coverages.get(filename)
+                if not coverage:
+                    new_files.append((filename, statements, missing))
+                    continue
+                old_statements = set(decode_runs(coverage.statements))
+                old_missing = set(decode_runs(coverage.missing))
+                statements, missing = set(statements), set(missing)
+                missing = ((missing & old_missing)
+                    | (missing - old_statements)
+                    | (old_missing - statements))
+                to_write.extend(([coverage], cls._file_values(
+                            statements | old_statements, missing)))
+            cls.import_files(build, new_files)
+            if to_write:
+                cls.write(*to_write)
+
+    @classmethod
+    def diff_coverage(cls, build, changes):
+        '''
+        Return the coverage of the changes, a dictionary of file name and
+        changed line numbers, by build as a dictionary with the number of
+        changed statements (lines), the number of those covered
+        (covered_lines), the coverage percentage and the missing lines by
+        file. Only the coverage of the changed files is read.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        source = build.cache_build or build
+        lines = covered_lines = 0
+        missing_lines = {}
+        if changes:
+            cursor.execute(*table.select(table.filename, table.statements,
+                    table.missing,
+                    where=(table.build == source.id)
+                    & table.filename.in_(list(changes))))
+            rows = cursor.fetchall()
+        else:
+            rows = []
+        for filename, statements, missing in rows:
+            changed = set(changes[filename])
+            statements = changed.intersection(decode_runs(statements))
+            missing = statements.intersection(decode_runs(missing))
+            lines += len(statements)
+            covered_lines += len(statements) - len(missing)
+            if missing:
+                missing_lines[filename] = sorted(missing)
+        return {
+            'lines': lines,
+            'covered_lines': covered_lines,
+            'coverage': (round(covered_lines * 100.0 / lines, 2)
+                if lines else None),
+            'missing': missing_lines,
+            }
@@ -0,0 +1,117 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Weekly range partitioning of tables on PostgreSQL'
+import datetime
+import logging
+
+from trytond import backend
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['partitioned', 'week_start', 'partition_table',
+    'create_partitions', 'week_partitions', 'drop_partition']
+
+logger = logging.getLogger(__name__)
+
+
+def partitioned():
+    'Return if the tables must be partitioned by week'
+    return (backend.name() == 'postgresql'
+        and config.getboolean('project_unittest', 'partition',
+            default=False))
+
+
+def week_start(value):
+    'Return the monday of the week of value, a date or a datetime'
+    if value is None:
+        value = datetime.date.today()
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value - datetime.timedelta(days=value.weekday())
+
+
+def _partition_name(table, week):
+    return '%s_p%s' % (table, week.strftime('%Y%m%d'))
+
+
+def is_partitioned(table):
+    cursor = Transaction().connection.cursor()
+    cursor.execute('SELECT 1 FROM pg_partitioned_table '
+        'WHERE partrelid = to_regclass(%s)', ('"%s"' % table,))
+    return bool(cursor.fetchone())
+
+
+def create_partitions(table, weeks):
+    'Create the missing partitions of table for weeks'
+    cursor = Transaction().connection.cursor()
+    for week in set(weeks):
+        cursor.execute('CREATE TABLE IF NOT EXISTS "%s" PARTITION OF "%s" '
+            'FOR VALUES FROM (%%s) TO (%%s)' % (
+                _partition_name(table, week), table),
+            (week, week + datetime.timedelta(days=7)))
+
+
+def week_partitions(table):
+    'Return the list of partition names and weeks of table'
+    cursor = Transaction().connection.cursor()
+    cursor.execute('SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname',
+        ('"%s"' % table,))
+    partitions = []
+    for name, in cursor.fetchall():
+        week = datetime.datetime.strptime(name[-8:], '%Y%m%d').date()
+        partitions.append((name, week))
+    return partitions
+
+
+def drop_partition(table, name):
+    'Detach the partition name from table and drop it'
+    cursor = Transaction().connection.cursor()
+    cursor.execute('ALTER TABLE "%s" DETACH PARTITION "%s"' % (table, name))
+    cursor.execute('DROP TABLE "%s"' % name)
+
+
+def partition_table(table, column):
+    '''
+    Replace table by a table partitioned by week on column, a date column
+    without null values, moving its rows, indexes and foreign keys.
+    The primary key becomes the id and column.
+    '''
+    cursor = Transaction().connection.cursor()
+    if is_partitioned(table):
+        return
+    legacy = table + '__legacy'
+    logger.info('Partitioning table %s by week of %s', table, column)
+    cursor.execute('ALTER TABLE "%s" RENAME TO "%s"' % (table, legacy))
+    cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS '
+        'INCLUDING CONSTRAINTS) PARTITION BY RANGE ("%s")'
+        % (table, legacy, column))
+    cursor.execute('ALTER TABLE "%s" ADD PRIMARY KEY (id, "%s")'
+        % (table, column))
+    # The sequence must survive the legacy table
+    cursor.execute('ALTER SEQUENCE "%s_id_seq" OWNED BY NONE' % table)
+
+    cursor.execute('SELECT i.relname, pg_get_indexdef(i.oid) '
+        'FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid '
+        'WHERE x.indrelid = to_regclass(%s) AND NOT x.indisunique',
+        ('"%s"' % legacy,))
+    indexes = cursor.fetchall()
+    cursor.execute('SELECT conname, pg_get_constraintdef(oid) '
+        'FROM pg_constraint WHERE conrelid = to_regclass(%s) '
+        'AND contype = \'f\'', ('"%s"' % legacy,))
+    foreign_keys = cursor.fetchall()
+    for name, _ in foreign_keys:
+        cursor.execute('ALTER TABLE "%s" DROP CONSTRAINT "%s"'
+            % (legacy, name))
+    for name, definition in indexes:
+        cursor.execute('DROP INDEX "%s"' % name)
+        cursor.execute(definition.replace(legacy, table, 1))
+    for name, definition in foreign_keys:
+        cursor.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" %s'
+            % (table, name, definition))
+
+    cursor.execute('SELECT DISTINCT "%s" FROM "%s"' % (column, legacy))
+    create_partitions(table, [w for w, in cursor.fetchall()])
+    cursor.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (table, legacy))
+    cursor.execute('DROP TABLE "%s"' % legacy)
@@ -0,0 +1,60 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Planning of the execution of tests'
+import heapq
+
+__all__ = ['lpt_shards', 'priority_order', 'first_bad']
+
+
+def lpt_shards(durations, count):
+    '''
+    Split durations, a dictionary of test and expected duration, into count
+    shards using the longest processing time first rule: tests are taken
+    from the longest to the shortest and each one is put in the shard with
+    the lowest total duration.
+
+    Returns a list of tuples with the total duration and the tests of each
+    shard.
+    '''
+    count = max(1, min(count, len(durations) or 1))
+    shards = [(0.0, i, []) for i in range(count)]
+    heapq.heapify(shards)
+    for test in sorted(durations, key=lambda t: (-durations[t], t)):
+        total, i, tests = heapq.heappop(shards)
+        tests.append(test)
+        heapq.heappush(shards, (total + durations[test], i, tests))
+    return [(total, tests) for total, _, tests in sorted(shards,
+            key=lambda s: s[1])]
+
+
+def priority_order(tests, *priorities):
+    '''
+    Order tests by taking first those of each list of priorities, in their
+    order, followed by the remaining tests sorted by name.
+    Tests of priorities which are not in tests are ignored.
+    '''
+    tests = set(tests)
+    order = []
+    for priority in priorities:
+        for test in priority:
+            if test in tests:
+                order.append(test)
+                tests.discard(test)
+    order.extend(sorted(tests))
+    return order
+
+
+def first_bad(revisions, is_bad):
+    '''
+    Return the index of the first bad revision of revisions, ordered from a
+    good revision to a bad one, by binary search calling is_bad on as few
+    revisions as possible
+    '''
+    good, bad = 0, len(revisions) - 1
+    while bad - good > 1:
+        middle = (good + bad) // 2
+        if is_bad(revisions[middle]):
+            bad = middle
+        else:
+            good = middle
+    return bad
@@ -0,0 +1,106 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Sampled SQL profiling of the getters and state updates'
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['CountingConnection', 'profiler']
+
+logger = logging.getLogger(__name__)
+
+
+class CountingCursor(object):
+    'Cursor proxy counting executed statements and fetched rows'
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter['statements'] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, query, rows):
+        rows = list(rows)
+        self._counter['statements'] += len(rows)
+        return self._cursor.executemany(query, rows)
+
+    def _fetched(self, rows):
+        self._counter['rows'] += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._counter['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        return self._fetched(self._cursor.fetchmany(*args))
+
+    def fetchall(self):
+        return self._fetched(self._cursor.fetchall())
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._counter['rows'] += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    'Connection proxy returning counting cursors'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.counter = {'statements': 0, 'rows': 0}
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._connection.cursor(*args, **kwargs),
+            self.counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def profile_rate():
+    'Return the ratio of calls which are profiled'
+    return config.getfloat('project_unittest', 'profile_rate', default=0)
+
+
+@contextmanager
+def profiler(model, method, records=None):
+    '''
+    Log as JSON the number of SQL statements, the number of fetched rows and
+    the elapsed time of the block for the ratio of calls set by the
+    profile_rate option of the project_unittest section
+    '''
+    rate = profile_rate()
+    if not rate or random.random() >= rate:
+        yield
+        return
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = counting = CountingConnection(connection)
+    start = time.time()
+    try:
+        yield
+    finally:
+        transaction.connection = connection
+        logger.info(json.dumps({
+                    'model': model,
+                    'method': method,
+                    'records': records,
+                    'statements': counting.counter['statements'],
+                    'rows': counting.counter['rows'],
+                    'elapsed': round(time.time() - start, 6),
+                    'rate': rate,
+                    }))
@@ -0,0 +1,210 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Incremental parsers of test reports'
+import datetime
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+__all__ = ['iter_junit', 'iter_subunit', 'read_coverage',
+    'iter_coverage_files']
+
+
+def _open(report):
+    if isinstance(report, basestring):
+        return open(report, 'rb'), True
+    return report, False
+
+
+def _result_type(name):
+    # Tryton scenarios are doctests run from rst files
+    if name.endswith('.rst') or name.endswith('_rst'):
+        return 'scenario'
+    return 'unittest'
+
+
+def iter_junit(report):
+    '''
+    Yield a dictionary with name, type, state, description and duration for
+    each testcase of the JUnit XML report (a file name or a file object).
+
+    Parsed elements are released as soon as they are read so memory usage
+    does not depend on the size of the report.
+    '''
+    report, close = _open(report)
+    try:
+        parents = []
+        for event, elem in ElementTree.iterparse(report,
+                events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag != 'testcase':
+                continue
+            name = elem.get('name', '')
+            classname = elem.get('classname')
+            if classname:
+                name = '%s.%s' % (classname, name)
+            state, description = 'pass', None
+            for child in elem:
+                if child.tag in ('failure', 'error'):
+                    state = 'fail' if child.tag == 'failure' else 'error'
+                    description = '\n'.join(filter(None,
+                            (child.get('message'), child.text)))
+                    break
+            duration = elem.get('time')
+            yield {
+                'name': name,
+                'type': _result_type(name),
+                'state': state,
+                'description': description,
+                'duration': float(duration) if duration else None,
+                }
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+    finally:
+        if close:
+            report.close()
+
+
+def _parse_time(value):
+    value = value.rstrip('Z')
+    for format_ in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, format_)
+        except ValueError:
+            continue
+
+
+def _total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+SUBUNIT_STATES = {
+    'success': 'pass',
+    'successful': 'pass',
+    'skip': 'pass',
+    'xfail': 'pass',
+    'failure': 'fail',
+    'uxsuccess': 'fail',
+    'error': 'error',
+    }
+
+
+def iter_subunit(report):
+    '''
+    Yield a dictionary with name, type, state, description and duration for
+    each test outcome of the subunit (v1) stream report (a file name or a file
+    object). Durations are computed from the time directives.
+    '''
+    report, close = _open(report)
+    try:
+        outcome = None
+        details = []
+        now = None
+        starts = {}
+        for line in report:
+            if outcome is not None:
+                if line.rstrip('\r\n') == ']':
+                    outcome['description'] = ''.join(details) or None
+                    yield outcome
+                    outcome, details = None, []
+                else:
+                    details.append(line)
+                continue
+            directive, _, rest = line.partition(':')
+            directive = directive.strip().lower()
+            rest = rest.strip()
+            if directive == 'time':
+                now = _parse_time(rest)
+                continue
+            elif directive in ('test', 'testing'):
+                starts[rest] = now
+                continue
+            elif directive not in SUBUNIT_STATES:
+                continue
+            has_details = rest.endswith('[') or rest.endswith('[ multipart')
+            if has_details:
+                name = rest.rsplit('[', 1)[0].strip()
+            else:
+                name = rest
+            result = {
+                'name': name,
+                'type': _result_type(name),
+                'state': SUBUNIT_STATES[directive],
+                'description': None,
+                'duration': None,
+                }
+            start = starts.pop(name, None)
+            if start and now:
+                result['duration'] = _total_seconds(now - start)
+            if has_details:
+                outcome = result
+            else:
+                yield result
+    finally:
+        if close:
+            report.close()
+
+
+def read_coverage(report):
+    '''
+    Return a tuple with coverage percentage, lines and covered lines of the
+    Cobertura XML report (as written by "coverage xml").
+
+    Only the root element is parsed.
+    '''
+    report, close = _open(report)
+    try:
+        for _, elem in ElementTree.iterparse(report, events=('start',)):
+            lines = int(elem.get('lines-valid', 0))
+            covered_lines = int(elem.get('lines-covered', 0))
+            if lines:
+                coverage = round(covered_lines * 100.0 / lines, 2)
+            else:
+                coverage = round(float(elem.get('line-rate', 0)) * 100, 2)
+            return coverage, lines, covered_lines
+    finally:
+        if close:
+            report.close()
+
+
+def iter_coverage_files(report):
+    '''
+    Yield the file name, the statement lines and the missing lines of each
+    file of the Cobertura XML report (as written by "coverage xml").
+    '''
+    report, close = _open(report)
+    try:
+        parents = []
+        filename, statements, missing = None, [], []
+        for event, elem in ElementTree.iterparse(report,
+                events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                if elem.tag == 'class' and elem.get('filename') != filename:
+                    if filename is not None:
+                        yield filename, statements, missing
+                    filename, statements, missing = (elem.get('filename'),
+                        [], [])
+                continue
+            parents.pop()
+            # Lines of methods are also listed by their class
+            if (elem.tag == 'line' and filename is not None
+                    and not any(p.tag == 'method' for p in parents)):
+                number = int(elem.get('number'))
+                statements.append(number)
+                if not int(elem.get('hits', 0)):
+                    missing.append(number)
+            if elem.tag in ('line', 'class'):
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+        if filename is not None:
+            yield filename, statements, missing
+    finally:
+        if close:
+            report.close()
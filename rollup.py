@@ -0,0 +1,254 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+
+from sql import Null
+from sql.aggregate import Count
+from sql.conditionals import Case, Coalesce
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+from .test import RESULT_TYPES
+
+__all__ = ['TestRollup']
+
+# Number of builds added to the roll-up by transaction
+ROLLUP_BATCH_SIZE = 1000
+
+
+def _total():
+    return {
+        'passed': 0,
+        'failed': 0,
+        'errors': 0,
+        'builds': set(),
+        'coverages': {},
+        }
+
+
+class TestRollup(ModelSQL, ModelView):
+    'Test Daily Roll-up'
+    __name__ = 'project.test.rollup'
+
+    day = fields.Date('Day', required=True, readonly=True, select=True)
+    component = fields.Many2One('project.work.component', 'Component',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    type = fields.Selection(RESULT_TYPES, 'Type', required=True,
+        readonly=True)
+    passed = fields.Integer('Passed', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+    errors = fields.Integer('Errors', readonly=True)
+    builds = fields.Integer('Builds', readonly=True)
+    min_coverage = fields.Float('Minimum Coverage', digits=(16, 2),
+        readonly=True)
+    average_coverage = fields.Float('Average Coverage', digits=(16, 2),
+        readonly=True)
+    coverage_sum = fields.Float('Coverage Sum', readonly=True)
+    coverage_builds = fields.Integer('Coverage Builds', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TestRollup, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('day_component_type_uniq', Unique(t, t.day, t.component, t.type),
+                'The roll-up of a day must be unique by component and type.'),
+            ]
+        cls._order.insert(0, ('day', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        exist = TableHandler.table_exist(cls._table)
+
+        super(TestRollup, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['component', 'day', 'type'], 'add')
+
+        if not exist:
+            cls.backfill()
+
+    @classmethod
+    def add_builds(cls, builds):
+        '''
+        Add the results and the coverage of finished builds to the roll-up of
+        the day of their execution. Builds already added are skipped.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        Result = pool.get('project.test.build.result')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+        result = Result.__table__()
+
+        for sub_builds in grouped_slice(builds):
+            sub_ids = cls._claim([b.id for b in sub_builds])
+            if not sub_ids:
+                continue
+            cursor.execute(*build.select(build.id, build.execution,
+                    build.create_date, build.component, build.coverage,
+                    Coalesce(build.cache_build, build.id),
+                    where=reduce_ids(build.id, sub_ids)))
+            infos = {}
+            sources = {}
+            for (build_id, execution, create_date, component, coverage,
+                    source) in cursor.fetchall():
+                day = (execution or create_date).date()
+                infos[build_id] = (day, component, coverage)
+                sources.setdefault(source, []).append(build_id)
+
+            totals = {}
+            counted = set()
+            cursor.execute(*result.select(result.build, result.type,
+                    result.state, Count(result.id),
+                    where=reduce_ids(result.build, list(sources)),
+                    group_by=[result.build, result.type, result.state]))
+            for source, type_, state, count in cursor.fetchall():
+                for build_id in sources[source]:
+                    day, component, coverage = infos[build_id]
+                    total = totals.setdefault((day, component, type_),
+                        _total())
+                    if state == 'pass':
+                        total['passed'] += count
+                    elif state == 'fail':
+                        total['failed'] += count
+                    elif state == 'error':
+                        total['errors'] += count
+                    total['builds'].add(build_id)
+                    counted.add(build_id)
+                    if coverage is not None:
+                        total['coverages'][build_id] = coverage
+            # Builds without results are counted with the unit tests
+            for build_id in set(infos) - counted:
+                day, component, coverage = infos[build_id]
+                total = totals.setdefault((day, component, 'unittest'),
+                    _total())
+                total['builds'].add(build_id)
+                if coverage is not None:
+                    total['coverages'][build_id] = coverage
+
+            for (day, component, type_), total in totals.iteritems():
+                cls._add(day, component, type_, total)
+
+    @classmethod
+    def _claim(cls, build_ids):
+        '''
+        Mark the builds of build_ids not yet added to the roll-up as added and
+        return their ids, so concurrent transactions never add a build twice
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+
+        not_rolled_up = build.rolled_up == False
+        if backend.name() == 'postgresql':
+            cursor.execute(*build.update([build.rolled_up], [True],
+                    where=reduce_ids(build.id, build_ids) & not_rolled_up,
+                    returning=[build.id]))
+            return [i for i, in cursor.fetchall()]
+        claimed = []
+        for build_id in build_ids:
+            cursor.execute(*build.update([build.rolled_up], [True],
+                    where=(build.id == build_id) & not_rolled_up))
+            if cursor.rowcount:
+                claimed.append(build_id)
+        return claimed
+
+    @classmethod
+    def _add(cls, day, component, type_, total):
+        '''
+        Increment the roll-up of the day, component and type by total,
+        creating it if it does not exist yet
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        coverages = total['coverages'].values()
+        increments = [
+            (table.passed, total['passed']),
+            (table.failed, total['failed']),
+            (table.errors, total['errors']),
+            (table.builds, len(total['builds'])),
+            ]
+        if coverages:
+            increments += [
+                (table.coverage_sum, sum(coverages)),
+                (table.coverage_builds, len(coverages)),
+                ]
+        columns = [c for c, _ in increments]
+        values = [Coalesce(c, 0) + v for c, v in increments]
+        if coverages:
+            min_coverage = min(coverages)
+            columns += [table.min_coverage, table.average_coverage]
+            # The values are computed from the columns before the update
+            values += [
+                Case(((table.min_coverage != Null)
+                        & (table.min_coverage < min_coverage),
+                        table.min_coverage),
+                    else_=min_coverage),
+                ((Coalesce(table.coverage_sum, 0) + sum(coverages))
+                    / (Coalesce(table.coverage_builds, 0) + len(coverages))),
+                ]
+        cursor.execute(*table.update(columns, values,
+                where=(table.day == day) & (table.component == component)
+                & (table.type == type_)))
+        if cursor.rowcount:
+            return
+
+        min_coverage = min(coverages) if coverages else None
+        average_coverage = (sum(coverages) / len(coverages)
+            if coverages else None)
+        cursor.execute(*table.insert([table.create_uid, table.create_date,
+                    table.day, table.component, table.type, table.passed,
+                    table.failed, table.errors, table.builds,
+                    table.min_coverage, table.average_coverage,
+                    table.coverage_sum, table.coverage_builds],
+                [[Transaction().user, datetime.datetime.now(), day,
+                        component, type_, total['passed'], total['failed'],
+                        total['errors'], len(total['builds']), min_coverage,
+                        average_coverage, sum(coverages), len(coverages)]]))
+
+    @classmethod
+    def backfill(cls):
+        '''
+        Empty the roll-up so roll_up_builds rebuilds it from all the finished
+        builds
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        build = Build.__table__()
+
+        cursor.execute(*table.delete())
+        cursor.execute(*build.update([build.rolled_up], [False],
+                where=build.rolled_up == True))
+
+    @classmethod
+    def roll_up_builds(cls, batch_size=ROLLUP_BATCH_SIZE):
+        '''
+        Add the finished builds missing from the roll-up by batches of at
+        most batch_size builds, committing after each batch
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        build = Build.__table__()
+
+        while True:
+            cursor.execute(*build.select(build.id,
+                    where=(build.finished == True)
+                    & (build.rolled_up == False),
+                    order_by=build.id.asc, limit=batch_size))
+            build_ids = [i for i, in cursor.fetchall()]
+            if not build_ids:
+                break
+            cls.add_builds(Build.browse(build_ids))
+            transaction.commit()
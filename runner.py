@@ -0,0 +1,126 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Parallel execution of builds'
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+
+from .template import TemplatePool
+
+__all__ = ['Runner', 'clean_task']
+
+logger = logging.getLogger(__name__)
+
+# Command run by the current worker process
+_process = None
+
+
+def _terminate(signum, frame):
+    if _process is not None and _process.poll() is None:
+        os.killpg(_process.pid, signal.SIGKILL)
+    os._exit(1)
+
+
+def _init_worker():
+    signal.signal(signal.SIGTERM, _terminate)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_task(task):
+    '''
+    Run the commands of task in a worker process and return the build id,
+    the shard and the return code of the last command run.
+
+    task is a dictionary with build, shard (the index of the part of the
+    tests run by the task or None), directory, commands (a list of command
+    and working directory), env, files (to write in directory before
+    running the commands which use it) and database (the name of the
+    PostgreSQL database of the build or None).
+    It may have a template, the specification of the template database to
+    clone before running the command at index template['before'].
+    '''
+    global _process
+    directory = task['directory']
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    parent = os.path.dirname(directory)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    env = os.environ.copy()
+    env.update(task['env'])
+    returncode = 0
+    template = task.get('template')
+    with open(directory + '.log', 'ab') as log:
+        for i, (command, cwd) in enumerate(task['commands']):
+            if cwd == directory:
+                for name, content in task['files'].iteritems():
+                    with open(os.path.join(directory, name), 'wb') as file_:
+                        file_.write(content)
+            if template and i == template['before']:
+                try:
+                    env = TemplatePool(template['path']).clone(
+                        template, env, log) or env
+                except (OSError, subprocess.CalledProcessError):
+                    logger.exception('Could not clone template database')
+            # Run in its own process group to be able to kill its children
+            _process = subprocess.Popen(command, shell=True, cwd=cwd,
+                env=env, stdout=log, stderr=subprocess.STDOUT,
+                preexec_fn=os.setsid)
+            returncode = _process.wait()
+            _process = None
+            if returncode:
+                break
+    return task['build'], task['shard'], returncode
+
+
+def clean_task(task):
+    'Drop the database of task and remove its working copy, keeping its log'
+    directory = task['directory']
+    if task.get('database'):
+        env = os.environ.copy()
+        env.update(task['env'])
+        with open(directory + '.log', 'ab') as log:
+            subprocess.call(['dropdb', '--if-exists', task['database']],
+                env=env, stdout=log, stderr=subprocess.STDOUT)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class Runner(object):
+    'Run tasks in a bounded pool of processes'
+
+    def __init__(self, workers=None, failfast=False):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.failfast = failfast
+
+    def run(self, tasks, callback):
+        '''
+        Run tasks calling callback with the build id, the shard and the return
+        code as soon as each one finishes. If failfast is set, pending and
+        running tasks are cancelled when callback returns False.
+
+        Returns False if the run was cancelled.
+        '''
+        if not tasks:
+            return True
+        pool = multiprocessing.Pool(min(self.workers, len(tasks)),
+            _init_worker)
+        try:
+            for build_id, shard, returncode in pool.imap_unordered(run_task,
+                    tasks):
+                if (not callback(build_id, shard, returncode)
+                        and self.failfast):
+                    logger.info('Build %s failed, cancelling the others',
+                        build_id)
+                    pool.terminate()
+                    return False
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return True
@@ -45,7 +45,7 @@ for dep in info.get('depends', []):
                 major_version, minor_version + 1))
 requires.append(get_require_version('trytond'))
 
-tests_require = [get_require_version('proteus')]
+tests_require = [get_require_version('proteus'), 'mock']
 
 setup(name='%s_%s' % (PREFIX, MODULE),
     version=version,
@@ -0,0 +1,76 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Buffered streaming of results from test workers'
+import threading
+import time
+
+__all__ = ['ResultStream']
+
+# Number of buffered results which triggers a flush
+STREAM_BATCH_SIZE = 100
+# Number of seconds after which buffered results are flushed
+STREAM_INTERVAL = 5
+
+
+class ResultStream(object):
+    '''
+    Buffer the results pushed by a test worker and send them by batches.
+
+    push is called with the list of buffered results, typically the
+    push_results RPC of project.test.build bound to the build id found in
+    the TEST_BUILD environment variable. The buffer is flushed as soon as it
+    holds size results or when a result is added interval seconds after the
+    previous flush, and when the stream is closed. A timer, created by
+    calling timer with the interval and the function to call like
+    threading.Timer, flushes the results buffered for interval seconds, so a
+    slow test does not hold the results of the previous ones.
+    '''
+
+    def __init__(self, push, size=STREAM_BATCH_SIZE,
+            interval=STREAM_INTERVAL, clock=time.time, timer=threading.Timer):
+        self.push = push
+        self.size = size
+        self.interval = interval
+        self.clock = clock
+        self.timer_class = timer
+        self.buffer = []
+        self.last_flush = clock()
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def add(self, name, state, type_='unittest', description=None,
+            duration=None):
+        with self.lock:
+            self.buffer.append({
+                    'name': name,
+                    'type': type_,
+                    'state': state,
+                    'description': description,
+                    'duration': duration,
+                    })
+            if (len(self.buffer) >= self.size
+                    or self.clock() - self.last_flush >= self.interval):
+                self.flush()
+            elif self.timer is None:
+                self.timer = self.timer_class(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.buffer:
+                self.push(self.buffer)
+                self.buffer = []
+            self.last_flush = self.clock()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
@@ -0,0 +1,154 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'Pool of template databases with the dependencies of builds installed'
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+
+__all__ = ['template_key', 'TemplatePool']
+
+logger = logging.getLogger(__name__)
+
+# Number of days after which unused templates are dropped
+TEMPLATE_MAX_AGE = 7
+
+
+def template_key(components, dependencies, db_type):
+    '''
+    Return the key of the template database for the set of components, the
+    revision of their dependencies and db_type.
+    The revision of the components is not part of the key as templates only
+    have their dependencies installed.
+    '''
+    value = json.dumps([sorted(components), dependencies, db_type])
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class TemplatePool(object):
+    '''
+    Template databases stored in path, each one described by a JSON file
+    named by its key.
+
+    SQLite templates are database files copied for each build and
+    PostgreSQL templates are databases cloned with createdb --template.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @contextmanager
+    def _lock(self, key):
+        with open(os.path.join(self.path, key + '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def clone(self, spec, env, log):
+        '''
+        Clone the template database of spec into the database of the build,
+        creating the template first if needed, and return the environment
+        to run the tests with it, or None if no template could be created.
+
+        spec is a dictionary with components, db_type, directory (the
+        working copy), database (the name of the build database),
+        template_command (run in the working copy to install the
+        dependencies of the modules in the database named by DB_NAME) and
+        dependencies_command (run in the working copy to print the list and
+        the revision of the dependencies).
+        '''
+        dependencies = ''
+        if spec['dependencies_command']:
+            dependencies = subprocess.check_output(
+                spec['dependencies_command'], shell=True,
+                cwd=spec['directory'], env=env).decode('utf-8').strip()
+        key = template_key(spec['components'], dependencies, spec['db_type'])
+        with self._lock(key):
+            entry = self._entry(key)
+            if not os.path.exists(entry):
+                if not self._create(key, spec, env, log):
+                    return None
+            with open(entry) as file_:
+                name = json.load(file_)['name']
+            os.utime(entry, None)
+            env = env.copy()
+            start = time.time()
+            if spec['db_type'] == 'sqlite':
+                shutil.copyfile(name, os.path.join(spec['directory'],
+                        spec['database'] + '.sqlite'))
+            else:
+                subprocess.check_call(['createdb', '--template', name,
+                        spec['database']], env=env, stdout=log,
+                    stderr=subprocess.STDOUT)
+            logger.info('Cloned template %s in %.2fs', key,
+                time.time() - start)
+            env['DB_NAME'] = spec['database']
+        self.prune()
+        return env
+
+    def _create(self, key, spec, env, log):
+        env = env.copy()
+        if spec['db_type'] == 'sqlite':
+            # The template is installed in the working copy then moved
+            env['DB_NAME'] = 'template'
+            name = os.path.join(self.path, key + '.sqlite')
+        else:
+            name = env['DB_NAME'] = 'template_%s' % key[:20]
+        logger.info('Creating template %s', key)
+        returncode = subprocess.call(spec['template_command'], shell=True,
+            cwd=spec['directory'], env=env, stdout=log,
+            stderr=subprocess.STDOUT)
+        if returncode:
+            logger.warning('Template %s creation failed', key)
+            return False
+        if spec['db_type'] == 'sqlite':
+            shutil.move(os.path.join(spec['directory'], 'template.sqlite'),
+                name)
+        with open(self._entry(key), 'w') as file_:
+            json.dump({
+                    'name': name,
+                    'db_type': spec['db_type'],
+                    'components': spec['components'],
+                    }, file_)
+        return True
+
+    def _drop(self, key):
+        entry = self._entry(key)
+        with open(entry) as file_:
+            values = json.load(file_)
+        if values['db_type'] == 'sqlite':
+            if os.path.exists(values['name']):
+                os.remove(values['name'])
+        else:
+            subprocess.call(['dropdb', '--if-exists', values['name']])
+        os.remove(entry)
+        logger.info('Dropped template %s', key)
+
+    def prune(self, max_age=TEMPLATE_MAX_AGE):
+        'Drop the templates unused for max_age days or all if None'
+        if max_age is not None:
+            limit = time.time() - max_age * 24 * 60 * 60
+        for entry in glob.glob(os.path.join(self.path, '*.json')):
+            if max_age is not None and os.path.getmtime(entry) >= limit:
+                continue
+            key = os.path.basename(entry)[:-len('.json')]
+            with self._lock(key):
+                if os.path.exists(entry):
+                    self._drop(key)
+
+    def invalidate(self):
+        'Drop all the templates'
+        self.prune(max_age=None)
@@ -1,19 +1,260 @@
 #This file is part of Tryton.  The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
-from sql import Literal
+from sql import Literal, Null, Table
+from sql.functions import CurrentTimestamp
 from sql.conditionals import Case, Coalesce
-from sql.aggregate import Min, Max
+from sql.aggregate import Count, Min, Max, Sum
+from sql.operators import Exists
 import datetime
+import logging
+import os
+import pipes
+import subprocess
+import time
+import zlib
+from io import BytesIO
+from itertools import islice
 from dateutil.relativedelta import relativedelta
-from trytond.model import ModelView, ModelSQL, fields
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, Unique, fields
 from trytond.pool import Pool, PoolMeta
-from trytond.tools import reduce_ids
+from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
+from .archive import ArchiveWriter
+from .export import EXPORT_FORMATS, server_cursor
+from .failure import fingerprint
+from .impact import diff_changes
+from .partition import partitioned, week_start, partition_table, \
+    create_partitions, week_partitions, drop_partition
+from .planner import lpt_shards, priority_order
+from .profiling import profiler
+from .runner import Runner, clean_task
+from .report import iter_junit, iter_subunit, read_coverage, \
+    iter_coverage_files
 
 
-__all__ = ['TestBuildGroup', 'TestBuild', 'TestBuildResult', 'Component']
+__all__ = ['TestBuildGroup', 'TestBuild', 'TestCase', 'TestBuildResult',
+    'Component']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+STATES = [
+    ('pass', 'Pass'),
+    ('fail', 'Fail'),
+    ('error', 'Error'),
+    ]
+RESULT_TYPES = [
+    ('unittest', 'Unittest'),
+    ('scenario', 'Scenario'),
+    ('flake', 'Flake'),
+    ('pep8', 'PEP8'),
+    ('coverage', 'Coverage')
+    ]
+COVERAGE_STATES = [
+    ('ok', 'Ok'),
+    ('acceptable', 'Acceptable'),
+    ('to_improve', 'To Improve'),
+    ('error', 'Error'),
+    ]
+# States ordered from worst to best, the aggregated state of a build or a
+# group is the worst state of its members
+STATE_ORDER = ['error', 'fail', 'pass']
+COVERAGE_STATE_ORDER = ['error', 'to_improve', 'acceptable', 'ok']
+TEST_TYPES = ['unittest', 'scenario']
+FLAKE_TYPES = ['flake', 'pep8']
+# Number of results inserted by statement on bulk imports
+BATCH_SIZE = 5000
+# Maximum number of results by chunk of exports
+EXPORT_LIMIT = 10000
+# Number of builds deleted by transaction when deleting old builds
+DELETE_BATCH_SIZE = 100
+# Build fields stored in archives
+ARCHIVE_BUILD_FIELDS = ['execution', 'component', 'review', 'branch',
+    'revision', 'coverage', 'lines', 'covered_lines']
+ARCHIVE_RESULT_FIELDS = ['name', 'type', 'state', 'description',
+    'duration']
+# Weight of a new rerun in the flakiness score of a test case
+FLAKY_ALPHA = 0.3
+# Score from which a test case is considered flaky
+FLAKY_THRESHOLD = 0.25
+# Weight of a new duration in the average duration of a test case
+DURATION_ALPHA = 0.2
+# Number of latest builds of a branch whose failures are run first
+RECENT_BUILDS = 10
+TEST_ORDERS = [
+    ('name', 'Name'),
+    ('failure_first', 'Failure First'),
+    ]
+REPORT_PARSERS = {
+    'junit': iter_junit,
+    'subunit': iter_subunit,
+    }
+
+
+def worst_state(states, order=STATE_ORDER):
+    'Return the worst of states according to order'
+    rank = min(order.index(s) if s in order else len(order) - 1
+        for s in states)
+    return order[rank]
+
+
+def _state_rank(column, order):
+    return Case(*[(column == Literal(s), i) for i, s in enumerate(order[:-1])],
+        else_=len(order) - 1)
+
+
+def _rank_state(rank, order):
+    return Case(*[(rank == Literal(i), s) for i, s in enumerate(order[:-1])],
+        else_=order[-1])
+
+
+def _coverage_state(coverage):
+    return Case((coverage < Literal(50), 'error'),
+        (coverage < Literal(60), 'to_improve'),
+        (coverage < Literal(70), 'acceptable'),
+        else_='ok')
+
+
+def coverage_state(coverage):
+    'Return the coverage state of a coverage percentage'
+    if coverage is None or coverage >= 70:
+        return 'ok'
+    elif coverage >= 60:
+        return 'acceptable'
+    elif coverage >= 50:
+        return 'to_improve'
+    return 'error'
+
+
+def batches(iterable, size=BATCH_SIZE):
+    'Yield lists of at most size items of iterable'
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _parse_datetime(value):
+    if not value:
+        return None
+    for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, format_)
+        except ValueError:
+            continue
+    raise ValueError(value)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def bulk_insert(table, columns, rows):
+    '''
+    Insert rows into table, using COPY on PostgreSQL and a single prepared
+    statement executed for all the rows on other backends
+    '''
+    cursor = Transaction().connection.cursor()
+    if backend.name() == 'postgresql':
+        data = BytesIO()
+        for row in rows:
+            line = u'\t'.join(_copy_value(v) for v in row)
+            data.write(line.encode('utf-8'))
+            data.write(b'\n')
+        data.seek(0)
+        cursor.copy_from(data, table._name, columns=columns)
+    else:
+        query = table.insert([getattr(table, c) for c in columns],
+            [[''] * len(columns)])
+        cursor.executemany(str(query), rows)
+
+
+def ignore_flaky():
+    'Return if flaky results must not change the state of builds'
+    return config.getboolean('project_unittest', 'ignore_flaky',
+        default=False)
+
+
+def update_rows(table, names, rows):
+    '''
+    Update the columns names of table with rows, a list of tuples with the
+    values of names followed by the record id, executing the same statement
+    for all the rows
+    '''
+    cursor = Transaction().connection.cursor()
+    query = table.update([getattr(table, n) for n in names],
+        [''] * len(names), where=table.id == 0)
+    for batch in batches(rows):
+        cursor.executemany(str(query), batch)
+
+
+def _result_rank(result, types):
+    condition = result.type.in_(types)
+    if ignore_flaky():
+        condition &= (result.flaky == False)
+    return Min(Case(
+            (condition, _state_rank(result.state, STATE_ORDER)),
+            else_=len(STATE_ORDER) - 1))
+
+
+def _test_count(result, states=None):
+    condition = result.type.in_(TEST_TYPES)
+    if states:
+        condition &= result.state.in_(states)
+    return Sum(Case((condition, 1), else_=0))
+
+
+def _state_count(result, states):
+    return Sum(Case((result.state.in_(states), 1), else_=0))
+
+
+def add_counters(table, counts, names):
+    '''
+    Increment the columns names of table by counts, a dictionary of record id
+    and a tuple with the increments of names, grouping the updates of records
+    sharing the same increments
+    '''
+    cursor = Transaction().connection.cursor()
+    ids_by_values = {}
+    for id_, values in counts.iteritems():
+        ids_by_values.setdefault(tuple(values), []).append(id_)
+    columns = [getattr(table, n) for n in names]
+    for values, ids in ids_by_values.iteritems():
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(columns,
+                    [Coalesce(c, 0) + v for c, v in zip(columns, values)],
+                    where=reduce_ids(table.id, sub_ids)))
+
+
+def write_states(table, states, names):
+    '''
+    Store states, a dictionary of record id and a tuple with the values of
+    names, grouping the updates of records sharing the same values
+    '''
+    cursor = Transaction().connection.cursor()
+    ids_by_values = {}
+    for id_, values in states.iteritems():
+        ids_by_values.setdefault(tuple(values), []).append(id_)
+    columns = [getattr(table, n) for n in names]
+    for values, ids in ids_by_values.iteritems():
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(columns, list(values),
+                    where=reduce_ids(table.id, sub_ids)))
+
 
 class TestBuildGroup(ModelSQL, ModelView):
     'Test Build Group'
@@ -30,147 +271,636 @@ class TestBuildGroup(ModelSQL, ModelView):
             ], 'db_type', required=True, readonly=True, select=True)
 
     failfast = fields.Boolean('Fail Fast', readonly=True)
+    bypass_cache = fields.Boolean('Bypass Cache', readonly=True,
+        help='Run all the builds even if their revision was already built.')
     reviews = fields.Boolean('Include Reviews', readonly=True)
     development = fields.Boolean('Development', readonly=True)
-    work = fields.Many2One('project.work', 'Task')
-    test_state = fields.Function(fields.Selection([
-            ('pass', 'Pass'),
-            ('fail', 'Fail'),
-            ('error', 'Error'),
-            ], 'Test State', select=True),
-        'get_state', searcher='search_state')
-    flake_state = fields.Function(fields.Selection([
-            ('pass', 'Pass'),
-            ('fail', 'Fail'),
-            ('error', 'Error'),
-            ], 'Flake State', select=True),
-        'get_state', searcher='search_state')
-    coverage_state = fields.Function(fields.Selection([
-            ('ok', 'Ok'),
-            ('acceptable', 'Acceptable'),
-            ('to_improve', 'To Improve'),
-            ('error', 'Error'),
-            ], 'Coverage State', select=True),
-        'get_state', searcher='search_coverage_state')
+    work = fields.Many2One('project.work', 'Task', select=True)
+    test_state = fields.Selection(STATES, 'Test State', readonly=True,
+        select=True)
+    flake_state = fields.Selection(STATES, 'Flake State', readonly=True,
+        select=True)
+    coverage_state = fields.Selection(COVERAGE_STATES, 'Coverage State',
+        readonly=True, select=True)
+    archived = fields.Boolean('Archived', readonly=True, select=True)
+    queued = fields.Boolean('Queued', readonly=True, select=True,
+        help='The builds are waiting to be run by the scheduler.')
+    archives = fields.One2Many('project.test.build.archive', 'group',
+        'Archives', readonly=True)
+    expected_tests = fields.Integer('Expected Tests', readonly=True)
+    done_tests = fields.Integer('Done Tests', readonly=True)
+    failed_tests = fields.Integer('Failed Tests', readonly=True)
+    progress = fields.Function(fields.Float('Progress', digits=(16, 2)),
+        'get_progress')
+    shards = fields.Integer('Shards', required=True, readonly=True,
+        domain=[('shards', '>=', 1)],
+        help='Number of tasks run in parallel for each build, each one '
+        'running a part of the tests of similar duration.\n'
+        'The test command must run only the tests listed in {order}.')
+    test_order = fields.Selection(TEST_ORDERS, 'Test Order', required=True,
+        readonly=True, help='The order in which the tests of builds are run.\n'
+        'Failure First runs first the tests which failed in the latest builds '
+        'of the branch, then the tests affected by the changes and the new '
+        'tests.')
+    _priority_cache = Cache('project.test.build.group.priority_tests',
+        context=False)
 
     @classmethod
-    def get_state(cls, groups, names):
+    def __setup__(cls):
+        super(TestBuildGroup, cls).__setup__()
+        cls.__rpc__.update({
+                'plan_shards': RPC(),
+                'order_tests': RPC(),
+                'export_results': RPC(instantiate=0),
+                'queue_builds': RPC(readonly=False, instantiate=0),
+                })
+        cls._buttons.update({
+                'update_state': {
+                    'invisible': Eval('archived', False),
+                    },
+                'queue_builds': {
+                    'invisible': (Eval('archived', False)
+                        | Eval('queued', False)),
+                    },
+                'restore': {
+                    'invisible': ~Eval('archived', False),
+                    },
+                })
+
+    @staticmethod
+    def default_archived():
+        return False
+
+    @staticmethod
+    def default_queued():
+        return False
+
+    @staticmethod
+    def default_shards():
+        return 1
+
+    @staticmethod
+    def default_test_state():
+        return 'pass'
+
+    @staticmethod
+    def default_flake_state():
+        return 'pass'
+
+    @staticmethod
+    def default_coverage_state():
+        return 'ok'
+
+    @staticmethod
+    def default_expected_tests():
+        return 0
+
+    @staticmethod
+    def default_test_order():
+        return 'failure_first'
+
+    @staticmethod
+    def default_done_tests():
+        return 0
+
+    @staticmethod
+    def default_failed_tests():
+        return 0
+
+    def get_progress(self, name):
+        if not self.expected_tests:
+            return None
+        return min(100.0, 100.0 * (self.done_tests or 0)
+            / self.expected_tests)
+
+    @classmethod
+    @ModelView.button
+    def update_state(cls, groups):
+        'Recompute the stored states of groups and their builds from results'
         pool = Pool()
         Build = pool.get('project.test.build')
-        Result = pool.get('project.test.build.result')
+        build = Build.__table__()
         cursor = Transaction().connection.cursor()
-        in_max = cursor.IN_MAX
 
-        group_ids = [g.id for g in groups]
-        test_state = {}.fromkeys(group_ids, 'pass')
-        flake_state = {}.fromkeys(group_ids, 'pass')
-        coverage_state = {}.fromkeys(group_ids, 'ok')
+        build_ids = []
+        for sub_groups in grouped_slice(groups):
+            cursor.execute(*build.select(build.id,
+                    where=reduce_ids(build.group, [g.id for g in sub_groups])))
+            build_ids.extend(i for i, in cursor.fetchall())
+        Build.refresh_state(Build.browse(build_ids))
+        cls.refresh_state(groups)
 
-        build = Build.__table__()
-        table = Result.__table__()
-        coverage = Case((Min(build.coverage) < Literal(50), 'error'),
-                        (Min(build.coverage) < Literal(60), 'to_improve'),
-                        (Min(build.coverage) < Literal(70), 'acceptable'),
-                        else_='ok')
-        # TODO: Replace with grouped_slice
-        for i in range(0, len(group_ids), in_max):
-            sub_ids = group_ids[i:i + in_max]
-            red_sql = reduce_ids(build.group, sub_ids)
-            if 'coverage_state' in names:
-                coverage_query = build.select(build.group, coverage,
-                    group_by=(build.group), where=red_sql)
-                cursor.execute(*coverage_query)
-                coverage_state.update(dict(cursor.fetchall()))
-            for name in ('test_state', 'flake_state'):
-                if name not in names:
-                    continue
-
-                if name == 'test_state':
-                    types = ['unittest', 'scenario']
-                else:
-                    types = ['flake', 'pep8']
-                numeric_state = Min(Case((table.state == Literal('error'), 0),
-                        (table.state == Literal('fail'), 1),
-                        else_=2))
-                state = Case((numeric_state == Literal(0), 'error'),
-                    (numeric_state == Literal(1), 'fail'),
-                    else_='pass')
-                query = build.join(table, condition=(
-                        (build.id == table.build) &
-                        table.type.in_(types))).select(build.group, state,
-                            group_by=build.group)
+    @classmethod
+    def refresh_state(cls, groups):
+        '''
+        Recompute the stored states and test counters of groups from those of
+        its builds
+        '''
+        with profiler(cls.__name__, 'refresh_state', len(groups)):
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            build = Build.__table__()
+
+            names = ('test_state', 'flake_state', 'coverage_state')
+            counter_names = ('expected_tests', 'done_tests', 'failed_tests')
+            for sub_groups in grouped_slice(groups):
+                sub_ids = [g.id for g in sub_groups]
+                states = {}.fromkeys(sub_ids, ('pass', 'pass', 'ok'))
+                counters = {}.fromkeys(sub_ids, (0, 0, 0))
+                query = build.select(build.group,
+                    _rank_state(Min(_state_rank(build.test_state,
+                                STATE_ORDER)), STATE_ORDER),
+                    _rank_state(Min(_state_rank(build.flake_state,
+                                STATE_ORDER)), STATE_ORDER),
+                    _rank_state(Min(_state_rank(build.coverage_state,
+                                COVERAGE_STATE_ORDER)), COVERAGE_STATE_ORDER),
+                    Sum(Coalesce(build.expected_tests, 0)),
+                    Sum(Coalesce(build.done_tests, 0)),
+                    Sum(Coalesce(build.failed_tests, 0)),
+                    where=reduce_ids(build.group, sub_ids),
+                    group_by=build.group)
                 cursor.execute(*query)
-                if name == 'test_state':
-                    test_state.update(dict(cursor.fetchall()))
-                else:
-                    flake_state.update(dict(cursor.fetchall()))
+                for row in cursor.fetchall():
+                    states[row[0]] = row[1:4]
+                    counters[row[0]] = row[4:]
+                write_states(table, states, names)
+                update_rows(table, counter_names,
+                    [tuple(v) + (k,) for k, v in counters.iteritems()])
+            cls.update_works([g.id for g in groups])
 
-        result = {
-            'coverage_state': coverage_state,
-            'flake_state': flake_state,
-            'test_state': test_state
-        }
+    @classmethod
+    def update_works(cls, group_ids):
+        'Update the test summary of the tasks of groups'
+        pool = Pool()
+        Work = pool.get('project.work')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
 
-        for key in result.keys():
-            if key not in names:
-                del result[key]
-        return result
+        work_ids = set()
+        for sub_ids in grouped_slice(group_ids):
+            cursor.execute(*table.select(table.work,
+                    where=reduce_ids(table.id, list(sub_ids))
+                    & (table.work != Null),
+                    group_by=table.work))
+            work_ids.update(i for i, in cursor.fetchall())
+        if work_ids:
+            Work.update_test_summary(Work.browse(list(work_ids)))
 
     @classmethod
-    def search_state(cls, name, clause):
+    def expiration_date(cls):
+        '''
+        Return the date before which ended groups expire according to the
+        retention of the configuration
+        '''
         pool = Pool()
+        Date = pool.get('ir.date')
+        Configuration = pool.get('project.test.configuration')
+        weeks = Configuration(1).retention_weeks
+        if weeks is None:
+            weeks = Configuration.default_retention_weeks()
+        date = Date.today() - relativedelta(weeks=weeks)
+        return datetime.datetime.combine(date, datetime.time(23, 59, 59))
+
+    @classmethod
+    def delete_old_builds(cls, date=None, batch_size=DELETE_BATCH_SIZE):
+        '''
+        Delete groups ended before date (the expiration date by default).
+        If the configuration archives builds, the groups are archived first.
+
+        Results, builds and groups are deleted with plain SQL by batches of
+        at most batch_size builds, committing after each batch, so the
+        deletion can be stopped and restarted at any time.
+        '''
+        pool = Pool()
+        Configuration = pool.get('project.test.configuration')
         Build = pool.get('project.test.build')
         Result = pool.get('project.test.build.result')
-        _, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
-        table = Result.__table__()
+        Component = pool.get('project.work.component')
+        Work = pool.get('project.work')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
         build = Build.__table__()
-        if name == 'test_state':
-            where = Coalesce(table.type, 'none').in_(['unittest', 'scenario',
-                    'none'])
-        elif name == 'flake_state':
-            where = Coalesce(table.type, 'none').in_(['flake', 'pep8', 'none'])
-        else:
-            raise Exception('Bad argument')
+        result = Result.__table__()
+
+        if date is None:
+            date = cls.expiration_date()
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime.combine(date, datetime.time(23, 59, 59))
+        if Configuration(1).archive_builds:
+            # Archived groups are kept
+            cls.archive_old_builds(date)
 
-        numeric_state = Min(Case((table.state == Literal('error'), 0),
-                (table.state == Literal('fail'), 1),
-                else_=2))
-        state = Case((numeric_state == Literal(0), 'error'),
-            (numeric_state == Literal(1), 'fail'),
-            else_='pass')
-        query = build.join(table, 'left', condition=(
-                (build.id == table.build) & where)).select(build.group,
-                    group_by=build.group, having=(Operator(state, value)))
-        return [('id', 'in', query)]
+        expired = table.select(table.id,
+            where=(table.end <= date) & (table.archived == False))
+        totals = {'results': 0, 'builds': 0, 'groups': 0}
+        if partitioned():
+            totals['results'] += Result.drop_partitions(date, expired)
+            transaction.commit()
+        while True:
+            start = time.time()
+            deleted = {'results': 0, 'builds': 0, 'groups': 0}
+            cursor.execute(*build.select(build.id, build.component,
+                    where=build.group.in_(expired),
+                    order_by=build.id.asc, limit=batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                build_ids = [r[0] for r in rows]
+                Build.release_cache(build_ids)
+                cursor.execute(*result.delete(
+                        where=reduce_ids(result.build, build_ids)))
+                deleted['results'] = cursor.rowcount
+                cursor.execute(*build.delete(
+                        where=reduce_ids(build.id, build_ids)))
+                deleted['builds'] = cursor.rowcount
+                Component.update_last_build(
+                    Component.browse(list({r[1] for r in rows})))
+            else:
+                # All builds of expired groups are deleted
+                cursor.execute(*table.select(table.id,
+                        where=(table.end <= date) & (table.archived == False),
+                        order_by=table.id.asc, limit=batch_size))
+                group_ids = [i for i, in cursor.fetchall()]
+                if not group_ids:
+                    break
+                cursor.execute(*table.select(table.work,
+                        where=reduce_ids(table.id, group_ids)
+                        & (table.work != Null),
+                        group_by=table.work))
+                work_ids = [i for i, in cursor.fetchall()]
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.id, group_ids)))
+                deleted['groups'] = cursor.rowcount
+                Work.update_test_summary(Work.browse(work_ids))
+            transaction.commit()
+            for key, value in deleted.iteritems():
+                totals[key] += value
+            logger.info('Deleted %s results, %s builds and %s groups in %.2fs',
+                deleted['results'], deleted['builds'], deleted['groups'],
+                time.time() - start)
+        return totals
 
     @classmethod
-    def search_coverage_state(cls, name, clause):
+    def plan_shards(cls, component, count):
+        '''
+        Split the tests of component into count shards of similar duration
+        based on the average duration of its test cases.
+
+        Returns a list of tuples with the expected duration and the test names
+        of each shard.
+        '''
+        pool = Pool()
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        case = TestCase.__table__()
+
+        cursor.execute(*case.select(case.name, case.average_duration,
+                where=(case.component == int(component))
+                & case.type.in_(TEST_TYPES)))
+        durations = dict(cursor.fetchall())
+        known = [d for d in durations.itervalues() if d is not None]
+        # Tests never timed are expected to last as the average test
+        default = sum(known) / len(known) if known else 1.0
+        for name, duration in durations.iteritems():
+            if duration is None:
+                durations[name] = default
+        return lpt_shards(durations, count)
+
+    @classmethod
+    def priority_tests(cls, component, branch):
+        '''
+        Return the names of the tests of component which failed in the latest
+        builds of branch, the most recent failures first, and the names of
+        the tests created since those builds.
+        The lists are cached until a build finishes.
+        '''
         pool = Pool()
         Build = pool.get('project.test.build')
-        _, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
-        table = Build.__table__()
-        coverage_state = Case((Min(table.coverage) < Literal(50), 'error'),
-                        (Min(table.coverage) < Literal(60), 'to_improve'),
-                        (Min(table.coverage) < Literal(70), 'acceptable'),
-                        else_='ok')
-        query = table.select(table.group,
-            group_by=(table.group),
-            having=(Operator(coverage_state, value)))
-        return [('id', 'in', query)]
+        Result = pool.get('project.test.build.result')
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+        result = Result.__table__()
+        case = TestCase.__table__()
+
+        key = (component, branch)
+        priorities = cls._priority_cache.get(key)
+        if priorities is not None:
+            return priorities
+
+        # Builds linked to a cached build have no results
+        cursor.execute(*build.select(build.id, build.execution,
+                where=(build.component == component)
+                & (build.branch == branch)
+                & (build.cache_build == Null)
+                & (build.execution != Null),
+                order_by=[build.execution.desc, build.id.desc],
+                limit=RECENT_BUILDS))
+        rows = cursor.fetchall()
+        failed, new = [], []
+        if rows:
+            where = reduce_ids(result.build, [r[0] for r in rows])
+            if partitioned():
+                where &= result.week >= week_start(rows[-1][1])
+            cursor.execute(*result.join(case,
+                    condition=result.case == case.id).select(case.name,
+                    where=where
+                    & result.type.in_(TEST_TYPES)
+                    & result.state.in_(['fail', 'error']),
+                    group_by=case.name,
+                    order_by=Max(result.id).desc))
+            failed = [n for n, in cursor.fetchall()]
+            cursor.execute(*case.select(case.name,
+                    where=(case.component == component)
+                    & case.type.in_(TEST_TYPES)
+                    & (case.create_date >= rows[-1][1]),
+                    order_by=case.create_date.desc))
+            new = [n for n, in cursor.fetchall()]
+        priorities = (failed, new)
+        cls._priority_cache.set(key, priorities)
+        return priorities
 
     @classmethod
-    def delete_old_builds(cls, date=None):
+    def order_tests(cls, component, branch, changes=None,
+            policy='failure_first'):
+        '''
+        Return the names of the tests of component in the order to run them
+        on branch following policy, one of TEST_ORDERS.
+
+        With failure_first, the tests which failed recently come first, then
+        the tests covering changes (a dictionary of file name and changed
+        line numbers) and the new tests, then the others by name.
+        '''
         pool = Pool()
-        Date = pool.get('ir.date')
+        TestCase = pool.get('project.test.case')
+        Impact = pool.get('project.test.impact')
+        cursor = Transaction().connection.cursor()
+        case = TestCase.__table__()
+
+        component = int(component)
+        cursor.execute(*case.select(case.name,
+                where=(case.component == component)
+                & case.type.in_(TEST_TYPES)))
+        names = [n for n, in cursor.fetchall()]
+        if policy != 'failure_first':
+            return priority_order(names)
+        failed, new = cls.priority_tests(component, branch)
+        affected = []
+        if changes:
+            affected, _ = Impact.select_tests(component, changes)
+        return priority_order(names, failed, affected, new)
+
+    @classmethod
+    def export_results(cls, groups, format_='junit', offset=0,
+            limit=EXPORT_LIMIT):
+        '''
+        Return the chunk of the results of the builds of groups exported in
+        format_ from offset and the offset of the next chunk,
+        see project.test.build export_results
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        builds = Build.search([
+                ('group', 'in', [g.id for g in groups]),
+                ], order=[('group', 'ASC'), ('id', 'ASC')])
+        return Build.export_results(builds, format_, offset=offset,
+            limit=limit)
+
+    @classmethod
+    @ModelView.button
+    def queue_builds(cls, groups):
+        'Queue the builds of groups to be run by the scheduler'
+        cls.write(groups, {
+                'queued': True,
+                })
+
+    @classmethod
+    def run_queued_builds(cls):
+        'Run the builds of the queued groups, the oldest first'
+        transaction = Transaction()
+        groups = cls.search([
+                ('queued', '=', True),
+                ], order=[('id', 'ASC')])
+        for group in groups:
+            cls.write([group], {
+                    'queued': False,
+                    })
+            transaction.commit()
+            cls.run_builds([group])
+
+    @classmethod
+    def run_builds(cls, groups):
+        '''
+        Run the builds of groups in parallel processes, each one (or each of
+        its shards) in its own working copy and database, importing the
+        results of each task as soon as it finishes.
+        The results of previous runs are deleted and the working copies and
+        databases are removed once imported.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        Configuration = pool.get('project.test.configuration')
+        transaction = Transaction()
+
+        configuration = Configuration(1)
+        for group in groups:
+            cls.write([group], {
+                    'start': datetime.datetime.now(),
+                    'end': None,
+                    })
+            Build.clear_results(list(group.builds))
+            Build.write(list(group.builds), {
+                    'execution': datetime.datetime.now(),
+                    })
+            transaction.commit()
+            to_run = list(group.builds)
+            if not group.bypass_cache:
+                to_run = Build.link_cache(to_run)
+                Build.finish([b for b in group.builds if b not in to_run])
+                transaction.commit()
+            tasks = {}
+            for build in to_run:
+                for task in build.get_tasks(configuration):
+                    tasks[(build.id, task['shard'])] = task
+            imported = dict.fromkeys((b.id for b in to_run), 0)
+
+            def done(build_id, shard, returncode):
+                task = tasks.pop((build_id, shard))
+                build = Build(build_id)
+                imported[build_id] += build.import_task(task, returncode,
+                    imported[build_id])
+                # A build is finished once all its shards are imported
+                if not any(k[0] == build_id for k in tasks):
+                    Build.finish([build])
+                transaction.commit()
+                clean_task(task)
+                build = Build(build_id)
+                return not returncode and build.test_state == 'pass'
+            runner = Runner(configuration.workers, group.failfast)
+            try:
+                runner.run(tasks.values(), done)
+            finally:
+                # Tasks cancelled by failfast
+                for task in tasks.values():
+                    clean_task(task)
+            cls.write([group], {
+                    'end': datetime.datetime.now(),
+                    })
+            transaction.commit()
+
+    @classmethod
+    def archive_old_builds(cls, date=None):
+        '''
+        Move builds and results of groups ended before date (the expiration
+        date by default) to compressed archive files.
+
+        Groups are kept with an index of their archived builds and can be
+        restored. Each group is committed once its archive is written.
+        '''
+        pool = Pool()
+        Archive = pool.get('project.test.build.archive')
+        Build = pool.get('project.test.build')
+        Result = pool.get('project.test.build.result')
+        TestCase = pool.get('project.test.case')
+        Failure = pool.get('project.test.failure')
+        Component = pool.get('project.work.component')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        build = Build.__table__()
+        result = Result.__table__()
+        case = TestCase.__table__()
+        failure = Failure.__table__()
+
         if date is None:
-            date = Date.today() - relativedelta(weeks=1)
-        if isinstance(date, datetime.date):
+            date = cls.expiration_date()
+        if not isinstance(date, datetime.datetime):
             date = datetime.datetime.combine(date, datetime.time(23, 59, 59))
-        to_delete = cls.search([('end', '<=', date)])
-        if to_delete:
-            cls.delete(to_delete)
+
+        groups = cls.search([
+                ('end', '<=', date),
+                ('archived', '=', False),
+                ], order=[('id', 'ASC')])
+        writer = ArchiveWriter()
+        try:
+            for group in groups:
+                cursor.execute(*build.select(build.id,
+                        *[getattr(build, f) for f in ARCHIVE_BUILD_FIELDS],
+                        where=build.group == group.id))
+                builds = [(r[0], dict(zip(ARCHIVE_BUILD_FIELDS, r[1:])))
+                    for r in cursor.fetchall()]
+                Build.release_cache([b[0] for b in builds])
+                archives = []
+                result_cursor = transaction.connection.cursor()
+                for build_id, values in builds:
+                    offset = writer.start()
+                    writer.write(values)
+                    result_cursor.execute(*result.join(case,
+                            condition=result.case == case.id).join(failure,
+                            'LEFT', condition=result.failure == failure.id
+                            ).select(
+                            case.name, result.type, result.state,
+                            failure.data, result.duration,
+                            where=result.build == build_id))
+                    count = 0
+                    for rows in iter(
+                            lambda: result_cursor.fetchmany(BATCH_SIZE), []):
+                        for row in rows:
+                            result_values = dict(
+                                zip(ARCHIVE_RESULT_FIELDS, row))
+                            data = result_values['description']
+                            if data:
+                                result_values['description'] = (
+                                    zlib.decompress(data).decode('utf-8'))
+                            writer.write(result_values)
+                        count += len(rows)
+                    archives.append({
+                            'group': group.id,
+                            'component': values['component'],
+                            'branch': values['branch'],
+                            'revision': values['revision'],
+                            'execution': values['execution'],
+                            'results': count,
+                            'filename': writer.filename,
+                            'offset': offset,
+                            'length': writer.end(),
+                            })
+                Archive.create(archives)
+                build_ids = [b[0] for b in builds]
+                for sub_ids in grouped_slice(build_ids):
+                    cursor.execute(*result.delete(
+                            where=reduce_ids(result.build, sub_ids)))
+                    cursor.execute(*build.delete(
+                            where=reduce_ids(build.id, sub_ids)))
+                Component.update_last_build(Component.browse(
+                        list({b[1]['component'] for b in builds})))
+                cursor.execute(*table.update([table.archived], [True],
+                        where=table.id == group.id))
+                transaction.commit()
+                logger.info('Archived group %s with %s builds', group.id,
+                    len(builds))
+        finally:
+            writer.close()
+
+    @classmethod
+    @ModelView.button
+    def restore(cls, groups):
+        'Restore the builds and results of archived groups'
+        pool = Pool()
+        Archive = pool.get('project.test.build.archive')
+        Build = pool.get('project.test.build')
+        Result = pool.get('project.test.build.result')
+
+        archives = Archive.search([
+                ('group', 'in', [g.id for g in groups]),
+                ])
+        for archive in archives:
+            values, results = archive.read_build()
+            values['group'] = archive.group.id
+            values['execution'] = _parse_datetime(values['execution'])
+            build, = Build.create([values])
+
+            def build_results():
+                for result in results:
+                    result['build'] = build.id
+                    yield result
+            Result.insert_results(build_results())
+        Archive.delete(archives)
+        cls.write(groups, {'archived': False})
+        cls.refresh_state(groups)
+
+    @classmethod
+    def create(cls, vlist):
+        groups = super(TestBuildGroup, cls).create(vlist)
+        cls.update_works([g.id for g in groups])
+        return groups
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Work = pool.get('project.work')
+        actions = iter(args)
+        works = set()
+        for groups, values in zip(actions, actions):
+            # Only ended groups are summarized
+            if 'work' in values or 'end' in values:
+                works.update(g.work for g in groups if g.work)
+                if values.get('work'):
+                    works.add(Work(values['work']))
+        super(TestBuildGroup, cls).write(*args)
+        if works:
+            Work.update_test_summary(list(works))
+
+    @classmethod
+    def delete(cls, groups):
+        pool = Pool()
+        Work = pool.get('project.work')
+        works = list({g.work for g in groups if g.work})
+        super(TestBuildGroup, cls).delete(groups)
+        if works:
+            Work.update_test_summary(works)
 
 
 class TestBuild(ModelSQL, ModelView):
@@ -192,127 +922,1033 @@ class TestBuild(ModelSQL, ModelView):
     lines = fields.Integer('Lines', readonly=True)
     covered_lines = fields.Integer('Covered Lines', readonly=True,
         required=True)
-    test_state = fields.Function(fields.Selection([
-            ('pass', 'Pass'),
-            ('fail', 'Fail'),
-            ('error', 'Error'),
-            ], 'Test State', select=True),
-        'get_state', searcher='search_state')
-    flake_state = fields.Function(fields.Selection([
-            ('pass', 'Pass'),
-            ('fail', 'Fail'),
-            ('error', 'Error'),
-            ], 'Flake State', select=True),
-        'get_state', searcher='search_state')
-    coverage_state = fields.Function(fields.Selection([
-            ('ok', 'Ok'),
-            ('acceptable', 'Acceptable'),
-            ('to_improve', 'To Improve'),
-            ('error', 'Error'),
-            ], 'Coverage State', select=True),
-        'get_state', searcher='search_coverage_state')
+    cache_build = fields.Many2One('project.test.build', 'Cache Build',
+        readonly=True, select=True, ondelete='SET NULL',
+        help='The build whose results are reused as the component was '
+        'already built on the same revision and database type.')
+    linked_builds = fields.One2Many('project.test.build', 'cache_build',
+        'Linked Builds', readonly=True)
+    coverage_files = fields.One2Many('project.test.build.coverage', 'build',
+        'Coverage Files', readonly=True)
+    finished = fields.Boolean('Finished', readonly=True,
+        help='All the results of the build are stored.')
+    rolled_up = fields.Boolean('Rolled Up', readonly=True,
+        help='The build is counted in the daily roll-up.')
+    week = fields.Date('Week', readonly=True,
+        help='The week of the results, set when the first one is stored.')
+    bisect = fields.Many2One('project.test.bisect', 'Bisect', readonly=True,
+        select=True, ondelete='SET NULL',
+        help='The bisection which runs the build with only its tests.')
+    first_bad = fields.Boolean('First Bad', readonly=True,
+        help='The revision is the first bad one found by the bisection.')
+    expected_tests = fields.Integer('Expected Tests', readonly=True,
+        help='By default, the number of known test cases of the component.')
+    done_tests = fields.Integer('Done Tests', readonly=True)
+    failed_tests = fields.Integer('Failed Tests', readonly=True)
+    test_state = fields.Selection(STATES, 'Test State', readonly=True,
+        select=True)
+    flake_state = fields.Selection(STATES, 'Flake State', readonly=True,
+        select=True)
+    coverage_state = fields.Selection(COVERAGE_STATES, 'Coverage State',
+        readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TestBuild, cls).__setup__()
+        cls.__rpc__.update({
+                'upload_report': RPC(readonly=False, instantiate=0),
+                'diff_coverage': RPC(instantiate=0),
+                'finish': RPC(readonly=False, instantiate=0),
+                'push_results': RPC(readonly=False, instantiate=0),
+                'export_results': RPC(instantiate=0),
+                })
+        cls._error_messages.update({
+                'unknown_report_format': 'Unknown test report format "%s".',
+                'unknown_export_format': 'Unknown export format "%s".',
+                })
 
     @classmethod
-    def get_state(cls, builds, names):
+    def __register__(cls, module_name):
         pool = Pool()
+        Group = pool.get('project.test.build.group')
         Result = pool.get('project.test.build.result')
+        TableHandler = backend.get('TableHandler')
         cursor = Transaction().connection.cursor()
-        in_max = cursor.IN_MAX
+        table = cls.__table__()
+        group = Group.__table__()
+
+        migrate_finished = (TableHandler.table_exist(cls._table)
+            and not TableHandler(cls, module_name).column_exist('finished'))
+        migrate_week = (TableHandler.table_exist(cls._table)
+            and not TableHandler(cls, module_name).column_exist('week')
+            and TableHandler.table_exist(Result._table)
+            and TableHandler(Result, module_name).column_exist('week'))
+
+        super(TestBuild, cls).__register__(module_name)
+
+        table_h = TableHandler(cls, module_name)
+        table_h.index_action(['component', 'execution'], 'add')
+        table_h.index_action(['component', 'revision'], 'add')
+
+        # Migration from 3.4: builds of ended groups are finished
+        if migrate_finished:
+            cursor.execute(*table.update([table.finished], [True],
+                    where=table.group.in_(group.select(group.id,
+                            where=group.end != Null))))
+
+        # Migration from 3.4: the week of the results is stored on builds
+        if migrate_week:
+            result = Result.__table__()
+            cursor.execute(*table.update([table.week],
+                    [result.select(Min(result.week),
+                            where=result.build == table.id)]))
+
+    @staticmethod
+    def default_test_state():
+        return 'pass'
+
+    @staticmethod
+    def default_flake_state():
+        return 'pass'
+
+    @staticmethod
+    def default_coverage_state():
+        return 'ok'
+
+    @staticmethod
+    def default_finished():
+        return False
+
+    @staticmethod
+    def default_rolled_up():
+        return False
+
+    @staticmethod
+    def default_first_bad():
+        return False
+
+    @staticmethod
+    def default_done_tests():
+        return 0
+
+    @staticmethod
+    def default_failed_tests():
+        return 0
+
+    @classmethod
+    def finish(cls, builds):
+        'Called once all the results of builds are stored'
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Rollup = pool.get('project.test.rollup')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
 
-        build_ids = [g.id for g in builds]
-        test_state = {}.fromkeys(build_ids, 'pass')
-        flake_state = {}.fromkeys(build_ids, 'pass')
-        coverage_state = {}.fromkeys(build_ids, 'ok')
+        for sub_builds in grouped_slice(builds):
+            cursor.execute(*table.update([table.finished], [True],
+                    where=reduce_ids(table.id, [b.id for b in sub_builds])))
+        Rollup.add_builds(builds)
+        Group._priority_cache.clear()
 
+    @classmethod
+    def clear_results(cls, builds):
+        'Delete the results and the coverage of builds to run them again'
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+        Coverage = pool.get('project.test.build.coverage')
+        cursor = Transaction().connection.cursor()
         table = cls.__table__()
         result = Result.__table__()
+        coverage = Coverage.__table__()
 
-        # TODO: Replace with grouped_slice
-        for i in range(0, len(build_ids), in_max):
-            sub_ids = build_ids[i:i + in_max]
-            red_sql = reduce_ids(table.id, sub_ids)
-            coverage = Case((table.coverage < Literal(50), 'error'),
-                            (table.coverage < Literal(60), 'to_improve'),
-                            (table.coverage < Literal(70), 'acceptable'),
-                            else_='ok')
-            coverage_query = table.select(table.id, coverage, where=red_sql)
-            cursor.execute(*coverage_query)
-            coverage_state.update(dict(cursor.fetchall()))
-            for name in ('test_state', 'flake_state'):
-                if name not in names:
-                    continue
-
-                if name == 'test_state':
-                    types = ['unittest', 'scenario']
-                else:
-                    types = ['flake', 'pep8']
-                numeric_state = Min(Case((result.state == Literal('error'), 0),
-                        (result.state == Literal('fail'), 1),
-                        else_=2))
-                state = Case((numeric_state == Literal(0), 'error'),
-                    (numeric_state == Literal(1), 'fail'),
-                    else_='pass')
-                query = result.join(table, condition=(
-                        (table.id == result.build) &
-                        result.type.in_(types))).select(table.id, state,
-                            group_by=table.id)
+        build_ids = [b.id for b in builds]
+        # Keep the results used by the other builds
+        cls.release_cache(build_ids)
+        for sub_ids in grouped_slice(build_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*result.delete(
+                    where=reduce_ids(result.build, sub_ids)))
+            cursor.execute(*coverage.delete(
+                    where=reduce_ids(coverage.build, sub_ids)))
+            cursor.execute(*table.update([table.cache_build, table.coverage,
+                        table.lines, table.covered_lines, table.finished,
+                        table.week],
+                    [Null, Null, Null, 0, False, Null],
+                    where=reduce_ids(table.id, sub_ids)))
+        cls.refresh_state(builds)
 
+    @classmethod
+    def refresh_state(cls, builds):
+        '''
+        Recompute the stored states and test counters of builds from its
+        results and propagate them to their groups
+        '''
+        with profiler(cls.__name__, 'refresh_state', len(builds)):
+            pool = Pool()
+            Group = pool.get('project.test.build.group')
+            Result = pool.get('project.test.build.result')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            result = Result.__table__()
+
+            names = ('test_state', 'flake_state', 'coverage_state')
+            counter_names = ('done_tests', 'failed_tests')
+            group_ids = set()
+            for sub_builds in grouped_slice(builds):
+                sub_ids = [b.id for b in sub_builds]
+                states = {}
+                counters = {}.fromkeys(sub_ids, (0, 0))
+                # Builds linked to a cached build get the states of its results
+                sources = {}
+                cursor.execute(*table.select(table.id, table.group,
+                        _coverage_state(table.coverage),
+                        Coalesce(table.cache_build, table.id),
+                        where=reduce_ids(table.id, sub_ids)))
+                for build_id, group_id, coverage, source in cursor.fetchall():
+                    states[build_id] = ['pass', 'pass', coverage]
+                    sources.setdefault(source, []).append(build_id)
+                    if group_id:
+                        group_ids.add(group_id)
+                where = reduce_ids(result.build, list(sources))
+                if partitioned():
+                    # Restrict the scan to the partitions of the builds
+                    where &= result.week.in_(
+                        list(set(cls.get_weeks(list(sources)).values())))
+                query = result.select(result.build,
+                    _rank_state(_result_rank(result, TEST_TYPES),
+                        STATE_ORDER),
+                    _rank_state(_result_rank(result, FLAKE_TYPES),
+                        STATE_ORDER),
+                    _test_count(result),
+                    _test_count(result, ['fail', 'error']),
+                    where=where,
+                    group_by=result.build)
                 cursor.execute(*query)
-                if name == 'test_state':
-                    test_state.update(dict(cursor.fetchall()))
-                else:
-                    flake_state.update(dict(cursor.fetchall()))
+                for source, test, flake, done, failed in cursor.fetchall():
+                    for build_id in sources.get(source, []):
+                        states[build_id][:2] = [test, flake]
+                        counters[build_id] = (done, failed)
+                write_states(table, states, names)
+                update_rows(table, counter_names,
+                    [v + (k,) for k, v in counters.iteritems()])
+            Group.refresh_state(Group.browse(list(group_ids)))
 
-        result = {
-            'coverage_state': coverage_state,
-            'flake_state': flake_state,
-            'test_state': test_state
-        }
+    @classmethod
+    def merge_state(cls, build_states):
+        '''
+        Merge new result states into the stored states of builds.
+
+        build_states is a dictionary of build id and a tuple of the worst
+        test and flake states of the new results (or None).
+        As results can only make a build worse, only the builds which change
+        are written and only their groups are recomputed.
+        '''
+        with profiler(cls.__name__, 'merge_state', len(build_states)):
+            pool = Pool()
+            Group = pool.get('project.test.build.group')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
 
-        for key in result.keys():
-            if key not in names:
-                del result[key]
-        return result
+            names = ('test_state', 'flake_state')
+            group_ids = set()
+            for sub_ids in grouped_slice(build_states.keys()):
+                sub_ids = list(sub_ids)
+                states = {}
+                cursor.execute(*table.select(table.id, table.group,
+                        table.test_state, table.flake_state,
+                        where=reduce_ids(table.id, sub_ids)))
+                for build_id, group_id, test, flake in cursor.fetchall():
+                    new_test, new_flake = build_states[build_id]
+                    merged = (
+                        worst_state([test, new_test or test]),
+                        worst_state([flake, new_flake or flake]),
+                        )
+                    if merged != (test, flake):
+                        states[build_id] = merged
+                        if group_id:
+                            group_ids.add(group_id)
+                write_states(table, states, names)
+            if group_ids:
+                Group.refresh_state(Group.browse(list(group_ids)))
 
     @classmethod
-    def search_coverage_state(cls, name, clause):
-        _, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
+    def add_progress(cls, counts):
+        '''
+        Add to the test counters of builds and of their groups counts, a
+        dictionary of build id and a tuple with the number of new done and
+        failed tests
+        '''
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        cursor = Transaction().connection.cursor()
         table = cls.__table__()
-        coverage_state = Case((table.coverage < Literal(50), 'error'),
-                        (table.coverage < Literal(60), 'to_improve'),
-                        (table.coverage < Literal(70), 'acceptable'),
-                        else_='ok')
-        query = table.select(table.id,
-            where=(Operator(coverage_state, value)))
-        return [('id', 'in', query)]
+        group = Group.__table__()
+
+        names = ('done_tests', 'failed_tests')
+        add_counters(table, counts, names)
+        group_counts = {}
+        for sub_ids in grouped_slice(counts.keys()):
+            cursor.execute(*table.select(table.id, table.group,
+                    where=reduce_ids(table.id, list(sub_ids))
+                    & (table.group != Null)))
+            for build_id, group_id in cursor.fetchall():
+                done, failed = group_counts.get(group_id, (0, 0))
+                group_counts[group_id] = (done + counts[build_id][0],
+                    failed + counts[build_id][1])
+        add_counters(group, group_counts, names)
 
     @classmethod
-    def search_state(cls, name, clause):
+    def push_results(cls, build, results, total=None):
+        '''
+        Store results, a list of dictionaries with name, type, state,
+        description and duration, as soon as they are run by a test worker,
+        total being the number of tests the worker expects to run.
+        Workers should buffer their results with stream.ResultStream to send
+        them by batches. Returns the number of stored results.
+        '''
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+
+        if total is not None and total != build.expected_tests:
+            cls.write([build], {
+                    'expected_tests': total,
+                    })
+        return Result.insert_results(
+            dict(v, build=build.id) for v in results)
+
+    @classmethod
+    def import_report(cls, build, report, format_='junit',
+            coverage_report=None):
+        '''
+        Import the results of the test report (a file name or a file object)
+        into build. format_ is either 'junit' or 'subunit'.
+        File names are read on the server so clients must use upload_report.
+        If coverage_report (Cobertura XML) is given, the coverage of the build
+        and of each of its files is updated too.
+        Returns the number of imported results.
+        '''
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+
+        parser = REPORT_PARSERS.get(format_)
+        if not parser:
+            cls.raise_user_error('unknown_report_format', format_)
+
+        def results():
+            for values in parser(report):
+                values['build'] = build.id
+                yield values
+        count = Result.insert_results(results())
+        if coverage_report:
+            cls.import_coverage(build, coverage_report)
+        return count
+
+    @classmethod
+    def upload_report(cls, build, report, format_='junit',
+            coverage_report=None):
+        '''
+        Import the content of the test report and of the optional Cobertura
+        XML coverage_report sent by a client into build.
+        Returns the number of imported results.
+        '''
+        if coverage_report is not None:
+            coverage_report = BytesIO(coverage_report)
+        return cls.import_report(build, BytesIO(report), format_=format_,
+            coverage_report=coverage_report)
+
+    @classmethod
+    def import_coverage(cls, build, report, merge=False):
+        '''
+        Update the coverage of build and of each of its files from the
+        Cobertura XML report (a file name or a file object).
+        If merge is set, the report is merged into the stored coverage of
+        build, like the reports of its shards.
+        '''
+        pool = Pool()
+        Coverage = pool.get('project.test.build.coverage')
+        cursor = Transaction().connection.cursor()
+        coverage_table = Coverage.__table__()
+
+        coverage, lines, covered_lines = read_coverage(report)
+        if not isinstance(report, basestring):
+            # The files are parsed from the start of the report
+            report.seek(0)
+        if merge:
+            Coverage.merge_files(build, iter_coverage_files(report))
+            cursor.execute(*coverage_table.select(
+                    Sum(coverage_table.lines),
+                    Sum(coverage_table.covered_lines),
+                    where=coverage_table.build == build.id))
+            lines, covered_lines = [v or 0 for v in cursor.fetchone()]
+            if lines:
+                coverage = round(covered_lines * 100.0 / lines, 2)
+        else:
+            Coverage.import_files(build, iter_coverage_files(report))
+        cls.write([build], {
+                'coverage': coverage,
+                'lines': lines,
+                'covered_lines': covered_lines,
+                })
+
+    @classmethod
+    def export_results(cls, builds, format_='junit', offset=0,
+            limit=EXPORT_LIMIT):
+        '''
+        Return the chunk of the results of builds exported in format_,
+        'junit' or 'csv', with at most limit results from the offset-th one
+        and the offset of the next chunk, None for the last one.
+        Clients call it from offset 0 and concatenate the chunks, so the
+        memory used by a call does not depend on the size of the export.
+        '''
+        writer_class = EXPORT_FORMATS.get(format_)
+        if not writer_class:
+            cls.raise_user_error('unknown_export_format', format_)
+        file_ = BytesIO()
+        writer = writer_class(file_, header=not offset)
+        next_offset = cls.write_results(builds, writer, offset=offset,
+            limit=limit)
+        if next_offset is None:
+            writer.close()
+        return fields.Binary.cast(file_.getvalue()), next_offset
+
+    @classmethod
+    def write_results(cls, builds, writer, offset=0, limit=None):
+        '''
+        Stream to writer at most limit results of builds from the offset-th
+        one, with the start and the end of their builds, reading them from a
+        server-side cursor so memory does not depend on their number.
+        Returns the offset of the next result or None if the last one is
+        written.
+        '''
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+        TestCase = pool.get('project.test.case')
+        Failure = pool.get('project.test.failure')
+        cursor = Transaction().connection.cursor()
+        result = Result.__table__()
+        case = TestCase.__table__()
+        failure = Failure.__table__()
+
+        sources = dict((b.id, (b.cache_build or b).id) for b in builds)
+        weeks = cls.get_weeks(list(set(sources.values())))
+        summaries = {}
+        for sub_ids in grouped_slice(list(set(sources.values()))):
+            cursor.execute(*result.select(result.build, Count(result.id),
+                    _state_count(result, ['fail']),
+                    _state_count(result, ['error']),
+                    Sum(Coalesce(result.duration, 0)),
+                    where=reduce_ids(result.build, list(sub_ids)),
+                    group_by=result.build))
+            for row in cursor.fetchall():
+                summaries[row[0]] = row[1:]
+
+        total = sum(summaries.get(sources[b.id], (0,))[0] for b in builds)
+        stop = total if limit is None else min(offset + limit, total)
+        descriptions = {}
+        # Position of the first result of the build in the export
+        start = 0
+        for build in builds:
+            source = sources[build.id]
+            summary = summaries.get(source, (0, 0, 0, 0))
+            end = start + summary[0]
+            # Builds without results are written with the next results
+            begins = offset <= start and (start < stop or stop == total)
+            first, last = max(start, offset), min(end, stop)
+            if not begins and first >= last:
+                start = end
+                continue
+            build_name = '%s@%s' % (build.component.rec_name, build.revision)
+            if begins:
+                writer.start_build(build_name, *summary)
+            else:
+                writer.resume_build(build_name)
+            if first >= last:
+                # Build without results
+                writer.end_build()
+                start = end
+                continue
+            where = result.build == source
+            if partitioned():
+                where &= result.week == weeks[source]
+            result_cursor = server_cursor('project_test_export_%s' % source)
+            result_cursor.execute(*result.join(case,
+                    condition=result.case == case.id).join(failure, 'LEFT',
+                    condition=result.failure == failure.id).select(
+                    case.name, result.type, result.state, result.duration,
+                    result.flaky, failure.id, failure.data,
+                    where=where, order_by=[case.name, result.id],
+                    offset=first - start, limit=last - first))
+            for rows in iter(
+                    lambda: result_cursor.fetchmany(BATCH_SIZE), []):
+                for (name, type_, state, duration, flaky, failure_id,
+                        data) in rows:
+                    if failure_id and failure_id not in descriptions:
+                        # Keep memory bounded with many distinct failures
+                        if len(descriptions) >= BATCH_SIZE:
+                            descriptions.clear()
+                        descriptions[failure_id] = zlib.decompress(
+                            data).decode('utf-8')
+                    writer.write({
+                            'name': name,
+                            'type': type_,
+                            'state': state,
+                            'duration': duration,
+                            'flaky': flaky,
+                            'description': descriptions.get(failure_id),
+                            })
+            result_cursor.close()
+            if end <= stop:
+                writer.end_build()
+            start = end
+        return stop if stop < total else None
+
+    @classmethod
+    def diff_coverage(cls, build, changes):
+        '''
+        Return the coverage by build of the changes of its review, a
+        dictionary of file name and changed line numbers
+        '''
         pool = Pool()
+        Coverage = pool.get('project.test.build.coverage')
+        return Coverage.diff_coverage(build, changes)
+
+    @classmethod
+    def link_cache(cls, builds):
+        '''
+        Link builds to the latest finished build with results of the same
+        component, revision and database type and return the builds without
+        such a build, which must be run
+        '''
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
         Result = pool.get('project.test.build.result')
-        _, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
-        table = Result.__table__()
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        group = Group.__table__()
         result = Result.__table__()
-        if name == 'test_state':
-            where = Coalesce(table.type, 'none').in_(['unittest', 'scenario',
-                    'none'])
-        elif name == 'flake_state':
-            where = Coalesce(table.type, 'none').in_(['flake', 'pep8', 'none'])
+
+        to_run = []
+        for build in builds:
+            if not build.group:
+                to_run.append(build)
+                continue
+            # Builds cancelled or crashed without results are not reused
+            source = Coalesce(table.cache_build, table.id)
+            cursor.execute(*table.join(group,
+                    condition=table.group == group.id).select(source,
+                    where=(table.component == build.component.id)
+                    & (table.revision == build.revision)
+                    & (group.db_type == build.group.db_type)
+                    & (table.finished == True)
+                    & (table.id != build.id)
+                    & Exists(result.select(Literal(1),
+                            where=result.build == source, limit=1)),
+                    order_by=table.id.desc, limit=1))
+            row = cursor.fetchone()
+            if not row:
+                to_run.append(build)
+                continue
+            cache_build = cls(row[0])
+            cls.write([build], {
+                    'cache_build': cache_build.id,
+                    'coverage': cache_build.coverage,
+                    'lines': cache_build.lines,
+                    'covered_lines': cache_build.covered_lines,
+                    })
+        linked = [b for b in builds if b not in to_run]
+        if linked:
+            cls.refresh_state(linked)
+        return to_run
+
+    @classmethod
+    def get_weeks(cls, build_ids):
+        '''
+        Return a dictionary of build id and the week of its results, the
+        stored one or the monday of its execution or of its creation for
+        builds without results
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        weeks = {}
+        for sub_ids in grouped_slice(build_ids):
+            cursor.execute(*table.select(table.id, table.week,
+                    table.execution, table.create_date,
+                    where=reduce_ids(table.id, list(sub_ids))))
+            for build_id, week, execution, create_date in cursor.fetchall():
+                weeks[build_id] = week or week_start(execution or create_date)
+        return weeks
+
+    @classmethod
+    def release_cache(cls, build_ids):
+        '''
+        Move the results, the coverage and the coverage contexts of builds
+        used as cache by builds not in build_ids to the latest of them, which
+        becomes the cache of the others.
+        Must be called before deleting builds.
+        '''
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+        Coverage = pool.get('project.test.build.coverage')
+        Impact = pool.get('project.test.impact')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        result = Result.__table__()
+        coverage = Coverage.__table__()
+        impact = Impact.__table__()
+
+        for sub_ids in grouped_slice(build_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.select(table.cache_build, Max(table.id),
+                    where=reduce_ids(table.cache_build, sub_ids)
+                    & ~reduce_ids(table.id, build_ids),
+                    group_by=table.cache_build))
+            for old_id, new_id in cursor.fetchall():
+                # The results stay in the partition of their week
+                week = cls.get_weeks([old_id])[old_id]
+                cursor.execute(*result.update([result.build], [new_id],
+                        where=result.build == old_id))
+                cursor.execute(*coverage.update([coverage.build], [new_id],
+                        where=coverage.build == old_id))
+                cursor.execute(*impact.update([impact.build], [new_id],
+                        where=impact.build == old_id))
+                cursor.execute(*table.update([table.cache_build], [new_id],
+                        where=(table.cache_build == old_id)
+                        & (table.id != new_id)))
+                cursor.execute(*table.update([table.cache_build, table.week],
+                        [Null, week], where=table.id == new_id))
+
+    @property
+    def directory(self):
+        pool = Pool()
+        Configuration = pool.get('project.test.configuration')
+        return os.path.join(Configuration(1).directory,
+            'group-%s' % self.group.id, 'build-%s' % self.id)
+
+    def get_tasks(self, configuration):
+        '''
+        Return the runner tasks of the build, one by shard of its tests if
+        its group has several shards
+        '''
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        if self.bisect:
+            return [self.get_task(configuration, self.bisect.tests.split())]
+        changes = None
+        if self.group.test_order == 'failure_first':
+            changes = self.get_changes(configuration)
+        order = Group.order_tests(self.component.id, self.branch,
+            changes=changes, policy=self.group.test_order)
+        shards = []
+        if self.group.shards > 1:
+            # Each shard runs its tests in the order of the build
+            rank = dict((n, i) for i, n in enumerate(order))
+            shards = [sorted(tests, key=rank.get) for _, tests
+                in Group.plan_shards(self.component.id, self.group.shards)
+                if tests]
+        if len(shards) < 2:
+            return [self.get_task(configuration, order)]
+        return [self.get_task(configuration, tests, shard=i)
+            for i, tests in enumerate(shards)]
+
+    def get_changes(self, configuration):
+        '''
+        Return the changes of the revision of the build, a dictionary of file
+        name and changed line numbers, from the output of the changes command
+        '''
+        if not configuration.changes_command:
+            return None
+        # The command is run by the shell
+        command = configuration.changes_command.format(
+            component=pipes.quote(self.component.rec_name),
+            branch=pipes.quote(self.branch),
+            revision=pipes.quote(self.revision))
+        try:
+            diff = subprocess.check_output(command, shell=True,
+                cwd=configuration.directory)
+        except subprocess.CalledProcessError:
+            # The tests are still run, without the changes first
+            logger.warning('Changes command failed for build %s', self.id)
+            return None
+        return diff_changes(diff.decode('utf-8', 'replace').splitlines())
+
+    def get_task(self, configuration, order, shard=None):
+        '''
+        Return the runner task of the build which runs the tests of order,
+        in its own working copy and database if it is a shard
+        '''
+        directory = self.directory
+        if shard is not None:
+            directory += '-%s' % shard
+        values = {
+            'component': self.component.rec_name,
+            'branch': self.branch,
+            'revision': self.revision,
+            'directory': directory,
+            'report': os.path.join(directory, 'junit.xml'),
+            'coverage': os.path.join(directory, 'coverage.xml'),
+            'order': os.path.join(directory, 'tests.txt'),
+            }
+        # The commands are run by the shell
+        values = dict((k, pipes.quote(v)) for k, v in values.iteritems())
+        if self.group.db_type == 'sqlite':
+            database = ':memory:'
+            uri = 'sqlite://'
         else:
-            raise Exception('Bad argument')
+            database = 'test_%s_%s' % (self.group.id, self.id)
+            if shard is not None:
+                database += '_%s' % shard
+            uri = 'postgresql://'
+        template = None
+        if configuration.template_command:
+            # The modules of the build are installed by the test command
+            template = {
+                'path': configuration.template_directory,
+                'before': 1,
+                'components': [self.component.rec_name] + [
+                    c.rec_name for c in configuration.client_components],
+                'db_type': self.group.db_type,
+                'directory': directory,
+                # SQLite templates are copied to a file of the directory
+                'database': database if database != ':memory:' else 'test',
+                'template_command': configuration.template_command,
+                'dependencies_command': configuration.dependencies_command,
+                }
+        return {
+            'build': self.id,
+            'shard': shard,
+            'directory': directory,
+            'database': database if uri != 'sqlite://' else None,
+            'commands': [
+                (configuration.checkout_command.format(**values),
+                    os.path.dirname(directory)),
+                (configuration.test_command.format(**values), directory),
+                ],
+            'env': {
+                'DB_NAME': database,
+                'TEST_BUILD': str(self.id),
+                'TRYTOND_CONFIG': os.path.join(directory, 'trytond.conf'),
+                },
+            'files': {
+                'trytond.conf': '[database]\nuri = %s\npath = %s\n' % (
+                    uri, directory),
+                'tests.txt': u''.join(n + u'\n' for n in order).encode(
+                    'utf-8'),
+                },
+            'template': template,
+            }
 
-        numeric_state = Min(Case((table.state == Literal('error'), 0),
-                (table.state == Literal('fail'), 1),
-                else_=2))
-        state = Case((numeric_state == Literal(0), 'error'),
-            (numeric_state == Literal(1), 'fail'),
-            else_='pass')
-        query = result.join(table, 'LEFT', condition=(
-                (table.id == result.id) & where)).select(result.build,
-                    group_by=result.build, having=(Operator(state, value)))
-        return [('id', 'in', query)]
+    def import_task(self, task, returncode, imported=0):
+        '''
+        Import the reports written by task of the build, skipping the test
+        report if the results were pushed while running.
+        imported is the number of results imported from the reports of the
+        other shards of the build. Returns the number of imported results.
+        '''
+        pool = Pool()
+        Result = pool.get('project.test.build.result')
+        Coverage = pool.get('project.test.build.coverage')
+        directory = task['directory']
+        report = os.path.join(directory, 'junit.xml')
+        coverage = os.path.join(directory, 'coverage.xml')
+        # The results pushed by the workers are already stored
+        streamed = Result.search([
+                ('build', '=', self.id),
+                ], offset=imported, limit=1)
+        count = 0
+        if os.path.exists(report):
+            if not streamed:
+                count = self.import_report(self, report)
+        elif returncode:
+            with open(directory + '.log', 'rb') as log:
+                log.seek(0, os.SEEK_END)
+                log.seek(max(0, log.tell() - 10000))
+                description = log.read().decode('utf-8', 'replace')
+            Result.insert_results([{
+                        'build': self.id,
+                        'name': 'build',
+                        'type': 'unittest',
+                        'state': 'error',
+                        'description': description,
+                        }])
+            count = 1
+        if os.path.exists(coverage):
+            # The coverage of the other shards is already stored
+            merge = bool(Coverage.search([
+                        ('build', '=', self.id),
+                        ], limit=1))
+            self.import_coverage(self, coverage, merge=merge)
+        return count
+
+    @classmethod
+    def count_cases(cls, component_ids):
+        '''
+        Return a dictionary of component id and its number of known test
+        cases
+        '''
+        pool = Pool()
+        TestCase = pool.get('project.test.case')
+        cursor = Transaction().connection.cursor()
+        case = TestCase.__table__()
+
+        expected = {}.fromkeys(component_ids, 0)
+        for sub_ids in grouped_slice(component_ids):
+            cursor.execute(*case.select(case.component, Count(case.id),
+                    where=reduce_ids(case.component, list(sub_ids))
+                    & case.type.in_(TEST_TYPES),
+                    group_by=case.component))
+            expected.update(cursor.fetchall())
+        return expected
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Component = pool.get('project.work.component')
+        vlist = [v.copy() for v in vlist]
+        expected = cls.count_cases(list({v['component'] for v in vlist
+                    if v.get('component') and 'expected_tests' not in v}))
+        for values in vlist:
+            values['coverage_state'] = coverage_state(values.get('coverage'))
+            if 'expected_tests' not in values:
+                values['expected_tests'] = expected.get(
+                    values.get('component'))
+        builds = super(TestBuild, cls).create(vlist)
+        Group.refresh_state(list({b.group for b in builds if b.group}))
+        Component.update_last_build(list({b.component for b in builds}))
+        return builds
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Component = pool.get('project.work.component')
+        actions = iter(args)
+        args = []
+        groups = set()
+        components = set()
+        for builds, values in zip(actions, actions):
+            if set(values) & {'coverage', 'group', 'expected_tests'}:
+                groups.update(b.group for b in builds if b.group)
+            if 'execution' in values or 'component' in values:
+                components.update(b.component for b in builds)
+            if 'coverage' in values:
+                values = values.copy()
+                values['coverage_state'] = coverage_state(values['coverage'])
+            args.extend((builds, values))
+        super(TestBuild, cls).write(*args)
+        actions = iter(args)
+        for builds, values in zip(actions, actions):
+            if 'group' in values and values['group']:
+                groups.add(Group(values['group']))
+            if values.get('component'):
+                components.add(Component(values['component']))
+        if groups:
+            Group.refresh_state(list(groups))
+        if components:
+            Component.update_last_build(list(components))
+
+    @classmethod
+    def delete(cls, builds):
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Component = pool.get('project.work.component')
+        groups = list({b.group for b in builds if b.group})
+        components = list({b.component for b in builds})
+        cls.release_cache([b.id for b in builds])
+        super(TestBuild, cls).delete(builds)
+        if groups:
+            Group.refresh_state(groups)
+        if components:
+            Component.update_last_build(components)
+
+
+class TestCase(ModelSQL, ModelView):
+    'Test Case'
+    __name__ = 'project.test.case'
+
+    component = fields.Many2One('project.work.component', 'Component',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    name = fields.Char('Name', required=True, readonly=True, select=True)
+    type = fields.Selection(RESULT_TYPES, 'Type', required=True,
+        readonly=True)
+    results = fields.One2Many('project.test.build.result', 'case', 'Results',
+        readonly=True)
+    flaky_score = fields.Float('Flaky Score', digits=(16, 2), readonly=True,
+        help='Moving average of the state changes between runs of the test '
+        'on the same revision.')
+    flaky = fields.Boolean('Flaky', readonly=True, select=True)
+    average_duration = fields.Float('Average Duration', digits=(16, 3),
+        readonly=True, help='Moving average of the durations in seconds.')
+
+    @classmethod
+    def __setup__(cls):
+        super(TestCase, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('component_name_type_uniq',
+                Unique(t, t.component, t.name, t.type),
+                'The test case must be unique per component and type.'),
+            ]
+        cls._order.insert(0, ('name', 'ASC'))
+
+    @staticmethod
+    def default_flaky_score():
+        return 0
+
+    @staticmethod
+    def default_flaky():
+        return False
+
+    @classmethod
+    def update_flakiness(cls, vlist):
+        '''
+        Update the flaky score of the test cases of the results values in
+        vlist and return the ids of the flaky test cases among them.
+
+        Only results of revisions already built for the same component and
+        branch are taken into account, comparing their state with the one of
+        the latest previous run, so history is never rescanned.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        Result = pool.get('project.test.build.result')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        build = Build.__table__()
+        previous = Build.__table__()
+        result = Result.__table__()
+
+        by_build = {}
+        for values in vlist:
+            if values.get('state') in STATE_ORDER:
+                by_build.setdefault(values['build'], {})[values['case']] = (
+                    values['state'])
+
+        observations = []
+        for build_id, states in by_build.iteritems():
+            # Previous runs of the same revision, the latest first
+            query = build.join(previous, condition=(
+                    (previous.component == build.component)
+                    & (previous.branch == build.branch)
+                    & (previous.revision == build.revision)
+                    & (previous.id != build.id))).select(previous.id,
+                where=build.id == build_id,
+                order_by=[previous.execution.desc, previous.id.desc])
+            cursor.execute(*query)
+            previous_ids = [i for i, in cursor.fetchall()]
+            if not previous_ids:
+                continue
+            previous_states = {}
+            for sub_ids in grouped_slice(states.keys()):
+                cursor.execute(*result.select(result.case, result.build,
+                        result.state,
+                        where=reduce_ids(result.case, list(sub_ids))
+                        & reduce_ids(result.build, previous_ids)
+                        & result.state.in_(STATE_ORDER)))
+                for case_id, prev_build, state in cursor.fetchall():
+                    rank = previous_ids.index(prev_build)
+                    if (case_id not in previous_states
+                            or rank < previous_states[case_id][0]):
+                        previous_states[case_id] = (rank, state)
+            for case_id, (_, state) in previous_states.iteritems():
+                observations.append((case_id, states[case_id] != state))
+
+        flaky = set()
+        if observations:
+            scores = {}
+            case_ids = list({o[0] for o in observations})
+            for sub_ids in grouped_slice(case_ids):
+                cursor.execute(*table.select(table.id, table.flaky_score,
+                        where=reduce_ids(table.id, list(sub_ids))))
+                scores.update(cursor.fetchall())
+            for case_id, flip in observations:
+                scores[case_id] = ((scores[case_id] or 0) * (1 - FLAKY_ALPHA)
+                    + (FLAKY_ALPHA if flip else 0))
+            write_states(table, dict((i, (round(s, 2),
+                            s >= FLAKY_THRESHOLD))
+                    for i, s in scores.iteritems()), ('flaky_score', 'flaky'))
+
+        case_ids = list({v['case'] for v in vlist})
+        for sub_ids in grouped_slice(case_ids):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, list(sub_ids))
+                    & (table.flaky == True)))
+            flaky.update(i for i, in cursor.fetchall())
+        return flaky
+
+    @classmethod
+    def update_durations(cls, vlist):
+        'Update the average duration of test cases with the results values'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        durations = {}
+        for values in vlist:
+            if values.get('duration') is not None:
+                durations.setdefault(values['case'], []).append(
+                    values['duration'])
+        if not durations:
+            return
+        averages = {}
+        for sub_ids in grouped_slice(durations.keys()):
+            cursor.execute(*table.select(table.id, table.average_duration,
+                    where=reduce_ids(table.id, list(sub_ids))))
+            averages.update(cursor.fetchall())
+        rows = []
+        for case_id, values in durations.iteritems():
+            average = averages.get(case_id)
+            for duration in values:
+                if average is None:
+                    average = duration
+                else:
+                    average = (average * (1 - DURATION_ALPHA)
+                        + duration * DURATION_ALPHA)
+            rows.append((round(average, 3), case_id))
+        update_rows(table, ['average_duration'], rows)
+
+    @classmethod
+    def get_ids(cls, keys, cache):
+        '''
+        Fill cache, a dictionary of (component, name, type) keys and test case
+        ids, with keys creating the missing test cases
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        def missing():
+            by_component = {}
+            for key in keys:
+                if key not in cache:
+                    by_component.setdefault(key[0], set()).add(key[1:])
+            return by_component
+
+        def fetch():
+            for component, names in missing().iteritems():
+                for sub_names in grouped_slice(list({n for n, _ in names})):
+                    cursor.execute(*table.select(table.id, table.name,
+                            table.type,
+                            where=(table.component == component)
+                            & table.name.in_(list(sub_names))))
+                    for id_, name, type_ in cursor.fetchall():
+                        cache[(component, name, type_)] = id_
+
+        fetch()
+        if missing():
+            # Concurrent imports may create the same test cases
+            cls.lock()
+            fetch()
+        to_create = missing()
+        if to_create:
+            create_date = datetime.datetime.now()
+            bulk_insert(table, ['create_uid', 'create_date', 'component',
+                    'name', 'type'],
+                [(transaction.user, create_date, component, name, type_)
+                    for component, names in to_create.iteritems()
+                    for name, type_ in names])
+            fetch()
+        return cache
 
 
 class TestBuildResult(ModelSQL, ModelView):
@@ -321,21 +1957,107 @@ class TestBuildResult(ModelSQL, ModelView):
 
     build = fields.Many2One('project.test.build', 'Build', required=True,
         readonly=True, select=True, ondelete='CASCADE')
-    name = fields.Char('Name', required=True, readonly=True)
-    type = fields.Selection([
-            ('unittest', 'Unittest'),
-            ('scenario', 'Scenario'),
-            ('flake', 'Flake'),
-            ('pep8', 'PEP8'),
-            ('coverage', 'Coverage')
-            ], 'Type', required=True, readonly=True, select=True)
-    description = fields.Text('Description', readonly=True)
+    case = fields.Many2One('project.test.case', 'Test Case', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    name = fields.Function(fields.Char('Name'), 'get_name',
+        searcher='search_name')
+    # Type is also stored on results as it is used to compute the states
+    type = fields.Selection(RESULT_TYPES, 'Type', required=True,
+        readonly=True, select=True)
+    failure = fields.Many2One('project.test.failure', 'Failure',
+        readonly=True, select=True, ondelete='RESTRICT')
+    description = fields.Function(fields.Text('Description'),
+        'get_description')
     state = fields.Selection([
             ('draft', 'Draft'),
             ('fail', 'Failed'),
             ('error', 'Error'),
             ('pass', 'Pass'),
             ], 'State', required=True, readonly=True, select=True)
+    flaky = fields.Boolean('Flaky', readonly=True,
+        help='The test case was flaky when the result was stored.')
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help='In seconds.')
+    week = fields.Date('Week', required=True, readonly=True,
+        help='The monday of the week of the build execution.')
+    flaky_score = fields.Function(fields.Float('Flaky Score', digits=(16, 2)),
+        'get_flaky_score')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        TestCase = pool.get('project.test.case')
+        Failure = pool.get('project.test.failure')
+        TableHandler = backend.get('TableHandler')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        build = Build.__table__()
+        case = TestCase.__table__()
+
+        table_h = TableHandler(cls, module_name)
+        migrate_case = (table_h.column_exist('name')
+            and not table_h.column_exist('case'))
+        migrate_failure = table_h.column_exist('description')
+        migrate_week = (TableHandler.table_exist(cls._table)
+            and not table_h.column_exist('week'))
+
+        super(TestBuildResult, cls).__register__(module_name)
+
+        # Migration from 3.4: names are stored on test cases
+        if migrate_case:
+            table_h = TableHandler(cls, module_name)
+            table_h.not_null_action('name', 'remove')
+            distinct = table.join(build,
+                condition=table.build == build.id).select(
+                Literal(0), CurrentTimestamp(), build.component, table.name,
+                table.type,
+                group_by=[build.component, table.name, table.type])
+            cursor.execute(*case.insert([case.create_uid, case.create_date,
+                        case.component, case.name, case.type], distinct))
+            case_id = case.join(build,
+                condition=case.component == build.component).select(case.id,
+                where=(build.id == table.build)
+                & (case.name == table.name)
+                & (case.type == table.type))
+            cursor.execute(*table.update([table.case], [case_id]))
+            table_h.not_null_action('case', 'add')
+            table_h.drop_column('name')
+
+        # Migration from 3.4: descriptions are stored once by failure
+        if migrate_failure:
+            failures = {}
+            description_cursor = server_cursor(
+                'project_test_result_failure_migration')
+            description_cursor.execute(*table.select(table.id,
+                    table.description, where=table.description != Null))
+            for rows in iter(
+                    lambda: description_cursor.fetchmany(BATCH_SIZE), []):
+                fingerprints = [fingerprint(d) for _, d in rows]
+                Failure.get_ids(dict(zip(fingerprints, (d for _, d in rows))),
+                    failures)
+                update_rows(table, ['failure'],
+                    [(failures[f], r[0]) for f, r in zip(fingerprints, rows)])
+            TableHandler(cls, module_name).drop_column('description')
+
+        # Migration from 3.4: results are stored by week
+        if migrate_week:
+            cursor.execute(*build.select(build.id))
+            weeks = Build.get_weeks([i for i, in cursor.fetchall()])
+            ids_by_week = {}
+            for build_id, week in weeks.iteritems():
+                ids_by_week.setdefault(week, []).append(build_id)
+            for week, build_ids in ids_by_week.iteritems():
+                for sub_ids in grouped_slice(build_ids):
+                    cursor.execute(*table.update([table.week], [week],
+                            where=reduce_ids(table.build, sub_ids)))
+            write_states(build, dict((k, (v,)) for k, v in weeks.iteritems()),
+                ('week',))
+            TableHandler(cls, module_name).not_null_action('week', 'add')
+
+        if partitioned():
+            partition_table(cls._table, 'week')
 
     @staticmethod
     def default_state():
@@ -345,59 +2067,422 @@ class TestBuildResult(ModelSQL, ModelView):
     def default_type():
         return 'unittest'
 
+    @classmethod
+    def get_name(cls, results, name):
+        with profiler(cls.__name__, 'get_name', len(results)):
+            pool = Pool()
+            TestCase = pool.get('project.test.case')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            case = TestCase.__table__()
+
+            names = {}
+            for sub_results in grouped_slice(results):
+                cursor.execute(*table.join(case,
+                        condition=table.case == case.id).select(table.id,
+                        case.name,
+                        where=reduce_ids(table.id,
+                            [r.id for r in sub_results])))
+                names.update(cursor.fetchall())
+            return names
 
-class Component:
-    __name__ = 'project.work.component'
-    last_build = fields.Function(fields.Many2One('project.test.build',
-            'Last Build'),
-        'get_last_build')
-    test_state = fields.Function(fields.Selection([
-            ('', ''),
-            ('pass', 'Pass'),
-            ('fail', 'Fail'),
-            ('error', 'Error'),
-            ], 'Test State', select=True),
-        'get_state')
-    flake_state = fields.Function(fields.Selection([
-            ('', ''),
-            ('pass', 'Pass'),
-            ('fail', 'Fail'),
-            ('error', 'Error'),
-            ], 'Flake State', select=True),
-        'get_state')
-    coverage_state = fields.Function(fields.Selection([
-            ('', ''),
-            ('ok', 'Ok'),
-            ('acceptable', 'Acceptable'),
-            ('to_improve', 'To Improve'),
-            ('error', 'Error'),
-            ], 'Coverage State', select=True),
-        'get_state')
+    @classmethod
+    def search_name(cls, name, clause):
+        return [('case.name',) + tuple(clause[1:])]
+
+    @classmethod
+    def get_description(cls, results, name):
+        with profiler(cls.__name__, 'get_description', len(results)):
+            descriptions = {}.fromkeys((r.id for r in results))
+            for result in results:
+                if result.failure:
+                    descriptions[result.id] = result.failure.description
+            return descriptions
+
+    @staticmethod
+    def default_flaky():
+        return False
 
     @classmethod
-    def get_last_build(cls, components, name):
+    def get_flaky_score(cls, results, name):
+        with profiler(cls.__name__, 'get_flaky_score', len(results)):
+            pool = Pool()
+            TestCase = pool.get('project.test.case')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            case = TestCase.__table__()
+
+            scores = {}
+            for sub_results in grouped_slice(results):
+                cursor.execute(*table.join(case,
+                        condition=table.case == case.id).select(table.id,
+                        case.flaky_score,
+                        where=reduce_ids(table.id,
+                            [r.id for r in sub_results])))
+                scores.update(cursor.fetchall())
+            return scores
+
+    @classmethod
+    def set_cases(cls, vlist, cache=None):
+        '''
+        Replace the name by the test case in the results values of vlist
+        '''
         pool = Pool()
         Build = pool.get('project.test.build')
-        table = Build.__table__()
-        table2 = Build.__table__()
+        TestCase = pool.get('project.test.case')
         cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+
+        if cache is None:
+            cache = {}
+        build_ids = list({v['build'] for v in vlist if 'name' in v})
+        components = {}
+        for sub_ids in grouped_slice(build_ids):
+            cursor.execute(*build.select(build.id, build.component,
+                    where=reduce_ids(build.id, sub_ids)))
+            components.update(cursor.fetchall())
+        keys = []
+        for values in vlist:
+            if 'name' not in values:
+                continue
+            values['type'] = values.get('type') or cls.default_type()
+            keys.append((components[values['build']], values.pop('name'),
+                    values['type']))
+            values['case'] = keys[-1]
+        TestCase.get_ids(keys, cache)
+        for values in vlist:
+            if isinstance(values.get('case'), tuple):
+                values['case'] = cache[values['case']]
+        return vlist
+
+    @classmethod
+    def set_weeks(cls, vlist, cache=None):
+        '''
+        Set the week of the builds of the results values in vlist, store it
+        on the builds without results and create their partitions
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+
+        if cache is None:
+            cache = {}
+        missing = list({v['build'] for v in vlist} - set(cache))
+        if missing:
+            weeks = Build.get_weeks(missing)
+            ids_by_week = {}
+            for build_id, week in weeks.iteritems():
+                ids_by_week.setdefault(week, []).append(build_id)
+            # The week of results does not follow later executions
+            for week, build_ids in ids_by_week.iteritems():
+                for sub_ids in grouped_slice(build_ids):
+                    cursor.execute(*build.update([build.week], [week],
+                            where=reduce_ids(build.id, list(sub_ids))
+                            & (build.week == Null)))
+            if partitioned():
+                create_partitions(cls._table, set(weeks.values()))
+            cache.update(weeks)
+        for values in vlist:
+            values['week'] = cache[values['build']]
+        return vlist
+
+    @classmethod
+    def drop_partitions(cls, date, expired):
+        '''
+        Drop the partitions of weeks ended before date which only contain
+        results of builds of the expired groups (a query of group ids) and
+        of no cache of the other builds.
+        Returns the number of dropped results.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        cursor = Transaction().connection.cursor()
+        build = Build.__table__()
+
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        kept = build.select(build.id,
+            where=(build.group == Null) | ~build.group.in_(expired))
+        used = kept | build.select(build.cache_build,
+            where=build.id.in_(kept) & (build.cache_build != Null))
+        count = 0
+        for name, week in week_partitions(cls._table):
+            if week + datetime.timedelta(days=7) > date:
+                continue
+            partition = Table(name)
+            cursor.execute(*partition.select(Literal(1),
+                    where=partition.build.in_(used), limit=1))
+            if cursor.fetchone():
+                # Results still used are deleted with their builds
+                continue
+            cursor.execute(*partition.select(Count(Literal('*'))))
+            rows, = cursor.fetchone()
+            drop_partition(cls._table, name)
+            count += rows
+            logger.info('Dropped partition %s with %s results', name, rows)
+        return count
+
+    @classmethod
+    def set_failures(cls, vlist, cache=None):
+        '''
+        Replace the description by the failure in the results values of vlist
+        '''
+        pool = Pool()
+        Failure = pool.get('project.test.failure')
+
+        if cache is None:
+            cache = {}
+        descriptions = {}
+        for values in vlist:
+            description = values.pop('description', None)
+            if description:
+                values['failure'] = fingerprint(description)
+                descriptions.setdefault(values['failure'], description)
+        Failure.get_ids(descriptions, cache)
+        for values in vlist:
+            if 'failure' in values and values['failure'] in cache:
+                values['failure'] = cache[values['failure']]
+        return vlist
+
+    @classmethod
+    def update_cases(cls, vlist):
+        '''
+        Update the flakiness and the durations of the test cases of the
+        results values in vlist and flag the results of flaky test cases
+        '''
+        pool = Pool()
+        TestCase = pool.get('project.test.case')
+        TestCase.update_durations(vlist)
+        flaky = TestCase.update_flakiness(vlist)
+        for values in vlist:
+            values['flaky'] = values['case'] in flaky
+        return vlist
+
+    @classmethod
+    def build_states(cls, vlist):
+        '''
+        Return a dictionary of build id and a tuple of the worst test and
+        flake states of the results values in vlist
+        '''
+        build_states = {}
+        skip_flaky = ignore_flaky()
+        for values in vlist:
+            if skip_flaky and values.get('flaky'):
+                continue
+            type_ = values.get('type') or cls.default_type()
+            state = values.get('state') or cls.default_state()
+            if type_ in TEST_TYPES:
+                index = 0
+            elif type_ in FLAKE_TYPES:
+                index = 1
+            else:
+                continue
+            states = build_states.setdefault(values['build'], [None, None])
+            states[index] = worst_state([state, states[index] or state])
+        return dict((k, tuple(v)) for k, v in build_states.iteritems())
+
+    @classmethod
+    def build_progress(cls, vlist):
+        '''
+        Return a dictionary of build id and a tuple with the number of done
+        and failed tests of the results values in vlist
+        '''
+        progress = {}
+        for values in vlist:
+            if (values.get('type') or cls.default_type()) not in TEST_TYPES:
+                continue
+            done, failed = progress.get(values['build'], (0, 0))
+            if values.get('state') in ('fail', 'error'):
+                failed += 1
+            progress[values['build']] = (done + 1, failed)
+        return progress
+
+    @classmethod
+    def insert_results(cls, results):
+        '''
+        Insert results, an iterable of dictionaries with build, name, type,
+        state, description and duration, by batches without instantiating
+        records and merge their states and test counters into their builds.
+        Test cases and failures are looked up once for the whole iterable.
+        Returns the number of inserted results.
+        '''
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        transaction = Transaction()
+        table = cls.__table__()
+
+        columns = ['create_uid', 'create_date', 'build', 'case', 'type',
+            'state', 'failure', 'flaky', 'duration', 'week']
+        create_date = datetime.datetime.now()
+        cases = {}
+        failures = {}
+        weeks = {}
+        count = 0
+        for batch in batches(results):
+            cls.set_cases(batch, cases)
+            cls.set_failures(batch, failures)
+            cls.set_weeks(batch, weeks)
+            cls.update_cases(batch)
+            rows = [(transaction.user, create_date, r['build'], r['case'],
+                    r.get('type') or cls.default_type(),
+                    r.get('state') or cls.default_state(),
+                    r.get('failure'), r['flaky'], r.get('duration'),
+                    r['week'])
+                for r in batch]
+            bulk_insert(table, columns, rows)
+            Build.merge_state(cls.build_states(batch))
+            Build.add_progress(cls.build_progress(batch))
+            count += len(rows)
+        return count
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        vlist = cls.set_cases([v.copy() for v in vlist])
+        cls.set_failures(vlist)
+        cls.set_weeks(vlist)
+        cls.update_cases(vlist)
+        results = super(TestBuildResult, cls).create(vlist)
+        build_states = cls.build_states(vlist)
+        if build_states:
+            Build.merge_state(build_states)
+        progress = cls.build_progress(vlist)
+        if progress:
+            Build.add_progress(progress)
+        return results
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        actions = iter(args)
+        args = []
+        builds = set()
+        for results, values in zip(actions, actions):
+            if set(values) & {'build', 'type', 'state'}:
+                builds.update(r.build for r in results)
+            if values.get('build'):
+                builds.add(Build(values['build']))
+                values = cls.set_weeks([values.copy()])[0]
+            args.extend((results, values))
+        super(TestBuildResult, cls).write(*args)
+        if builds:
+            Build.refresh_state(list(builds))
+
+    @classmethod
+    def delete(cls, results):
+        pool = Pool()
+        Build = pool.get('project.test.build')
+        builds = list({r.build for r in results})
+        super(TestBuildResult, cls).delete(results)
+        if builds:
+            Build.refresh_state(builds)
+
+
+class Component:
+    __name__ = 'project.work.component'
+    last_build = fields.Many2One('project.test.build', 'Last Build',
+        readonly=True, ondelete='SET NULL')
+    test_state = fields.Function(fields.Selection([('', '')] + STATES,
+            'Test State', select=True),
+        'get_state', searcher='search_state')
+    flake_state = fields.Function(fields.Selection([('', '')] + STATES,
+            'Flake State', select=True),
+        'get_state', searcher='search_state')
+    coverage_state = fields.Function(fields.Selection(
+            [('', '')] + COVERAGE_STATES, 'Coverage State', select=True),
+        'get_state', searcher='search_state')
+    flaky_tests = fields.Function(fields.Integer('Flaky Tests'),
+        'get_flaky_tests')
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        migrate_last_build = not TableHandler(cls,
+            module_name).column_exist('last_build')
+
+        super(Component, cls).__register__(module_name)
+
+        # Migration from 3.4: last build is stored
+        if migrate_last_build:
+            cursor.execute(*table.select(table.id))
+            cls.update_last_build(cls.browse([i for i, in
+                        cursor.fetchall()]))
+
+    @classmethod
+    def update_last_build(cls, components):
+        'Store the build with the latest execution of each component'
+        with profiler(cls.__name__, 'update_last_build', len(components)):
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            build = Build.__table__()
+            build2 = Build.__table__()
+
+            for sub_components in grouped_slice(components):
+                sub_ids = [c.id for c in sub_components]
+                last_builds = {}.fromkeys(sub_ids)
+                subquery = build2.select(build2.component,
+                    Max(build2.execution).as_('execution'),
+                    where=reduce_ids(build2.component, sub_ids),
+                    group_by=build2.component)
+                query = build.join(subquery, condition=(
+                        (build.component == subquery.component)
+                        & (build.execution == subquery.execution))).select(
+                        build.component, Max(build.id),
+                        group_by=build.component)
+                cursor.execute(*query)
+                last_builds.update(cursor.fetchall())
+                write_states(table, dict((k, (v,))
+                        for k, v in last_builds.iteritems()), ('last_build',))
+
+    @classmethod
+    def get_state(cls, components, names):
+        with profiler(cls.__name__, 'get_state', len(components)):
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            build = Build.__table__()
+
+            result = dict((n, {}.fromkeys((c.id for c in components), ''))
+                for n in names)
+            for sub_components in grouped_slice(components):
+                sub_ids = [c.id for c in sub_components]
+                query = table.join(build,
+                    condition=table.last_build == build.id).select(table.id,
+                        *[getattr(build, n) for n in names],
+                        where=reduce_ids(table.id, sub_ids))
+                cursor.execute(*query)
+                for row in cursor.fetchall():
+                    for name, value in zip(names, row[1:]):
+                        result[name][row[0]] = value
+            return result
+
+    @classmethod
+    def search_state(cls, name, clause):
+        return [('last_build.' + name,) + tuple(clause[1:])]
+
+    @classmethod
+    def get_flaky_tests(cls, components, name):
+        with profiler(cls.__name__, 'get_flaky_tests', len(components)):
+            pool = Pool()
+            TestCase = pool.get('project.test.case')
+            cursor = Transaction().connection.cursor()
+            case = TestCase.__table__()
 
-        component_ids = [c.id for c in components]
-        result = {}.fromkeys(component_ids, None)
-        subquery = table2.select(table2.component,
-            Max(table2.execution).as_('execution'),
-            group_by=table2.component)
-
-        query = table.join(subquery, condition=(
-                (table.component == subquery.component) &
-                (table.execution == subquery.execution))).select(
-                    table.component, table.id,
-                    where=table.component.in_(component_ids))
-        cursor.execute(*query)
-        result.update(dict(cursor.fetchall()))
-        return result
-
-    def get_state(self, name):
-        if not self.last_build:
-            return ''
-        return getattr(self.last_build, name)
+            result = {}.fromkeys((c.id for c in components), 0)
+            for sub_components in grouped_slice(components):
+                cursor.execute(*case.select(case.component, Count(case.id),
+                        where=reduce_ids(case.component,
+                            [c.id for c in sub_components])
+                        & (case.flaky == True),
+                        group_by=case.component))
+                result.update(cursor.fetchall())
+            return result
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the project_unittest query paths on synthetic data.
+
+The database is given as for the tests, for example:
+
+    DB_NAME=benchmark TRYTOND_CONFIG=trytond.conf \\
+        python -m trytond.modules.project_unittest.tests.benchmark \\
+        --results 10000 100000 1000000 --output benchmark.json
+
+Each size generates its groups, builds and results, times each query path
+and deletes them. A JSON line is written for each path with the size, the
+elapsed time, the number of SQL statements and the number of fetched rows.
+'''
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+from itertools import izip_longest
+
+from trytond import backend
+from trytond.tests.test_tryton import install_module, DB_NAME, USER, \
+    CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.project_unittest.profiling import CountingConnection
+
+
+def measure(name, size, function, *args):
+    'Call function with args and return the measure of the call'
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = counting = CountingConnection(connection)
+    try:
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+    finally:
+        transaction.connection = connection
+    return {
+        'path': name,
+        'results': size,
+        'backend': backend.name(),
+        'elapsed': round(elapsed, 6),
+        'statements': counting.counter['statements'],
+        'rows': counting.counter['rows'],
+        }
+
+
+def generate(size, components, results_per_build):
+    'Create the synthetic data and return the groups'
+    pool = Pool()
+    Component = pool.get('project.work.component')
+    Group = pool.get('project.test.build.group')
+    Build = pool.get('project.test.build')
+    Result = pool.get('project.test.build.result')
+
+    random.seed(size)
+    components = Component.create([{
+                'name': 'benchmark_%s' % i,
+                } for i in range(components)])
+    builds = max(1, size // results_per_build)
+    end = datetime.datetime.now() - datetime.timedelta(weeks=2)
+    groups = Group.create([{
+                'name': 'Benchmark %s' % i,
+                'db_type': random.choice(['sqlite', 'postgresql']),
+                'start': end - datetime.timedelta(hours=1),
+                'end': end,
+                } for i in range(max(1, builds // len(components)))])
+
+    def group_builds():
+        for i in range(builds):
+            group = groups[i // len(components) % len(groups)]
+            coverage = random.uniform(40, 100)
+            yield {
+                'group': group.id,
+                'component': components[i % len(components)].id,
+                'branch': 'default',
+                'revision': '%040x' % random.getrandbits(160),
+                'execution': group.start,
+                'lines': 1000,
+                'covered_lines': int(coverage * 10),
+                'coverage': coverage,
+                }
+    build_ids = []
+    vlists = izip_longest(*[group_builds()] * 1000)
+    for vlist in vlists:
+        build_ids.extend(b.id for b in Build.create(filter(None, vlist)))
+
+    def results():
+        for build_id in build_ids:
+            for i in range(results_per_build):
+                yield {
+                    'build': build_id,
+                    'name': 'tests.test_module.TestCase.test_%s' % i,
+                    'state': random.choice(['pass'] * 97 + ['fail', 'fail',
+                            'error']),
+                    'duration': random.expovariate(10),
+                    }
+    Result.insert_results(results())
+    return components, groups
+
+
+def run(size, components, results_per_build):
+    pool = Pool()
+    Component = pool.get('project.work.component')
+    Group = pool.get('project.test.build.group')
+    Build = pool.get('project.test.build')
+    transaction = Transaction()
+
+    start = time.time()
+    components, groups = generate(size, components, results_per_build)
+    transaction.commit()
+    yield {
+        'path': 'generate',
+        'results': size,
+        'backend': backend.name(),
+        'elapsed': round(time.time() - start, 6),
+        }
+
+    group_ids = [g.id for g in groups]
+    component_ids = [c.id for c in components]
+    states = ['test_state', 'flake_state', 'coverage_state']
+    yield measure('TestBuildGroup.get_state', size, Group.read, group_ids,
+        states)
+    yield measure('TestBuildGroup.search_state', size, Group.search,
+        [('test_state', '=', 'fail')])
+    yield measure('TestBuild.search_state', size, Build.search,
+        [('test_state', '=', 'fail')])
+    yield measure('Component.get_state', size, Component.read,
+        component_ids, ['last_build'] + states)
+    yield measure('Component.update_last_build', size,
+        Component.update_last_build, components)
+    transaction.rollback()
+    yield measure('TestBuildGroup.delete_old_builds', size,
+        Group.delete_old_builds)
+    Group.delete(Group.search([('id', 'in', group_ids)]))
+    Component.delete(components)
+    transaction.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+            '\n')[0])
+    parser.add_argument('--results', type=int, nargs='+',
+        default=[10000, 100000, 1000000],
+        help='number of results to generate for each run')
+    parser.add_argument('--components', type=int, default=50)
+    parser.add_argument('--results-per-build', type=int, default=200)
+    parser.add_argument('--output', type=argparse.FileType('a'),
+        default=sys.stdout, help='file where JSON lines are appended')
+    args = parser.parse_args()
+
+    install_module('project_unittest')
+    for size in args.results:
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            for result in run(size, args.components,
+                    args.results_per_build):
+                args.output.write(json.dumps(result) + '\n')
+                args.output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,41 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
+from contextlib import contextmanager
+from io import BytesIO
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import test_view, test_depends
+from trytond.tests.test_tryton import test_view, test_depends, DB_NAME, \
+    USER, CONTEXT
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.project_unittest.export import JUnitWriter, \
+    CSVWriter
+from trytond.modules.project_unittest.failure import fingerprint, summary
+from trytond.modules.project_unittest.impact import numbits_to_lines, \
+    lines_to_numbits, numbits_any, diff_changes
+from trytond.modules.project_unittest.linecoverage import encode_runs, \
+    decode_runs
+from trytond.modules.project_unittest.planner import lpt_shards, \
+    priority_order, first_bad
+from trytond.modules.project_unittest.report import iter_junit, \
+    iter_subunit, read_coverage
+from trytond.modules.project_unittest.runner import Runner
+from trytond.modules.project_unittest.stream import ResultStream
+from trytond.modules.project_unittest.template import template_key, \
+    TemplatePool
 
 
 class TestCase(unittest.TestCase):
@@ -19,6 +52,1153 @@ class TestCase(unittest.TestCase):
         'Test depends'
         test_depends()
 
+    def test0010report_parsers(self):
+        'Test report parsers'
+        junit = BytesIO(b'''<testsuites><testsuite name="project">
+            <testcase classname="tests.Test" name="test_pass"/>
+            <testcase classname="tests.Test" name="test_fail">
+                <failure message="AssertionError">Traceback</failure>
+            </testcase>
+            <testcase name="scenario_project.rst">
+                <error>Error</error>
+            </testcase>
+            </testsuite></testsuites>''')
+        self.assertEqual([(r['name'], r['type'], r['state'])
+                for r in iter_junit(junit)], [
+                ('tests.Test.test_pass', 'unittest', 'pass'),
+                ('tests.Test.test_fail', 'unittest', 'fail'),
+                ('scenario_project.rst', 'scenario', 'error'),
+                ])
+
+        subunit = BytesIO(b'''test: test_pass
+success: test_pass
+test: test_fail
+failure: test_fail [
+Traceback
+]
+''')
+        results = list(iter_subunit(subunit))
+        self.assertEqual([(r['name'], r['state']) for r in results],
+            [('test_pass', 'pass'), ('test_fail', 'fail')])
+        self.assertEqual(results[1]['description'], 'Traceback\n')
+
+        coverage = BytesIO(b'''<?xml version="1.0" ?>
+            <coverage line-rate="0.75" lines-covered="75" lines-valid="100">
+            </coverage>''')
+        self.assertEqual(read_coverage(coverage), (75.0, 100, 75))
+
+    def test0020lpt_shards(self):
+        'Test longest processing time first shards'
+        durations = {'a': 5, 'b': 4, 'c': 3, 'd': 3, 'e': 3}
+        self.assertEqual(lpt_shards(durations, 2), [
+                (8, ['a', 'd']),
+                (10, ['b', 'c', 'e']),
+                ])
+        shards = lpt_shards(durations, 10)
+        self.assertEqual(len(shards), 5)
+        self.assertEqual(sorted(t for _, tests in shards for t in tests),
+            sorted(durations))
+
+    def test0025priority_order(self):
+        'Test failure first ordering'
+        self.assertEqual(priority_order(['a', 'b', 'c', 'd', 'e'],
+                ['d', 'x', 'b'], ['b', 'e']),
+            ['d', 'b', 'e', 'a', 'c'])
+        self.assertEqual(priority_order(['b', 'a']), ['a', 'b'])
+
+    def test0026first_bad(self):
+        'Test bisection of revisions'
+        revisions = range(100)
+        for culprit in (1, 37, 99):
+            tested = []
+
+            def is_bad(revision):
+                tested.append(revision)
+                return revision >= culprit
+            self.assertEqual(first_bad(revisions, is_bad), culprit)
+            self.assertLessEqual(len(tested), 7)
+
+    def test0030numbits(self):
+        'Test numbits'
+        numbits = lines_to_numbits([1, 2, 10, 64])
+        self.assertEqual(numbits_to_lines(numbits), [1, 2, 10, 64])
+        self.assertTrue(numbits_any(numbits, lines_to_numbits([3, 10])))
+        self.assertFalse(numbits_any(numbits, lines_to_numbits([3, 11])))
+
+    def test0035diff_changes(self):
+        'Test changed lines of diffs'
+        diff = """diff --git a/module.py b/module.py
+--- a/module.py
++++ b/module.py
+@@ -2,4 +2,5 @@ import os
+ context
+-removed
++added
++++counter
+ context
+\\ No newline at end of file
+@@ -20 +21,0 @@
+-removed
+diff --git a/old.py b/old.py
+--- a/old.py
++++ /dev/null
+@@ -1 +0,0 @@
+-removed
+--- /dev/null	2001-01-01
++++ b/new.py	2001-01-01
+@@ -0,0 +1,2 @@
++first
++second
+"""
+        self.assertEqual(diff_changes(diff.splitlines()), {
+                'module.py': [3, 4],
+                'new.py': [1, 2],
+                })
+
+    def test0040runs(self):
+        'Test run length encoding of lines'
+        for lines in ([], [1], [1, 2, 3, 7, 8, 100, 101, 5000]):
+            self.assertEqual(decode_runs(encode_runs(lines)), lines)
+        self.assertEqual(len(encode_runs(range(1, 10000))), 3)
+
+    def test0050result_stream(self):
+        'Test buffering of streamed results'
+        pushed = []
+        now = [0]
+        stream = ResultStream(lambda r: pushed.append(len(r)), size=3,
+            interval=10, clock=lambda: now[0])
+        for i in range(4):
+            stream.add('test_%s' % i, 'pass')
+        self.assertEqual(pushed, [3])
+        now[0] = 10
+        stream.add('test_4', 'fail')
+        self.assertEqual(pushed, [3, 2])
+        stream.add('test_5', 'pass')
+        stream.close()
+        self.assertEqual(pushed, [3, 2, 1])
+
+        # Results are flushed while the next test is running
+        timers = []
+
+        class Timer(object):
+            def __init__(self, interval, function):
+                self.interval = interval
+                self.function = function
+                self.cancelled = False
+                timers.append(self)
+
+            def start(self):
+                pass
+
+            def cancel(self):
+                self.cancelled = True
+
+        pushed = []
+        stream = ResultStream(lambda r: pushed.append(len(r)), size=10,
+            interval=5, clock=lambda: now[0], timer=Timer)
+        stream.add('test_0', 'pass')
+        stream.add('test_1', 'pass')
+        timer, = timers
+        self.assertEqual(timer.interval, 5)
+        self.assertEqual(pushed, [])
+        timer.function()
+        self.assertEqual(pushed, [2])
+        self.assertTrue(timer.cancelled)
+        stream.close()
+        self.assertEqual(pushed, [2])
+
+    def test0055push_results(self):
+        'Test progress of pushed results'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Group = pool.get('project.test.build.group')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'push',
+                        }])
+            build = self.create_build(component)
+            self.assertEqual(Build.push_results(build, [{
+                            'name': 'test_%s' % i,
+                            'state': state,
+                            } for i, state in enumerate(
+                                ['pass', 'pass', 'fail'])], total=4), 3)
+            build = Build(build.id)
+            self.assertEqual((build.expected_tests, build.done_tests,
+                    build.failed_tests, build.test_state), (4, 3, 1, 'fail'))
+            group = build.group
+            self.assertEqual((group.expected_tests, group.done_tests,
+                    group.failed_tests, group.progress), (4, 3, 1, 75.0))
+
+            Build.push_results(build, [{
+                        'name': 'test_3',
+                        'state': 'pass',
+                        }])
+            self.assertEqual(Group(group.id).progress, 100.0)
+
+    def test0060failure_fingerprint(self):
+        'Test fingerprint of failures'
+        traceback = ('Traceback (most recent call last):\n'
+            '  File "%s/trytond/modules/sale/tests.py", line %s, in test\n'
+            '    Object at %s\n'
+            'AssertionError: 1 != 2\n')
+        first = traceback % ('/home/build-1', 12, '0x7f3a2c')
+        second = traceback % ('/tmp/build-2', 14, '0x7f4b8e')
+        self.assertEqual(fingerprint(first), fingerprint(second))
+        self.assertNotEqual(fingerprint(first),
+            fingerprint(first.replace('1 != 2', '1 != 3')))
+        self.assertEqual(summary(first), 'AssertionError: 1 != 2')
+
+    def test0070export_writers(self):
+        'Test export of results'
+        results = [{
+                'name': 'tests.Test.test_pass',
+                'type': 'unittest',
+                'state': 'pass',
+                'duration': 0.5,
+                'flaky': False,
+                'description': None,
+                }, {
+                'name': 'tests.Test.test_fail',
+                'type': 'unittest',
+                'state': 'fail',
+                'duration': None,
+                'flaky': False,
+                'description': u'Traceback\nAssertionError: 1 < 2',
+                }]
+        report = BytesIO()
+        writer = JUnitWriter(report)
+        writer.start_build('project@1', 2, 1, 0, 0.5)
+        for result in results:
+            writer.write(result)
+        writer.end_build()
+        writer.close()
+        report.seek(0)
+        self.assertEqual([(r['name'], r['state'], r['description'])
+                for r in iter_junit(report)], [
+                ('tests.Test.test_pass', 'pass', None),
+                ('tests.Test.test_fail', 'fail',
+                    'AssertionError: 1 < 2\nTraceback\n'
+                    'AssertionError: 1 < 2'),
+                ])
+
+        report = BytesIO()
+        writer = CSVWriter(report)
+        writer.start_build('project@1', 2, 1, 0, 0.5)
+        for result in results:
+            writer.write(result)
+        self.assertEqual(len(report.getvalue().splitlines()), 4)
+
+    def test0080template_pool(self):
+        'Test pool of SQLite template databases'
+        self.assertEqual(template_key(['b', 'a'], '1', 'sqlite'),
+            template_key(['a', 'b'], '1', 'sqlite'))
+        self.assertNotEqual(template_key(['a', 'b'], '1', 'sqlite'),
+            template_key(['a', 'b'], '2', 'sqlite'))
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        pool = TemplatePool(os.path.join(path, 'templates'))
+        with open(os.devnull, 'wb') as log:
+            for i in range(2):
+                directory = os.path.join(path, 'build-%s' % i)
+                os.mkdir(directory)
+                spec = {
+                    'components': ['a', 'b'],
+                    'db_type': 'sqlite',
+                    'directory': directory,
+                    'database': 'test',
+                    'template_command': (
+                        'echo $DB_NAME > $DB_NAME.sqlite; echo >> created'),
+                    'dependencies_command': 'echo 1',
+                    }
+                env = pool.clone(spec, os.environ.copy(), log)
+                self.assertEqual(env['DB_NAME'], 'test')
+                self.assertTrue(
+                    os.path.exists(os.path.join(directory, 'test.sqlite')))
+        # The template is created only once
+        self.assertTrue(os.path.exists(
+                os.path.join(path, 'build-0', 'created')))
+        self.assertFalse(os.path.exists(
+                os.path.join(path, 'build-1', 'created')))
+        pool.invalidate()
+        self.assertFalse([f for f in os.listdir(pool.path)
+                if not f.endswith('.lock')])
+
+    def test0085runner(self):
+        'Test parallel run of the shards of builds'
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        tasks = []
+        for shard in range(2):
+            directory = os.path.join(path, 'build-1-%s' % shard)
+            tasks.append({
+                    'build': 1,
+                    'shard': shard,
+                    'directory': directory,
+                    'database': None,
+                    'commands': [
+                        ('mkdir %s' % directory, path),
+                        ('test "$(cat tests.txt)" = test_%s' % shard,
+                            directory),
+                        ],
+                    'env': {},
+                    'files': {
+                        'tests.txt': b'test_0',
+                        },
+                    })
+        done = []
+        self.assertTrue(Runner(2).run(tasks,
+                lambda *args: done.append(args) or True))
+        self.assertEqual(sorted(done), [(1, 0, 0), (1, 1, 1)])
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Start a transaction which is rolled back at the end of the test,
+        including the work of the methods which commit by batches
+        '''
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction, \
+                patch.object(Transaction, 'commit'):
+            try:
+                yield transaction
+            finally:
+                transaction.rollback()
+
+    def create_build(self, component, revision='1', **values):
+        'Create a build of component in a new group'
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Build = pool.get('project.test.build')
+        group_values = {
+            'name': component.name,
+            'db_type': 'sqlite',
+            }
+        for name in ('end', 'work', 'shards', 'db_type'):
+            if name in values:
+                group_values[name] = values.pop(name)
+        group, = Group.create([group_values])
+        build_values = {
+            'group': group.id,
+            'component': component.id,
+            'branch': 'default',
+            'revision': revision,
+            'covered_lines': 0,
+            }
+        build_values.update(values)
+        build, = Build.create([build_values])
+        return build
+
+    def set_archive_path(self):
+        'Store the archives in a temporary directory and return it'
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        if not config.has_section('project_unittest'):
+            config.add_section('project_unittest')
+        config.set('project_unittest', 'archive_path', path)
+        self.addCleanup(config.remove_option, 'project_unittest',
+            'archive_path')
+        return path
+
+    def test0090archive_restore(self):
+        'Test archive and restore of groups'
+        with self.transaction():
+            pool = Pool()
+            Group = pool.get('project.test.build.group')
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Archive = pool.get('project.test.build.archive')
+            Component = pool.get('project.work.component')
+
+            self.set_archive_path()
+            component, = Component.create([{
+                        'name': 'archive',
+                        }])
+            execution = datetime.datetime(2001, 1, 1, 12, 30)
+            build = self.create_build(component, revision='a1',
+                execution=execution, end=execution)
+            group = build.group
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'tests.Test.test_pass',
+                        'state': 'pass',
+                        'duration': 0.5,
+                        }, {
+                        'build': build.id,
+                        'name': 'tests.Test.test_fail',
+                        'state': 'fail',
+                        'description': 'Traceback\nAssertionError',
+                        }])
+
+            Group.archive_old_builds(datetime.date(2001, 1, 2))
+            group = Group(group.id)
+            self.assertTrue(group.archived)
+            self.assertEqual(Build.search([
+                        ('group', '=', group.id),
+                        ]), [])
+            archive, = Archive.search([
+                    ('group', '=', group.id),
+                    ])
+            self.assertEqual((archive.component, archive.branch,
+                    archive.revision, archive.execution, archive.results),
+                (component, 'default', 'a1', execution, 2))
+
+            Group.restore([group])
+            group = Group(group.id)
+            self.assertFalse(group.archived)
+            self.assertEqual(Archive.search([
+                        ('group', '=', group.id),
+                        ]), [])
+            build, = group.builds
+            self.assertEqual((build.component, build.revision,
+                    build.execution), (component, 'a1', execution))
+            self.assertEqual(sorted((r.name, r.state, r.duration,
+                        r.description) for r in build.test), [
+                    ('tests.Test.test_fail', 'fail', None,
+                        'Traceback\nAssertionError'),
+                    ('tests.Test.test_pass', 'pass', 0.5, None),
+                    ])
+            self.assertEqual((group.test_state, group.done_tests,
+                    group.failed_tests), ('fail', 2, 1))
+
+    def test0100build_states(self):
+        'Test stored states and counters of builds and groups'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'states',
+                        }])
+            build = self.create_build(component)
+            self.assertEqual((build.test_state, build.flake_state,
+                    build.coverage_state), ('pass', 'pass', 'ok'))
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'test_pass',
+                        'state': 'pass',
+                        }, {
+                        'build': build.id,
+                        'name': 'test_fail',
+                        'state': 'fail',
+                        'description': 'AssertionError',
+                        }, {
+                        'build': build.id,
+                        'name': 'flake',
+                        'type': 'flake',
+                        'state': 'error',
+                        }])
+            build = Build(build.id)
+            group = build.group
+            for record in (build, group):
+                self.assertEqual((record.test_state, record.flake_state,
+                        record.done_tests, record.failed_tests),
+                    ('fail', 'error', 2, 1))
+
+            failed, = Result.search([
+                    ('build', '=', build.id),
+                    ('state', '=', 'fail'),
+                    ])
+            Result.delete([failed])
+            build = Build(build.id)
+            self.assertEqual((build.test_state, build.flake_state,
+                    build.done_tests, build.failed_tests),
+                ('pass', 'error', 1, 0))
+            self.assertEqual(build.group.test_state, 'pass')
+
+            Build.write([build], {
+                    'coverage': 55.0,
+                    })
+            build = Build(build.id)
+            self.assertEqual(build.coverage_state, 'to_improve')
+            self.assertEqual(build.group.coverage_state, 'to_improve')
+
+    def test0105import_report(self):
+        'Test import of reports'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'import',
+                        }])
+            build = self.create_build(component)
+            junit = b'''<testsuite>
+                <testcase classname="tests.Test" name="test_pass"/>
+                <testcase classname="tests.Test" name="test_fail">
+                    <failure>Traceback</failure>
+                </testcase>
+                </testsuite>'''
+            self.assertEqual(Build.import_report(build, BytesIO(junit)), 2)
+            # Clients send the content of the report
+            self.assertEqual(Build.upload_report(build, bytearray(
+                        b'test: test_subunit\nsuccess: test_subunit\n'),
+                    format_='subunit'), 1)
+            build = Build(build.id)
+            self.assertEqual((build.test_state, build.done_tests,
+                    build.failed_tests), ('fail', 3, 1))
+            self.assertEqual(sorted((r.name, r.state) for r in build.test), [
+                    ('test_subunit', 'pass'),
+                    ('tests.Test.test_fail', 'fail'),
+                    ('tests.Test.test_pass', 'pass'),
+                    ])
+
+    def test0110last_build(self):
+        'Test last build of components'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'last_build',
+                        }])
+            first = self.create_build(component, revision='1',
+                execution=datetime.datetime(2002, 1, 1))
+            last = self.create_build(component, revision='2',
+                execution=datetime.datetime(2002, 1, 2))
+            Result.insert_results([{
+                        'build': last.id,
+                        'name': 'test_fail',
+                        'state': 'fail',
+                        }])
+            component = Component(component.id)
+            self.assertEqual(component.last_build, last)
+            self.assertEqual(component.test_state, 'fail')
+            self.assertEqual(Component.search([
+                        ('id', '=', component.id),
+                        ('test_state', '=', 'fail'),
+                        ]), [component])
+
+            Build.delete([last])
+            component = Component(component.id)
+            self.assertEqual(component.last_build, first)
+            self.assertEqual(component.test_state, 'pass')
+
+    def test0120delete_old_builds(self):
+        'Test deletion of old builds by batches'
+        with self.transaction():
+            pool = Pool()
+            Group = pool.get('project.test.build.group')
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'delete',
+                        }])
+            end = datetime.datetime(2002, 6, 1)
+            old = [self.create_build(component, revision=str(i), end=end)
+                for i in range(3)]
+            recent = self.create_build(component, revision='3',
+                end=datetime.datetime(2002, 6, 3))
+            for build in old + [recent]:
+                Result.insert_results([{
+                            'build': build.id,
+                            'name': 'test_%s' % i,
+                            'state': 'pass',
+                            } for i in range(3)])
+
+            totals = Group.delete_old_builds(datetime.date(2002, 6, 2),
+                batch_size=2)
+            self.assertEqual(totals, {
+                    'results': 9,
+                    'builds': 3,
+                    'groups': 3,
+                    })
+            self.assertEqual(Build.search([
+                        ('component', '=', component.id),
+                        ]), [recent])
+            self.assertEqual(Group.search([
+                        ('id', 'in', [b.group.id for b in old]),
+                        ]), [])
+            self.assertEqual(len(Result.search([
+                            ('build', '=', recent.id),
+                            ])), 3)
+            self.assertEqual(Component(component.id).last_build, recent)
+
+    def test0125archive_old_builds(self):
+        'Test archive of the builds of expired groups'
+        with self.transaction():
+            pool = Pool()
+            Configuration = pool.get('project.test.configuration')
+            Group = pool.get('project.test.build.group')
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            path = self.set_archive_path()
+            component, = Component.create([{
+                        'name': 'expire',
+                        }])
+            Configuration.write([Configuration(1)], {
+                    'test_component': component.id,
+                    'directory': path,
+                    'retention_weeks': 2,
+                    'archive_builds': True,
+                    })
+            now = datetime.datetime.now()
+            expired = self.create_build(component, revision='1',
+                end=now - datetime.timedelta(weeks=3))
+            kept = self.create_build(component, revision='2',
+                end=now - datetime.timedelta(weeks=1))
+            Result.insert_results([{
+                        'build': expired.id,
+                        'name': 'test_%s' % i,
+                        'state': 'pass',
+                        } for i in range(2)])
+
+            # Archived groups are not deleted
+            self.assertEqual(Group.delete_old_builds(), {
+                    'results': 0,
+                    'builds': 0,
+                    'groups': 0,
+                    })
+            group = Group(expired.group.id)
+            self.assertTrue(group.archived)
+            archive, = group.archives
+            self.assertEqual((archive.revision, archive.results), ('1', 2))
+            self.assertEqual(Build.search([
+                        ('component', '=', component.id),
+                        ]), [kept])
+            self.assertFalse(Group(kept.group.id).archived)
+
+    def test0130flakiness(self):
+        'Test flaky score of test cases'
+        with self.transaction():
+            pool = Pool()
+            Result = pool.get('project.test.build.result')
+            TestCase = pool.get('project.test.case')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'flakiness',
+                        }])
+            builds = []
+            for day, state in enumerate(['pass', 'fail', 'pass'], 1):
+                build = self.create_build(component,
+                    execution=datetime.datetime(2005, 1, day))
+                Result.insert_results([{
+                            'build': build.id,
+                            'name': 'test_flaky',
+                            'state': state,
+                            }, {
+                            'build': build.id,
+                            'name': 'test_stable',
+                            'state': 'pass',
+                            }])
+                builds.append(build)
+            flaky, = TestCase.search([
+                    ('component', '=', component.id),
+                    ('name', '=', 'test_flaky'),
+                    ])
+            stable, = TestCase.search([
+                    ('component', '=', component.id),
+                    ('name', '=', 'test_stable'),
+                    ])
+            # Each run flips the state: 0.3 then 0.3 * 0.7 + 0.3
+            self.assertEqual((flaky.flaky_score, flaky.flaky), (0.51, True))
+            self.assertEqual((stable.flaky_score, stable.flaky), (0, False))
+            self.assertEqual(Component(component.id).flaky_tests, 1)
+            self.assertEqual([Result.search([
+                            ('build', '=', b.id),
+                            ('case', '=', flaky.id),
+                            ])[0].flaky for b in builds],
+                [False, True, True])
+
+            # Other revisions are not compared
+            build = self.create_build(component, revision='2',
+                execution=datetime.datetime(2005, 1, 4))
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'test_flaky',
+                        'state': 'fail',
+                        }])
+            self.assertEqual(TestCase(flaky.id).flaky_score, 0.51)
+
+    def test0135shards(self):
+        'Test durations of test cases and shards of builds'
+        with self.transaction():
+            pool = Pool()
+            Configuration = pool.get('project.test.configuration')
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            TestCase = pool.get('project.test.case')
+            Coverage = pool.get('project.test.build.coverage')
+            Component = pool.get('project.work.component')
+
+            path = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, path)
+            component, = Component.create([{
+                        'name': 'shards',
+                        }])
+            Configuration.write([Configuration(1)], {
+                    'test_component': component.id,
+                    'directory': path,
+                    })
+            for durations in ([1.0, 1.0, 0.5], [2.0], [1.0]):
+                build = self.create_build(component)
+                Result.insert_results([{
+                            'build': build.id,
+                            'name': name,
+                            'state': 'pass',
+                            'duration': duration,
+                            } for name, duration
+                        in zip(['test_a', 'test_b', 'test_c'], durations)])
+            self.assertEqual(sorted((c.name, c.average_duration)
+                    for c in TestCase.search([
+                            ('component', '=', component.id),
+                            ])), [
+                    ('test_a', 1.16),
+                    ('test_b', 1.0),
+                    ('test_c', 0.5),
+                    ])
+
+            build = self.create_build(component, shards=2)
+            tasks = build.get_tasks(Configuration(1))
+            self.assertEqual([(t['shard'], t['files']['tests.txt'])
+                    for t in tasks], [
+                    (0, b'test_a\n'),
+                    (1, b'test_b\ntest_c\n'),
+                    ])
+            reports = [
+                (b'<testcase name="test_a"/>',
+                    {'module.py': '100', 'other.py': '000'}),
+                (b'<testcase name="test_b"><failure/></testcase>'
+                    b'<testcase name="test_c"/>',
+                    {'module.py': '010', 'other.py': '011'}),
+                ]
+            for task, (junit, hits) in zip(tasks, reports):
+                os.makedirs(task['directory'])
+                with open(os.path.join(task['directory'], 'junit.xml'),
+                        'wb') as report:
+                    report.write(b'<testsuite>' + junit + b'</testsuite>')
+                with open(os.path.join(task['directory'], 'coverage.xml'),
+                        'wb') as report:
+                    report.write(b'<coverage><packages><package><classes>')
+                    for filename in sorted(hits):
+                        report.write(b'<class filename="%s"><lines>'
+                            % filename)
+                        for number, hit in enumerate(hits[filename], 1):
+                            report.write(b'<line number="%s" hits="%s"/>'
+                                % (number, hit))
+                        report.write(b'</lines></class>')
+                    report.write(b'</classes></package></packages>'
+                        b'</coverage>')
+            imported = build.import_task(tasks[0], 0)
+            self.assertEqual(imported, 1)
+            self.assertEqual(build.import_task(tasks[1], 1, imported), 2)
+
+            build = Build(build.id)
+            self.assertEqual((build.test_state, build.done_tests,
+                    build.failed_tests), ('fail', 3, 1))
+            # A line is covered if any shard covers it
+            self.assertEqual(sorted((c.filename, c.lines, c.covered_lines)
+                    for c in Coverage.search([
+                            ('build', '=', build.id),
+                            ])), [
+                    ('module.py', 3, 2),
+                    ('other.py', 3, 2),
+                    ])
+            self.assertEqual((build.lines, build.covered_lines,
+                    build.coverage), (6, 4, 66.67))
+
+    def test0137impact(self):
+        'Test import of coverage contexts and selection of tests'
+        with self.transaction():
+            pool = Pool()
+            Result = pool.get('project.test.build.result')
+            Impact = pool.get('project.test.impact')
+            Component = pool.get('project.work.component')
+
+            path = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, path)
+            component, = Component.create([{
+                        'name': 'impact',
+                        }])
+            build = self.create_build(component)
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'tests.Test.%s' % name,
+                        'state': 'pass',
+                        } for name in ['test_a', 'test_b']])
+
+            filename = os.path.join(path, '.coverage')
+            connection = sqlite3.connect(filename)
+            connection.executescript('''
+                CREATE TABLE context (id INTEGER, context TEXT);
+                CREATE TABLE file (id INTEGER, path TEXT);
+                CREATE TABLE line_bits (file_id INTEGER, context_id INTEGER,
+                    numbits BLOB);
+                INSERT INTO context VALUES (1, 'test_a'), (2, 'test_b');
+                INSERT INTO file VALUES (1, '/src/module.py');
+                ''')
+            connection.executemany('INSERT INTO line_bits VALUES (1, ?, ?)',
+                [(1, sqlite3.Binary(lines_to_numbits([1, 2]))),
+                    (2, sqlite3.Binary(lines_to_numbits([1, 3])))])
+            connection.commit()
+            connection.close()
+            with open(filename, 'rb') as file_:
+                Impact.upload_contexts(build, bytearray(file_.read()),
+                    root='/src')
+
+            self.assertEqual(Impact.select_tests(component.id, {
+                        'module.py': [2],
+                        }), (['tests.Test.test_a'], []))
+            self.assertEqual(Impact.select_tests(component.id, {
+                        'module.py': [1],
+                        'other.py': [1],
+                        }), (['tests.Test.test_a', 'tests.Test.test_b'],
+                    ['other.py']))
+
+            # No database is created for a missing file
+            missing = os.path.join(path, 'missing')
+            with self.assertRaises(UserError):
+                Impact.import_contexts(build, missing)
+            self.assertFalse(os.path.exists(missing))
+
+    def test0140link_cache(self):
+        'Test reuse of finished builds'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'cache',
+                        }])
+            source = self.create_build(component, revision='1',
+                coverage=80.0)
+            Result.insert_results([{
+                        'build': source.id,
+                        'name': 'test_fail',
+                        'state': 'fail',
+                        }])
+            Build.finish([source])
+            # Cancelled build with results and finished build without
+            cancelled = self.create_build(component, revision='2')
+            Result.insert_results([{
+                        'build': cancelled.id,
+                        'name': 'test_pass',
+                        'state': 'pass',
+                        }])
+            empty = self.create_build(component, revision='3')
+            Build.finish([empty])
+
+            builds = [self.create_build(component, revision=r)
+                for r in ('1', '2', '3')]
+            to_run = Build.link_cache(builds)
+            self.assertEqual(to_run, builds[1:])
+            linked = Build(builds[0].id)
+            self.assertEqual(linked.cache_build, source)
+            self.assertEqual((linked.test_state, linked.done_tests,
+                    linked.failed_tests, linked.coverage),
+                ('fail', 1, 1, 80.0))
+
+            # Results are kept when the source is deleted
+            Build.delete([source])
+            linked = Build(linked.id)
+            self.assertEqual(linked.cache_build, None)
+            self.assertEqual(len(linked.test), 1)
+            self.assertEqual(linked.test_state, 'fail')
+
+    def test0145cache_coverage(self):
+        'Test the coverage of builds linked to a released cache'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Coverage = pool.get('project.test.build.coverage')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'cache coverage',
+                        }])
+            source = self.create_build(component)
+            Result.insert_results([{
+                        'build': source.id,
+                        'name': 'test_pass',
+                        'state': 'pass',
+                        }])
+            Build.import_coverage(source, BytesIO(
+                    b'<coverage line-rate="0.5" lines-covered="2" '
+                    b'lines-valid="4"><packages><package><classes>'
+                    b'<class filename="module.py"><lines>'
+                    b'<line number="1" hits="1"/>'
+                    b'<line number="2" hits="0"/>'
+                    b'<line number="3" hits="1"/>'
+                    b'<line number="4" hits="0"/>'
+                    b'</lines></class>'
+                    b'</classes></package></packages></coverage>'))
+            Build.finish([source])
+            first, second = [self.create_build(component)
+                for _ in range(2)]
+            self.assertEqual(Build.link_cache([first, second]), [])
+
+            changes = {'module.py': [2, 3, 5]}
+            expected = {
+                'lines': 2,
+                'covered_lines': 1,
+                'coverage': 50.0,
+                'missing': {'module.py': [2]},
+                }
+            self.assertEqual(Build.diff_coverage(first, changes), expected)
+
+            # The coverage moves with the results when the source is run again
+            Build.clear_results([Build(source.id)])
+            first, second = Build(first.id), Build(second.id)
+            self.assertEqual(first.cache_build, second)
+            self.assertEqual(
+                Coverage.search([('build', '=', source.id)]), [])
+            self.assertEqual(Build.diff_coverage(first, changes), expected)
+
+            # And when it is deleted
+            Build.delete([second])
+            first = Build(first.id)
+            self.assertEqual(first.cache_build, None)
+            self.assertEqual(
+                len(Coverage.search([('build', '=', first.id)])), 1)
+            self.assertEqual(Build.diff_coverage(first, changes), expected)
+
+    def test0150rollup(self):
+        'Test daily roll-up of results'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Rollup = pool.get('project.test.rollup')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'rollup',
+                        }])
+            execution = datetime.datetime(2003, 3, 3, 10)
+            build = self.create_build(component, execution=execution,
+                coverage=60.0)
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'test_%s' % i,
+                        'state': state,
+                        } for i, state in enumerate(['pass', 'pass', 'fail'])]
+                + [{
+                        'build': build.id,
+                        'name': 'pep8',
+                        'type': 'pep8',
+                        'state': 'pass',
+                        }])
+            empty = self.create_build(component, execution=execution,
+                coverage=80.0)
+            Build.finish([build, empty])
+            # Builds are added only once
+            Build.finish([build])
+
+            def rollups():
+                return sorted((r.day, r.type, r.passed, r.failed, r.builds,
+                        r.min_coverage, r.average_coverage)
+                    for r in Rollup.search([
+                            ('component', '=', component.id),
+                            ]))
+            expected = [
+                (execution.date(), 'pep8', 1, 0, 1, 60.0, 60.0),
+                (execution.date(), 'unittest', 2, 1, 2, 60.0, 70.0),
+                ]
+            self.assertEqual(rollups(), expected)
+
+            Rollup.backfill()
+            self.assertEqual(rollups(), [])
+            Rollup.roll_up_builds(batch_size=1)
+            self.assertEqual(rollups(), expected)
+
+    def test0160result_weeks(self):
+        'Test week of results'
+        with self.transaction():
+            pool = Pool()
+            Group = pool.get('project.test.build.group')
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'weeks',
+                        }])
+            build = self.create_build(component,
+                execution=datetime.datetime(2004, 1, 7))
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'test_fail',
+                        'state': 'fail',
+                        }])
+            week = datetime.date(2004, 1, 5)
+            result, = build.test
+            self.assertEqual((Build(build.id).week, result.week),
+                (week, week))
+
+            # Results keep their week when the build is run again
+            Build.write([build], {
+                    'execution': datetime.datetime(2004, 2, 4),
+                    })
+            self.assertEqual(Build.get_weeks([build.id]), {build.id: week})
+            Group.update_state([build.group])
+            build = Build(build.id)
+            self.assertEqual((build.test_state, build.done_tests),
+                ('fail', 1))
+
+            Build.clear_results([build])
+            build = Build(build.id)
+            self.assertEqual((build.week, build.test, build.test_state,
+                    build.done_tests), (None, (), 'pass', 0))
+            self.assertEqual(Build.get_weeks([build.id]),
+                {build.id: datetime.date(2004, 2, 2)})
+
+    def test0165export_results(self):
+        'Test export of results by chunks'
+        with self.transaction():
+            pool = Pool()
+            Build = pool.get('project.test.build')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'export',
+                        }])
+            builds = [self.create_build(component, revision=r)
+                for r in ('1', '2', '3')]
+            Result.insert_results([{
+                        'build': builds[0].id,
+                        'name': 'tests.Test.test_%s' % name,
+                        'state': 'pass',
+                        } for name in ('a', 'b', 'c')]
+                + [{
+                        'build': builds[2].id,
+                        'name': 'tests.Test.test_d',
+                        'state': 'fail',
+                        'description': 'AssertionError',
+                        }])
+
+            for format_ in ('junit', 'csv'):
+                export, next_offset = Build.export_results(builds, format_,
+                    limit=None)
+                self.assertEqual(next_offset, None)
+                for limit in (1, 2, 3, 4):
+                    chunks, offsets = [], []
+                    offset = 0
+                    while offset is not None:
+                        chunk, offset = Build.export_results(builds,
+                            format_, offset=offset, limit=limit)
+                        chunks.append(bytes(chunk))
+                        offsets.append(offset)
+                    self.assertEqual(b''.join(chunks), bytes(export))
+                    self.assertEqual(offsets,
+                        range(limit, 4, limit) + [None])
+            self.assertEqual(bytes(export).count(b'\n'), 5)
+
+    def test0168bisect_builds(self):
+        'Test the builds read by bisects'
+        with self.transaction():
+            pool = Pool()
+            Result = pool.get('project.test.build.result')
+            Bisect = pool.get('project.test.bisect')
+            Component = pool.get('project.work.component')
+
+            component, = Component.create([{
+                        'name': 'bisect',
+                        }])
+            bisect, = Bisect.create([{
+                        'component': component.id,
+                        'branch': 'default',
+                        'db_type': 'sqlite',
+                        'good_revision': '1',
+                        'bad_revision': '2',
+                        }])
+            build = self.create_build(component, revision='2')
+            # Builds of other database types or branches are ignored
+            postgresql = self.create_build(component, revision='2',
+                db_type='postgresql')
+            branch = self.create_build(component, revision='2',
+                branch='other')
+            Result.insert_results([{
+                        'build': build.id,
+                        'name': 'test_a',
+                        'state': 'fail',
+                        }, {
+                        'build': build.id,
+                        'name': 'test_b',
+                        'state': 'pass',
+                        }, {
+                        'build': postgresql.id,
+                        'name': 'test_b',
+                        'state': 'fail',
+                        }, {
+                        'build': branch.id,
+                        'name': 'test_c',
+                        'state': 'fail',
+                        }])
+
+            self.assertEqual(bisect.get_failing_tests(), ['test_a'])
+            self.assertEqual(
+                bisect.get_states('2', ['test_a', 'test_b', 'test_c']),
+                (build, {'test_a': 'fail', 'test_b': 'pass'}))
+
+    def test0170work_summary(self):
+        'Test test summary of tasks'
+        with self.transaction():
+            pool = Pool()
+            Group = pool.get('project.test.build.group')
+            Result = pool.get('project.test.build.result')
+            Component = pool.get('project.work.component')
+            Work = pool.get('project.work')
+
+            company = create_company()
+            with set_company(company):
+                work, = Work.create([{
+                            'name': 'Task',
+                            'company': company.id,
+                            }])
+                component, = Component.create([{
+                            'name': 'summary',
+                            }])
+                running = self.create_build(component, work=work.id)
+                work = Work(work.id)
+                self.assertEqual((work.last_test_group, work.test_state,
+                        work.passed_test_groups, work.failed_test_groups),
+                    (None, None, 0, 0))
+
+                Group.write([running.group], {
+                        'end': datetime.datetime.now(),
+                        })
+                work = Work(work.id)
+                self.assertEqual((work.last_test_group, work.test_state,
+                        work.passed_test_groups, work.failed_test_groups),
+                    (running.group, 'pass', 1, 0))
+
+                failing = self.create_build(component, work=work.id,
+                    end=datetime.datetime.now())
+                Result.insert_results([{
+                            'build': failing.id,
+                            'name': 'test_fail',
+                            'state': 'fail',
+                            }])
+                work = Work(work.id)
+                self.assertEqual((work.last_test_group, work.test_state,
+                        work.passed_test_groups, work.failed_test_groups),
+                    (failing.group, 'fail', 1, 1))
+                self.assertIn(work, Work.search([
+                            ('test_state', '=', 'fail'),
+                            ]))
+
+                Group.delete([failing.group])
+                work = Work(work.id)
+                self.assertEqual((work.last_test_group, work.test_state,
+                        work.failed_test_groups),
+                    (running.group, 'pass', 0))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -1,8 +1,16 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from sql import Null
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case
 
+from trytond import backend
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+from .test import STATES, COVERAGE_STATES, update_rows
 
 
 __all__ = ['Work']
@@ -14,3 +22,84 @@ class Work:
 
     unittests = fields.One2Many('project.test.build.group', 'work',
         'Unittests')
+    last_test_group = fields.Many2One('project.test.build.group',
+        'Last Test Group', readonly=True, ondelete='SET NULL')
+    test_state = fields.Selection([(None, '')] + STATES, 'Test State',
+        readonly=True, select=True)
+    flake_state = fields.Selection([(None, '')] + STATES, 'Flake State',
+        readonly=True, select=True)
+    coverage_state = fields.Selection([(None, '')] + COVERAGE_STATES,
+        'Coverage State', readonly=True, select=True)
+    passed_test_groups = fields.Integer('Passed Test Groups', readonly=True)
+    failed_test_groups = fields.Integer('Failed Test Groups', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        Build = pool.get('project.test.build')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        group = Group.__table__()
+        build = Build.__table__()
+
+        migrate_summary = not TableHandler(cls, module_name).column_exist(
+            'last_test_group')
+
+        super(Work, cls).__register__(module_name)
+
+        # Migration from 3.4: the test states of builds and groups and the
+        # test summary are stored.
+        # It is done by the last registered model as the states depend on
+        # columns of results and on the summary of tasks.
+        if migrate_summary:
+            cursor.execute(*build.select(build.id))
+            Build.refresh_state(Build.browse([i for i, in cursor.fetchall()]))
+            cursor.execute(*group.select(group.id))
+            Group.refresh_state(Group.browse([i for i, in cursor.fetchall()]))
+
+    @staticmethod
+    def default_passed_test_groups():
+        return 0
+
+    @staticmethod
+    def default_failed_test_groups():
+        return 0
+
+    @classmethod
+    def update_test_summary(cls, works):
+        '''
+        Store the last ended test group of works, its states and the number
+        of ended groups which passed and failed
+        '''
+        pool = Pool()
+        Group = pool.get('project.test.build.group')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        group = Group.__table__()
+
+        names = ['last_test_group', 'test_state', 'flake_state',
+            'coverage_state', 'passed_test_groups', 'failed_test_groups']
+        for sub_works in grouped_slice(works):
+            sub_ids = [w.id for w in sub_works]
+            summaries = dict((i, [None, None, None, None, 0, 0])
+                for i in sub_ids)
+            cursor.execute(*group.select(group.work, Max(group.id),
+                    Sum(Case((group.test_state == 'pass', 1), else_=0)),
+                    Sum(Case((group.test_state.in_(['fail', 'error']), 1),
+                            else_=0)),
+                    where=reduce_ids(group.work, sub_ids)
+                    & (group.end != Null),
+                    group_by=group.work))
+            for work_id, group_id, passed, failed in cursor.fetchall():
+                summaries[work_id][0] = group_id
+                summaries[work_id][4:] = [passed, failed]
+            last_ids = [s[0] for s in summaries.itervalues() if s[0]]
+            if last_ids:
+                cursor.execute(*group.select(group.work, group.test_state,
+                        group.flake_state, group.coverage_state,
+                        where=reduce_ids(group.id, last_ids)))
+                for work_id, test, flake, coverage in cursor.fetchall():
+                    summaries[work_id][1:4] = [test, flake, coverage]
+            update_rows(table, names,
+                [tuple(v) + (k,) for k, v in summaries.iteritems()])